@@ -1,94 +1,142 @@
 import json
 import asyncio
+from contextlib import aclosing
+from typing import Dict, Optional
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query, status
 from starlette.websockets import WebSocketState
 from app.services.llm_engine import llm_engine
 from app.services.hybrid_search import hybrid_engine
-from app.services.time_service import time_service
 from app.services.diagnosis import diagnosis_service
 import base64
 import os
 import uuid
-from app.services.market_price import market_price_service
 from app.core.config import settings
-from app.core.database import get_db_connection, save_chat_session, load_chat_session, append_chat_turn, append_user_turn, update_ai_turn, update_user_image_path
-import random
-import re
+from app.services.conversation import conversation_manager
+from app.services.prompt_builder import prompt_builder
+from app.services.response_cache import response_cache
+from app.services.intent_router import intent_router
+from app.services.fast_paths import fast_paths
+from app.core.executors import executors
+from app.utils.streaming import stream_text, client_pace_ms, encode_frame, ReplyStream
 
 router = APIRouter()
 
+class ClientConnection:
+    """
+    One websocket, possibly carrying several chat threads (ids).
+    Answers for different ids run concurrently (at most WS_MAX_CONCURRENT per connection) and
+    their frames, tagged by id, go through one bounded outbox drained by a single writer task:
+    when the client reads slowly the outbox fills and producers (LLM streams) wait - backpressure.
+    """
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.outbox: asyncio.Queue = asyncio.Queue(maxsize=settings.WS_SEND_QUEUE)
+        self.slots = asyncio.Semaphore(settings.WS_MAX_CONCURRENT)
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.used_ids = set()
+        self.broken = False
+        self.writer: Optional[asyncio.Task] = None
+
+    @property
+    def client_state(self):
+        return self.websocket.client_state
+
+    def start(self):
+        self.writer = asyncio.create_task(self._drain())
+
+    async def _drain(self):
+        while True:
+            text = await self.outbox.get()
+            if self.broken:
+                continue  # keep consuming so producers never block on a dead socket
+            try:
+                await self.websocket.send_text(text)
+            except Exception as e:
+                print(f"send error (connection dropped): {e}")
+                self.broken = True
+
+    async def send_text(self, text: str):
+        if self.broken or self.websocket.client_state != WebSocketState.CONNECTED:
+            return
+        await self.outbox.put(text)
+
+    async def send_json(self, message: dict):
+        await self.send_text(encode_frame(message))
+
+    def active(self) -> int:
+        return sum(1 for t in self.tasks.values() if not t.done())
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.cancel()
+            await asyncio.gather(self.writer, return_exceptions=True)
+
 # Store active connections
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
+        self.active_connections: list[ClientConnection] = []
     
-    async def connect(self, websocket: WebSocket):
-        if websocket.client_state != WebSocketState.CONNECTED:
-            await websocket.accept()
-        self.active_connections.append(websocket)
+    async def connect(self, websocket: WebSocket) -> ClientConnection:
+        await websocket.accept()
+        conn = ClientConnection(websocket)
+        conn.start()
+        self.active_connections.append(conn)
+        return conn
     
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+    async def disconnect(self, conn: ClientConnection):
+        if conn in self.active_connections:
+            self.active_connections.remove(conn)
+        await conn.close()
     
-    async def send_json(self, message: dict, websocket: WebSocket):
+    async def send_json(self, message: dict, conn: ClientConnection):
         try:
-            if websocket.client_state != WebSocketState.CONNECTED:
-                return
-            await websocket.send_json(message)
+            await conn.send_json(message)
         except Exception as e:
             print(f"send_json error (ignored): {e}")
 
-manager = ConnectionManager()
-
-# In-memory history for simplicity (or use DB/Redis later)
-# Format: {session_id: [{"role": "user", "content": "..."}]}
-history_store = {}
-flush_tasks = {}
+    def stats(self) -> dict:
+        return {
+            "connections": len(self.active_connections),
+            "active_answers": sum(c.active() for c in self.active_connections),
+            "queued_frames": sum(c.outbox.qsize() for c in self.active_connections),
+            "max_concurrent_per_connection": settings.WS_MAX_CONCURRENT,
+        }
 
-def cancel_flush_task(session_id: str):
-    task = flush_tasks.pop(session_id, None)
-    if task and not task.done():
-        task.cancel()
+manager = ConnectionManager()
 
-async def schedule_flush(session_id: str):
-    async def worker():
-        await asyncio.sleep(settings.WS_DISCONNECT_TTL_SECONDS)
-        if session_id in history_store:
-            del history_store[session_id]
-    t = asyncio.create_task(worker())
-    flush_tasks[session_id] = t
+def save_upload(path: str, img_b64: str):
+    if "," in img_b64:
+        img_b64 = img_b64.split(",", 1)[1]
+    with open(path, "wb") as f:
+        f.write(base64.b64decode(img_b64))
 
-SYSTEM_INSTRUCTION = """Bạn là trợ lý AI chuyên nghiệp của công ty KAGRI (Công ty Cổ phần Tập đoàn Nông nghiệp KAGRI). 
-Nhiệm vụ của bạn là hỗ trợ khách hàng trả lời các câu hỏi về sản phẩm nông nghiệp, phân bón, kỹ thuật trồng trọt và thông tin công ty.
+class ActiveTurn:
+    """
+    The turn a task is answering: on cancel / supersede / disconnect the wrapper persists
+    whatever was already streamed (partial) through update_ai_turn.
+    """
+    def __init__(self, session, turn_idx: int, user_text: str):
+        self.session = session
+        self.turn_idx = turn_idx
+        self.user_text = user_text
+        self.partial = ""
+        self.finished = False
 
-QUY TẮC QUAN TRỌNG (BẮT BUỘC TUÂN THỦ):
-1. NGÔN NGỮ: TUYỆT ĐỐI CHỈ DÙNG TIẾNG VIỆT.
-2. PHONG CÁCH TRẢ LỜI:
-   - Thân thiện, mềm mại, lễ phép, tận tâm.
-   - Luôn dùng từ "Dạ" ở đầu câu và "ạ" ở cuối câu khi phù hợp để thể hiện sự tôn trọng (Ví dụ: "Dạ, số điện thoại của công ty là... ạ").
-   - Tránh dùng từ ngữ quá chuyên môn gây khó hiểu, diễn đạt tự nhiên như người thật.
-3. CHÍNH XÁC VÀ TRUNG THỰC (QUAN TRỌNG NHẤT):
-   - Với câu hỏi về CÔNG TY, SẢN PHẨM, CHUYÊN GIA: CHỈ được sử dụng thông tin có trong phần "CONTEXT".
-   - TUYỆT ĐỐI KHÔNG sử dụng kiến thức bên ngoài để trả lời về các chủ đề này.
-   - Nếu Context KHÔNG chứa thông tin: Hãy trả lời "Dạ, hiện tại em chưa tìm thấy thông tin này trong hệ thống dữ liệu của KAGRI. Mời anh/chị liên hệ hotline 0985 562 582 để được hỗ trợ chi tiết ạ."
-   - KHÔNG ĐƯỢC BỊA ĐẶT (Hallucinate) bất kỳ thông tin nào.
-4. XỬ LÝ CÂU HỎI VỀ CÔNG TY:
-   - Trình bày ĐẦY ĐỦ và CHI TIẾT thông tin từ Context (Tầm nhìn, Sứ mệnh, Giá trị cốt lõi...).
-   - Với số điện thoại/địa chỉ: Trả lời chính xác kèm lời dẫn lịch sự.
-5. Khi trả lời về thông tin CÔNG TY / SẢN PHẨM / CHUYÊN GIA: LUÔN kèm lời mời "Mời xem chi tiết tại: <URL>" sử dụng đúng URL có trong Context.
-6. Với câu hỏi về SẢN PHẨM CỤ THỂ: Trả lời ĐẦY ĐỦ các trường (Tên, Thành phần, Công dụng, Hướng dẫn sử dụng) nếu có trong Context.
+    async def finish(self, user_text: str, ai_text: str):
+        self.finished = True
+        await conversation_manager.finish_turn(self.session, self.turn_idx, user_text, ai_text)
 
-THÔNG TIN ĐƯỢC CUNG CẤP (CONTEXT):
-{context}
-"""
+    async def attach_image(self, path: str):
+        await conversation_manager.attach_image(self.session, self.turn_idx, path)
 
 @router.websocket("/ws/kagriai")
-async def websocket_endpoint(websocket: WebSocket, session_id: str = "default"):
-    if websocket.client_state != WebSocketState.CONNECTED:
-        await websocket.accept()
-    await manager.connect(websocket)
-    used_ids = set()
-    
+async def websocket_endpoint(websocket: WebSocket, session_id: str = "default", pace_ms: str = None):
+    conn = await manager.connect(websocket)
+    # Reader loop only parses messages; each id is answered by its own task so several threads
+    # share the socket without head-of-line blocking, and {"type":"cancel"}, a newer message
+    # for the same id, or a disconnect can interrupt the LLM stream (closing the Ollama request).
+    tasks = conn.tasks
+
     try:
         while True:
             data = await websocket.receive_text()
@@ -103,397 +151,175 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str = "default"):
                 await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
                 continue
             request_id = str(parsed.get("id"))
-            used_ids.add(request_id)
-            cancel_flush_task(request_id)
-            async def send(payload: dict):
-                payload["id"] = request_id
-                await manager.send_json(payload, websocket)
-            if request_id not in history_store:
-                loaded = load_chat_session(request_id)
-                if loaded:
-                    full_turns = loaded.get("turns", [])
-                    recent_turns = full_turns[-settings.MAX_TURNS:]
-                    history_store[request_id] = {
-                        "turns": recent_turns,
-                        "full_turns": full_turns,
-                        "meta": loaded.get("meta", {"last_product_code": None})
-                    }
-                else:
-                    history_store[request_id] = {
-                        "turns": [],
-                        "full_turns": [],
-                        "meta": {"last_product_code": None}
-                    }
+            previous = tasks.get(request_id)
+            if previous is not None and not previous.done():
+                # Explicit stop, or superseded by a newer message on the same thread
+                previous.cancel()
+            if parsed.get("type") == "cancel":
+                continue
+            tasks[request_id] = asyncio.create_task(run_message(conn, parsed, previous, pace_ms))
+            for rid in [rid for rid, t in tasks.items() if t.done()]:
+                del tasks[rid]
 
-            last_code = history_store[request_id]["meta"].get("last_product_code")
-            user_text = parsed.get("text", "") if isinstance(parsed, dict) else data
-            turn_idx = None
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # Abort in-flight answers (partial answers are saved), then unpin so the idle TTL starts counting
+        running = [t for t in tasks.values() if not t.done()]
+        for t in running:
+            t.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+        for rid in list(conn.used_ids):
+            conversation_manager.release(rid)
+        await manager.disconnect(conn)
+
+async def run_message(conn: ClientConnection, parsed: dict, previous: Optional[asyncio.Task], pace_ms: Optional[str]):
+    """
+    Task wrapper around handle_message: per-id ordering (waits for the superseded answer),
+    the per-connection concurrency cap, cancellation and partial-answer saving.
+    """
+    request_id = str(parsed.get("id"))
+    turn = None
+    try:
+        if previous is not None:
+            # Let the superseded answer save its partial turn first, keeps turn order in the session
+            await asyncio.gather(previous, return_exceptions=True)
+        async with conn.slots:
+            session = await conversation_manager.get(request_id)
+            if request_id not in conn.used_ids:
+                conn.used_ids.add(request_id)
+                conversation_manager.pin(session)
+            user_text = parsed.get("text", "") or ""
             # Save user turn immediately (text only for non-image; with [image] tag for image)
-            if isinstance(parsed, dict) and parsed.get("type") == "image_query":
-                turn_idx = append_user_turn(request_id, "[image] " + (user_text or ""), None, last_code)
+            if parsed.get("type") == "image_query":
+                turn_idx = await conversation_manager.begin_turn(session, "[image] " + user_text)
             else:
-                turn_idx = append_user_turn(request_id, user_text, None, last_code)
-            if isinstance(parsed, dict) and parsed.get("type") == "image_query" and parsed.get("image_base64"):
-                try:
-                    await send({"type": "start"})
-                    plant_type = (parsed.get("plant_type") or "").lower().strip()
-                    if plant_type not in ("durian", "coffee"):
-                        await send({"type": "stream", "content": "Dạ, anh/chị vui lòng chọn loại cây: 'durian' hoặc 'coffee' ạ."})
-                        await send({"type": "end"})
-                        history_store[request_id]["full_turns"].append({"user": "[image] " + user_text, "ai": "Thiếu loại cây"})
-                        history_store[request_id]["turns"].append({"user": "[image] " + user_text, "ai": "Thiếu loại cây"})
-                        update_ai_turn(request_id, turn_idx, "Thiếu loại cây")
-                        if len(history_store[request_id]["turns"]) > settings.MAX_TURNS:
-                            history_store[request_id]["turns"].pop(0)
-                        continue
-                    
-                    # Save user image to disk for persistence
-                    base_dir = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
-                    uploads_dir = os.path.join(base_dir, "app", "data", "uploads")
-                    os.makedirs(uploads_dir, exist_ok=True)
-                    filename = f"{request_id}-{uuid.uuid4().hex}.png"
-                    img_path_abs = os.path.join(uploads_dir, filename)
-                    
-                    img_b64 = parsed.get("image_base64")
-                    if "," in img_b64:
-                        img_b64 = img_b64.split(",", 1)[1]
-                    with open(img_path_abs, "wb") as f:
-                        f.write(base64.b64decode(img_b64))
-                    update_user_image_path(request_id, turn_idx, img_path_abs)
-                    
-                    # Run diagnosis
-                    result = diagnosis_service.predict(parsed.get("image_base64"), plant_type)
-                    if result.get("error"):
-                        await send({"type": "stream", "content": "Dạ, ảnh chưa hợp lệ hoặc mô hình chưa sẵn sàng ạ."})
-                        await send({"type": "end"})
-                        history_store[request_id]["full_turns"].append({"user": "[image] " + user_text, "ai": "Ảnh không hợp lệ", "user_image_path": img_path_abs})
-                        history_store[request_id]["turns"].append({"user": "[image] " + user_text, "ai": "Ảnh không hợp lệ"})
-                        update_ai_turn(request_id, turn_idx, "Ảnh không hợp lệ")
-                        if len(history_store[request_id]["turns"]) > settings.MAX_TURNS:
-                            history_store[request_id]["turns"].pop(0)
-                        continue
-                    
-                    preds = result.get("predictions", [])
-                    if not preds:
-                        text_reply = "Dạ, em chưa phát hiện được bệnh rõ ràng từ ảnh này. Anh/chị vui lòng thử ảnh khác rõ nét hơn ạ."
-                        await send({"type": "stream", "content": text_reply})
-                        await send({"type": "end"})
-                        history_store[request_id]["full_turns"].append({"user": "[image] " + user_text, "ai": text_reply, "user_image_path": img_path_abs})
-                        history_store[request_id]["turns"].append({"user": "[image] " + user_text, "ai": text_reply})
-                        update_ai_turn(request_id, turn_idx, text_reply)
-                        if len(history_store[request_id]["turns"]) > settings.MAX_TURNS:
-                            history_store[request_id]["turns"].pop(0)
-                        continue
-                    
-                    # Build text reply and attach example images of top prediction
-                    top = preds[0]
-                    lines = []
-                    lines.append(f"Dạ, ảnh cho thấy khả năng cao: {top['name']} ({top['probability']}%).")
-                    if len(preds) > 1:
-                        lines.append("Các khả năng tiếp theo:")
-                        for p in preds[1:]:
-                            lines.append(f"- {p['name']} ({p['probability']}%)")
-                    lines.append("Em gửi kèm ảnh mẫu bệnh để anh/chị đối chiếu ạ.")
-                    text_reply = "\n".join(lines)
-                    
-                    await send({"type": "stream", "content": text_reply})
-                    if top.get("images"):
-                        await send({"type": "images", "images": top["images"]})
-                    await send({"type": "end"})
-                    
-                    history_store[request_id]["full_turns"].append({"user": "[image] " + user_text, "ai": text_reply, "user_image_path": img_path_abs})
-                    history_store[request_id]["turns"].append({"user": "[image] " + user_text, "ai": text_reply})
-                    update_ai_turn(request_id, turn_idx, text_reply)
-                    if len(history_store[request_id]["turns"]) > settings.MAX_TURNS:
-                        history_store[request_id]["turns"].pop(0)
-                    continue
-                except Exception as e:
-                    print(f"Image diagnose error: {e}")
-                    await send({"type": "error", "content": "Lỗi chẩn đoán ảnh ạ."})
-                    continue
-
-            # --- CUSTOM HANDLER FOR TIME/DATE ---
-            lower_data = user_text.lower().strip()
-            time_keywords = ["mấy giờ", "ngày bao nhiêu", "hôm nay là", "thời gian", "ngày mấy", "giờ nào"]
-            lunar_keywords = ["âm lịch", "lịch âm", "ngày âm", "hôm nay âm", "hôm nay âm lịch"]
-            is_time_query = any(k in lower_data for k in time_keywords) or any(k in lower_data for k in lunar_keywords)
-            
-            nums = re.findall(r"\d{1,4}", lower_data)
-            am_keywords = ["âm", "am"]
-            duong_keywords = ["dương", "duong"]
-            convert_keywords = ["chuyển", "chuyen", "đổi", "doi", "convert", "->", "sang", "bao nhiêu dương", "bao nhieu duong", "là ngày dương", "la ngay duong", "thứ mấy", "thu may", "thứ"]
-            has_am = any(k in lower_data for k in am_keywords)
-            has_duong = any(k in lower_data for k in duong_keywords)
-            has_convert_kw = any(k in lower_data for k in convert_keywords)
-            is_convert_intent = len(nums) >= 3 and (has_convert_kw or (has_am and has_duong))
-            
-            if is_convert_intent:
-                try:
-                    a, b, c = nums[0], nums[1], nums[2]
-                    if len(a) == 4:
-                        date_str = f"{a}/{b}/{c}"
-                    else:
-                        date_str = f"{a}/{b}/{c}"
-                    convert_to_am = any(phrase in lower_data for phrase in ["sang âm", "doi sang am", "đổi sang âm", "duong sang am", "dương sang âm"])
-                    convert_to_duong = any(phrase in lower_data for phrase in ["sang dương", "doi sang duong", "đổi sang dương", "am sang duong", "âm sang dương"])
-                    idx_am = min([lower_data.find(k) for k in am_keywords if k in lower_data] + [9999])
-                    idx_duong = min([lower_data.find(k) for k in duong_keywords if k in lower_data] + [9999])
-                    if convert_to_duong and not convert_to_am:
-                        is_lunar = True
-                    elif convert_to_am and not convert_to_duong:
-                        is_lunar = False
-                    elif has_am and has_duong:
-                        is_lunar = idx_am <= idx_duong
-                    else:
-                        is_lunar = has_am and not has_duong
-                    result_text = time_service.get_date_info(date_str, is_lunar=is_lunar)
-                    await send({"type": "start"})
-                    await send({"type": "stream", "content": result_text})
-                    await send({"type": "end"})
-                    history_store[request_id]["full_turns"].append({"user": user_text, "ai": result_text})
-                    history_store[request_id]["turns"].append({"user": user_text, "ai": result_text})
-                    update_ai_turn(request_id, turn_idx, result_text)
-                    if len(history_store[request_id]["turns"]) > settings.MAX_TURNS:
-                        history_store[request_id]["turns"].pop(0)
-                    continue
-                except Exception as e:
-                    await send({"type": "start"})
-                    await send({"type": "stream", "content": "Dạ, em không chuyển được ngày âm dương với định dạng vừa nhập ạ."})
-                    await send({"type": "end"})
-                    history_store[request_id]["full_turns"].append({"user": user_text, "ai": "Không chuyển được ngày âm dương"})
-                    history_store[request_id]["turns"].append({"user": user_text, "ai": "Không chuyển được ngày âm dương"})
-                    update_ai_turn(request_id, turn_idx, "Không chuyển được ngày âm dương")
-                    if len(history_store[request_id]["turns"]) > settings.MAX_TURNS:
-                        history_store[request_id]["turns"].pop(0)
-                    continue
-            
-            if (not is_convert_intent) and is_time_query:
-                try:
-                    if len(nums) >= 3:
-                        a, b, c = nums[0], nums[1], nums[2]
-                        if len(a) == 4:
-                            date_str = f"{a}/{b}/{c}"
-                        else:
-                            date_str = f"{a}/{b}/{c}"
-                        is_lunar_flag = has_am and not has_duong
-                        date_info = time_service.get_date_info(date_str, is_lunar=is_lunar_flag)
-                        await send({"type": "start"})
-                        await send({"type": "stream", "content": date_info})
-                        await send({"type": "end"})
-                        history_store[request_id]["full_turns"].append({"user": user_text, "ai": date_info})
-                        history_store[request_id]["turns"].append({"user": user_text, "ai": date_info})
-                        update_ai_turn(request_id, turn_idx, date_info)
-                        if len(history_store[request_id]["turns"]) > settings.MAX_TURNS:
-                            history_store[request_id]["turns"].pop(0)
-                        continue
-                    else:
-                        time_response = time_service.get_current_time_info()
-                        await send({"type": "start"})
-                        await send({"type": "stream", "content": time_response})
-                        await send({"type": "end"})
-                        history_store[request_id]["full_turns"].append({"user": user_text, "ai": time_response})
-                        history_store[request_id]["turns"].append({"user": user_text, "ai": time_response})
-                        update_ai_turn(request_id, turn_idx, time_response)
-                        if len(history_store[request_id]["turns"]) > settings.MAX_TURNS:
-                            history_store[request_id]["turns"].pop(0)
-                        continue
-                except Exception as e:
-                    print(f"Time service error: {e}")
-
-            # --- CUSTOM HANDLER FOR DIAGNOSIS INTENT ---
-            lower_data = user_text.lower().strip()
-            diagnose_keywords = [
-                "chẩn đoán", "chẩn đoán bệnh", "chẩn đoán bệnh cây trồng",
-                "chẩn đoán qua ảnh", "chan doan", "chan doan benh", "chan doan qua anh"
-            ]
-            is_diagnose_intent = any(k in lower_data for k in diagnose_keywords)
-            if is_diagnose_intent:
-                try:
-                    guide = (
-                        "Để chẩn đoán bệnh cây trồng qua ảnh, mời anh/chị bấm nút "
-                        "“Chẩn đoán bệnh cây trồng qua ảnh” ở cạnh ô nhập, tải ảnh vết bệnh lên và chọn loại cây.\n\n"
-                        "Lưu ý:\n"
-                        "- Hiện hỗ trợ: Sầu Riêng (Thán thư, Ung thư thân, Thối trái, Rệp sáp, Nấm hồng, Bồ hóng, Cháy lá chết ngọn, Xì mủ thân, Bọ trĩ, Vàng lá) và Cà Phê (Gỉ sắt, Sâu vẽ bùa, Bệnh khô cành, Khỏe mạnh).\n"
-                        "- Ảnh cần rõ nét, tập trung vết bệnh, ánh sáng tốt, khoảng cách 30–50 cm.\n"
-                        "- Nếu bệnh ngoài danh sách, kết quả có thể chưa chính xác. Liên hệ hotline 0985.562.582 hoặc kagri.vn để được tư vấn chuyên gia."
-                    )
-                    await send({"type": "start"})
-                    chunk_size = 100
-                    for i in range(0, len(guide), chunk_size):
-                        await send({"type": "stream", "content": guide[i:i+chunk_size]})
-                        await asyncio.sleep(0.02)
-                    await send({"type": "end"})
-                    
-                    history_store[request_id]["full_turns"].append({"user": user_text, "ai": guide})
-                    history_store[request_id]["turns"].append({"user": user_text, "ai": guide})
-                    update_ai_turn(request_id, turn_idx, guide)
-                    if len(history_store[request_id]["turns"]) > settings.MAX_TURNS:
-                        history_store[request_id]["turns"].pop(0)
-                    continue
-                except Exception as e:
-                    print(f"Diagnosis guide error: {e}")
+                turn_idx = await conversation_manager.begin_turn(session, user_text)
+            turn = ActiveTurn(session, turn_idx, user_text)
+            await handle_message(conn, parsed, session, turn, pace_ms)
+    except asyncio.CancelledError:
+        if turn is not None and not turn.finished:
+            print(f"[WS] Generation for {request_id} cancelled after {len(turn.partial)} chars")
+            await turn.finish(turn.user_text, turn.partial)
+            await manager.send_json({"type": "end", "cancelled": True, "id": request_id}, conn)
+        raise
+    except Exception as e:
+        print(f"[WS] Handler error for {request_id}: {e}")
 
-            # --- CUSTOM HANDLER FOR MARKET PRICE ---
-            lower_data = user_text.lower().strip()
-            price_keywords = ["giá nông sản", "giá cà phê", "giá tiêu", "giá lúa", "giá gạo", "giá thóc", "giá sầu riêng", "giá heo", "giá lợn"]
-            is_price_query = any(k in lower_data for k in price_keywords)
-            
-            if is_price_query:
-                try:
-                    # Detect product to show meaningful progress
-                    product = "nông sản"
-                    source_hint = "thị trường nội địa"
-                    if "tiêu" in lower_data:
-                        product = "hồ tiêu"
-                        source_hint = "giatieu.com"
-                    elif "cà phê" in lower_data or "cafe" in lower_data:
-                        product = "cà phê"
-                        source_hint = "baoquocte.vn"
-                    elif "lúa" in lower_data or "gạo" in lower_data or "thóc" in lower_data:
-                        product = "lúa gạo"
-                        source_hint = "vietnambiz.vn"
-                    elif "sầu riêng" in lower_data:
-                        product = "sầu riêng"
-                        source_hint = "nguồn tổng hợp"
-                    
-                    
-                    await asyncio.sleep(0.05)
-                    
-                    
-                    price_response = market_price_service.get_prices(lower_data)
-                    
-                    
-                    await send({"type": "start"})
-                    
-                    chunk_size = 80
-                    for i in range(0, len(price_response), chunk_size):
-                        await send({"type": "stream", "content": price_response[i:i+chunk_size]})
-                        await asyncio.sleep(0.02)
-                    
-                    await send({"type": "end"})
-                    
-                    history_store[request_id]["full_turns"].append({"user": user_text, "ai": price_response})
-                    history_store[request_id]["turns"].append({"user": user_text, "ai": price_response})
-                    update_ai_turn(request_id, turn_idx, price_response)
-                    if len(history_store[request_id]["turns"]) > settings.MAX_TURNS:
-                        history_store[request_id]["turns"].pop(0)
-                    continue
-                except Exception as e:
-                    print(f"Market price error: {e}")
-
-            # --- CUSTOM HANDLER FOR PRODUCT LIST ---
-            lower_data = user_text.lower().strip()
-            product_intent_keywords = ["các sản phẩm", "danh sách sản phẩm", "sản phẩm của công ty", "tất cả sản phẩm", "sản phẩm đang có"]
-            is_product_list = any(k in lower_data for k in product_intent_keywords)
-            
-            # Additional heuristic: "sản phẩm" + "bao nhiêu" / "tổng số" / "liệt kê"
-            if not is_product_list and "sản phẩm" in lower_data:
-                if any(x in lower_data for x in ["bao nhiêu", "tổng số", "liệt kê", "giới thiệu", "nào", "gì"]):
-                    is_product_list = True
-            
-            if is_product_list:
-                try:
-                    conn = get_db_connection()
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT code, name, usage, url FROM products")
-                    all_products = cursor.fetchall()
-                    conn.close()
-                    
-                    total_count = len(all_products)
-                    
-                    if total_count > 0:
-                        examples = random.sample(all_products, min(3, total_count))
-                        
-                        response_text = f"Dạ, hiện tại KAGRI đang cung cấp tổng cộng **{total_count} sản phẩm** phục vụ đa dạng nhu cầu của bà con nông dân ạ.\n\n"
-                        response_text += "Các sản phẩm của KAGRI bao gồm thuốc trừ sâu, thuốc trừ bệnh, phân bón và các chế phẩm sinh học, giúp bảo vệ cây trồng khỏi sâu bệnh hại và tăng năng suất.\n\n"
-                        response_text += "Em xin phép giới thiệu 3 sản phẩm tiêu biểu với các công dụng khác nhau ạ:\n\n"
-                        
-                        for i, prod in enumerate(examples, 1):
-                            usage_text = prod['usage'] if prod['usage'] else "Đang cập nhật công dụng"
-                            usage_text = " ".join(usage_text.split())
-                            if len(usage_text) > 150:
-                                usage_text = usage_text[:147] + "..."
-                                
-                            response_text += f"{i}. **{prod['name']}** ({prod['code']})\n"
-                            response_text += f"   - Công dụng: {usage_text}\n"
-                            response_text += f"   👉 Chi tiết: {prod['url']}\n\n"
-                            
-                        response_text += "Mời anh/chị xem thêm danh sách đầy đủ tại website hoặc hỏi em về loại bệnh cụ thể để em tư vấn sản phẩm phù hợp nhất ạ."
-                        
-                        await send({"type": "start"})
-                        chunk_size = 50
-                        for i in range(0, len(response_text), chunk_size):
-                            await send({"type": "stream", "content": response_text[i:i+chunk_size]})
-                            await asyncio.sleep(0.02)
-                        
-                        await send({"type": "end"})
-                        
-                        history_store[request_id]["full_turns"].append({"user": user_text, "ai": response_text})
-                        history_store[request_id]["turns"].append({"user": user_text, "ai": response_text})
-                        update_ai_turn(request_id, turn_idx, response_text)
-                        if len(history_store[request_id]["turns"]) > settings.MAX_TURNS:
-                            history_store[request_id]["turns"].pop(0)
-                        continue
-                except Exception as e:
-                    print(f"Product list handler error: {e}")
+async def handle_message(conn: ClientConnection, parsed: dict, session, turn: ActiveTurn, pace_ms: Optional[str]):
+    request_id = str(parsed.get("id"))
+    async def send(payload: dict):
+        payload["id"] = request_id
+        await manager.send_json(payload, conn)
+    # Typing-effect pacing only when the client asks for it (message or ?pace_ms= on connect)
+    pace = client_pace_ms(parsed.get("pace_ms"), pace_ms)
+    async def reply(text):
+        return await stream_text(conn, request_id, text, pace_ms=pace)
 
-            try:
-                context_result = hybrid_engine.get_context(user_text, last_product_code=last_code)
-                context_text = context_result["text"]
-                found_code = context_result["product_code"]
-            except Exception as e:
-                print(f"Context error: {e}")
-                await send({"type": "error", "content": "Lỗi lấy ngữ cảnh: " + str(e)})
+    last_code = session.meta.get("last_product_code")
+    user_text = turn.user_text
+    if isinstance(parsed, dict) and parsed.get("type") == "image_query" and parsed.get("image_base64"):
+        try:
+            await send({"type": "start"})
+            plant_type = (parsed.get("plant_type") or "").lower().strip()
+            if plant_type not in ("durian", "coffee"):
+                await send({"type": "stream", "content": "Dạ, anh/chị vui lòng chọn loại cây: 'durian' hoặc 'coffee' ạ."})
                 await send({"type": "end"})
-                continue
-            
-            # Update last_product_code if new product found
-            if found_code:
-                 history_store[request_id]["meta"]["last_product_code"] = found_code
-                 print(f"Session {request_id} updated last_product_code: {found_code}")
-            
-            # 2. Build Prompt with ChatML format (escape braces in context to avoid .format errors)
-            try:
-                safe_context = context_text.replace("{", "{{").replace("}", "}}")
-                system_msg = SYSTEM_INSTRUCTION.format(context=safe_context)
-            except Exception as e:
-                print(f"SYSTEM_INSTRUCTION format error: {e}")
-                system_msg = SYSTEM_INSTRUCTION.format(context="")  # Fallback empty context
-            
-            full_prompt = f"<|im_start|>system\n{system_msg}<|im_end|>\n"
-            
-            for turn in history_store[request_id]["turns"]:
-                full_prompt += f"<|im_start|>user\n{turn['user']}<|im_end|>\n"
-                full_prompt += f"<|im_start|>assistant\n{turn['ai']}<|im_end|>\n"
+                await turn.finish("[image] " + user_text, "Thiếu loại cây")
+                return
             
-            full_prompt += f"<|im_start|>user\n{user_text}\n<|im_end|>\n"
-            full_prompt += "<|im_start|>assistant\n"
+            # Save user image to disk for persistence
+            base_dir = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+            uploads_dir = os.path.join(base_dir, "app", "data", "uploads")
+            os.makedirs(uploads_dir, exist_ok=True)
+            filename = f"{request_id}-{uuid.uuid4().hex}.png"
+            img_path_abs = os.path.join(uploads_dir, filename)
             
-            # 3. Stream Response
+            await executors.run_io(save_upload, img_path_abs, parsed.get("image_base64"))
+            await turn.attach_image(img_path_abs)
             
-            await send({"type": "start"})
+            # Run diagnosis
+            result = await executors.diagnose(parsed.get("image_base64"), plant_type)
+            text_reply = diagnosis_service.reply_text(result)
+            await send({"type": "stream", "content": text_reply})
+            # Example images of the top prediction
+            preds = result.get("predictions") or []
+            if not result.get("error") and preds and preds[0].get("images"):
+                await send({"type": "images", "images": preds[0]["images"]})
+            await send({"type": "end"})
             
-            full_response = ""
-            try:
-                async for chunk in llm_engine.generate_stream(full_prompt, max_tokens=1024):
-                    if chunk["sentence"]:
-                        await send({
-                            "type": "stream",
-                            "content": chunk["sentence"]
-                        })
-                        full_response += chunk["sentence"]
-                await send({"type": "end"})
-            except Exception as e:
-                await send({"type": "error", "content": "Lỗi phản hồi AI: " + str(e)})
-                await send({"type": "end"})
-            
-            history_store[request_id]["full_turns"].append({"user": user_text, "ai": full_response})
-            history_store[request_id]["turns"].append({"user": user_text, "ai": full_response})
-            update_ai_turn(request_id, turn_idx, full_response)
-            if len(history_store[request_id]["turns"]) > settings.MAX_TURNS:
-                history_store[request_id]["turns"].pop(0)
-                
-    except WebSocketDisconnect:
-        manager.disconnect(websocket)
-        for rid in list(used_ids):
-            await schedule_flush(rid)
+            await turn.finish("[image] " + user_text, text_reply)
+            return
+        except Exception as e:
+            print(f"Image diagnose error: {e}")
+            await send({"type": "error", "content": "Lỗi chẩn đoán ảnh ạ."})
+            return
+
+    # Fast paths (date conversion, time, diagnosis guide, market price, product list):
+    # one keyword pass routes the message, a handler that yields nothing falls through to the LLM
+    route = intent_router.route(user_text)
+    if await fast_paths.dispatch(route, turn, ReplyStream(conn, request_id, pace)):
+        return
+
+    try:
+        context_result = await hybrid_engine.aget_context(user_text, last_product_code=last_code, route=route)
+        context_text = context_result["text"]
+        context_sections = context_result.get("sections")
+        found_code = context_result["product_code"]
+    except Exception as e:
+        print(f"Context error: {e}")
+        await send({"type": "error", "content": "Lỗi lấy ngữ cảnh: " + str(e)})
+        await send({"type": "end"})
+        return
+    
+    # Update last_product_code if new product found
+    if found_code:
+         await conversation_manager.update_meta(session, "last_product_code", found_code)
+         print(f"Session {request_id} updated last_product_code: {found_code}")
+    
+    # Same question (by meaning) over the same retrieved context and history -> replay the cached answer
+    cached = await response_cache.lookup(user_text, context_text, history=list(session.turns))
+    if cached is not None and cached.answer is not None:
+        print(f"Response cache hit for {request_id} (sim={cached.similarity:.3f})")
+        cached_text = await reply(cached.answer.sentences)
+        await turn.finish(user_text, cached_text)
+        return
+
+    # 2. Build Prompt: fixed system rules -> context -> history -> user (KV-cache friendly)
+    # Tokenizing is CPU work: off the event loop, on a snapshot of the window
+    prompt = await executors.run_cpu(prompt_builder.build, request_id, context_text, list(session.turns), user_text,
+                                     head=session.head, sections=context_sections,
+                                     max_new_tokens=settings.PROMPT_MAX_NEW_TOKENS)
+    
+    # 3. Stream Response
+    
+    await send({"type": "start"})
+    
+    full_response = ""
+    sentences = []
+    completed = False
+    try:
+        stream = llm_engine.generate_stream(prompt.text, max_tokens=settings.PROMPT_MAX_NEW_TOKENS, context=prompt.context)
+        async with aclosing(stream):
+            async for chunk in stream:
+                if chunk.get("is_final"):
+                    prompt_builder.record(request_id, prompt, chunk.get("stats"))
+                    # Only a real completion carries stats; busy/error replies are not cached
+                    completed = chunk.get("stats") is not None
+                if chunk["sentence"]:
+                    await send({
+                        "type": "stream",
+                        "content": chunk["sentence"]
+                    })
+                    full_response += chunk["sentence"]
+                    turn.partial = full_response
+                    sentences.append(chunk["sentence"])
+        await send({"type": "end"})
+        if completed:
+            response_cache.store(cached, sentences)
+    except Exception as e:
+        await send({"type": "error", "content": "Lỗi phản hồi AI: " + str(e)})
+        await send({"type": "end"})
+    
+    await turn.finish(user_text, full_response)
@@ -26,5 +26,5 @@ class WeatherRequest(BaseModel):
 @router.post("/api/kagriai/weather")
 async def recommendations_weather(req: WeatherRequest):
     items = req.data.getRecommenedWeather if req and req.data else []
-    data = enrich([x.model_dump() for x in items])
+    data = await enrich([x.model_dump() for x in items])
     return data
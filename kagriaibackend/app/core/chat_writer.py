@@ -0,0 +1,214 @@
+import asyncio
+import sqlite3
+import time
+from typing import Dict, List, Optional
+from app.core.config import settings
+from app.core import database
+from app.core.executors import executors
+
+class ChatWriter:
+    """
+    Write-behind queue for chat persistence. Turn inserts and updates from all sessions are
+    collected and written in one transaction every CHAT_WRITE_FLUSH_MS or CHAT_WRITE_BATCH
+    records. Turn indexes come from an in-memory per-session counter (seeded once per session
+    from chat.db), so appending a turn no longer needs a MAX(turn_index) query.
+    A failed batch is rewritten one record per transaction: a turn whose index was taken by
+    another writer moves to the next free index (later updates of that turn follow it), and
+    one bad record never costs the other sessions their turns.
+    Shared mode (SESSION_SHARED, several worker processes): user turns are inserted right away
+    with the index assigned inside the transaction (no per-process counter to go stale); the
+    answer/image updates still go through the queue.
+    Falls back to direct writes when the background task is not running (scripts, tests).
+    """
+    def __init__(self, flush_ms: int = None, max_batch: int = None, shared: Optional[bool] = None):
+        self.flush_interval = (flush_ms if flush_ms is not None else settings.CHAT_WRITE_FLUSH_MS) / 1000.0
+        self.max_batch = max_batch or settings.CHAT_WRITE_BATCH
+        self.shared = settings.SESSION_SHARED if shared is None else shared
+        self.turn_counters: Dict[str, int] = {}
+        # session_id -> {queued turn index: index actually written}, after a conflict
+        self.remapped: Dict[str, Dict[int, int]] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._counter_lock = asyncio.Lock()
+        self.metrics = {"batches": 0, "records": 0, "errors": 0, "reseeded": 0, "dropped": 0, "last_flush_ms": 0.0, "max_flush_ms": 0.0, "total_flush_ms": 0.0, "max_queue_depth": 0}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0):
+        """
+        Durable shutdown: wait for everything queued to be committed, then stop the task.
+        """
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self.flush(), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"ChatWriter stop: {self._queue.qsize()} records not flushed within {timeout}s")
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def flush(self):
+        # join() also waits for the batch the writer task has already taken off the queue
+        if self.running:
+            await self._queue.join()
+
+    def _enqueue(self, op: tuple):
+        self._queue.put_nowait(op)
+        depth = self._queue.qsize()
+        if depth > self.metrics["max_queue_depth"]:
+            self.metrics["max_queue_depth"] = depth
+
+    async def _next_index(self, session_id: str) -> int:
+        async with self._counter_lock:
+            if session_id not in self.turn_counters:
+                await self.flush()
+                self.turn_counters[session_id] = await executors.run_db(database.next_turn_index, session_id)
+            idx = self.turn_counters[session_id]
+            self.turn_counters[session_id] = idx + 1
+            return idx
+
+    def seed(self, session_id: str, next_index: int):
+        self.turn_counters[session_id] = next_index
+
+    def forget(self, session_id: str):
+        self.turn_counters.pop(session_id, None)
+        self.remapped.pop(session_id, None)
+
+    async def append_user_turn(self, session_id: str, user: str, user_image_path: Optional[str] = None, last_product_code: Optional[str] = None) -> int:
+        if not self.running or self.shared:
+            return await database.aappend_user_turn(session_id, user, user_image_path, last_product_code)
+        idx = await self._next_index(session_id)
+        self._enqueue(("user_turn", session_id, idx, user, user_image_path, last_product_code))
+        return idx
+
+    async def update_ai_turn(self, session_id: str, turn_index: int, ai: str):
+        if not self.running:
+            return await database.aupdate_ai_turn(session_id, turn_index, ai)
+        self._enqueue(("ai", session_id, turn_index, ai))
+
+    async def update_user_image_path(self, session_id: str, turn_index: int, user_image_path: str):
+        if not self.running:
+            return await database.aupdate_user_image_path(session_id, turn_index, user_image_path)
+        self._enqueue(("image", session_id, turn_index, user_image_path))
+
+    async def update_last_product_code(self, session_id: str, last_product_code: Optional[str]):
+        if not self.running:
+            return await executors.run_db(database.write_turn_batch, [("meta", session_id, last_product_code)])
+        self._enqueue(("meta", session_id, last_product_code))
+
+    async def next_turn_index(self, session_id: str) -> int:
+        """
+        Next turn index as stored in chat.db (after committing our own queued writes).
+        Used to notice turns written by other worker processes.
+        """
+        await self.flush()
+        return await executors.run_db(database.next_turn_index, session_id)
+
+    async def load_chat_session(self, session_id: str, limit: Optional[int] = None, before: Optional[int] = None):
+        # Read-your-writes: commit anything still queued before reading history back
+        await self.flush()
+        return await database.aload_chat_session(session_id, limit, before)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch: List[tuple] = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _remap(self, op: tuple) -> tuple:
+        moved = self.remapped.get(op[1])
+        if moved and op[0] in ("user_turn", "ai", "image") and op[2] in moved:
+            return op[:2] + (moved[op[2]],) + op[3:]
+        return op
+
+    async def _write(self, batch: List[tuple], attempts: int = 3):
+        for attempt in range(1, attempts + 1):
+            started = time.perf_counter()
+            try:
+                await executors.run_db(database.write_turn_batch, [self._remap(op) for op in batch])
+            except sqlite3.OperationalError as e:
+                # locked/busy: transient, the same batch can succeed on retry
+                self.metrics["errors"] += 1
+                print(f"ChatWriter batch error (attempt {attempt}/{attempts}, {len(batch)} records): {e}")
+                await asyncio.sleep(0.05 * attempt)
+                continue
+            except Exception as e:
+                self.metrics["errors"] += 1
+                print(f"ChatWriter batch error ({len(batch)} records): {e}; writing records one by one")
+                break
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.metrics["batches"] += 1
+            self.metrics["records"] += len(batch)
+            self.metrics["last_flush_ms"] = round(elapsed_ms, 3)
+            self.metrics["total_flush_ms"] += elapsed_ms
+            self.metrics["max_flush_ms"] = round(max(self.metrics["max_flush_ms"], elapsed_ms), 3)
+            return
+        await self._write_each(batch)
+
+    async def _write_each(self, batch: List[tuple]):
+        # Remapped lazily, record by record: a conflict below also moves the later updates of that turn
+        for op in batch:
+            op = self._remap(op)
+            try:
+                await executors.run_db(database.write_turn_batch, [op])
+            except sqlite3.IntegrityError as e:
+                if op[0] != "user_turn" or not await self._reseed_and_write(op):
+                    self._drop(op, e)
+                    continue
+            except Exception as e:
+                self._drop(op, e)
+                continue
+            self.metrics["records"] += 1
+
+    async def _reseed_and_write(self, op: tuple) -> bool:
+        """(session_id, turn_index) already taken (another worker): write the turn at the next free index."""
+        session_id, queued_index = op[1], op[2]
+        try:
+            turn_index = await executors.run_db(database.next_turn_index, session_id)
+            await executors.run_db(database.write_turn_batch, [op[:2] + (turn_index,) + op[3:]])
+        except Exception as e:
+            print(f"ChatWriter reseed failed for {session_id}: {e}")
+            return False
+        self.remapped.setdefault(session_id, {})[queued_index] = turn_index
+        self.turn_counters[session_id] = max(self.turn_counters.get(session_id, 0), turn_index + 1)
+        self.metrics["reseeded"] += 1
+        return True
+
+    def _drop(self, op: tuple, error: Exception):
+        self.metrics["dropped"] += 1
+        print(f"ChatWriter dropped {op[0]} record for {op[1]}: {error}")
+
+    def stats(self) -> dict:
+        m = dict(self.metrics)
+        m["queue_depth"] = self._queue.qsize() if self._queue else 0
+        m["avg_flush_ms"] = round(m.pop("total_flush_ms") / m["batches"], 3) if m["batches"] else 0.0
+        m["avg_batch_size"] = round(m["records"] / m["batches"], 2) if m["batches"] else 0.0
+        m["tracked_sessions"] = len(self.turn_counters)
+        return m
+
+chat_writer = ChatWriter()
@@ -13,11 +13,84 @@ class Settings:
     N_CTX: int = int(os.getenv("N_CTX", "4096"))
     DOCS_PATH: str = os.path.join(BASE_DIR, "data", "docs")
     VECTOR_STORE_PATH: str = os.path.join(BASE_DIR, "data", "vector_store")
+    # Map index.faiss/docstore read-only so uvicorn workers share the pages (0 = read into RAM)
+    VECTOR_STORE_MMAP: bool = os.getenv("VECTOR_STORE_MMAP", "1").lower() not in ["0", "false", "no"]
+    # FAISS index type chosen at build time: flat | hnsw | hnsw_sq8 | ivfpq. ANN types are only
+    # used (and trained) once the store has VECTOR_INDEX_ANN_MIN_CHUNKS chunks; below that, flat
+    VECTOR_INDEX_TYPE: str = os.getenv("VECTOR_INDEX_TYPE", "hnsw").lower()
+    VECTOR_INDEX_ANN_MIN_CHUNKS: int = int(os.getenv("VECTOR_INDEX_ANN_MIN_CHUNKS", "20000"))
+    HNSW_M: int = int(os.getenv("HNSW_M", "32"))
+    HNSW_EF_CONSTRUCTION: int = int(os.getenv("HNSW_EF_CONSTRUCTION", "80"))
+    HNSW_EF_SEARCH: int = int(os.getenv("HNSW_EF_SEARCH", "64"))
+    IVF_NLIST: int = int(os.getenv("IVF_NLIST", "0"))  # 0 = 4 * sqrt(chunks)
+    IVF_NPROBE: int = int(os.getenv("IVF_NPROBE", "16"))
+    PQ_M: int = int(os.getenv("PQ_M", "0"))  # sub-quantizers, 0 = dim / 8 (8 bits each)
     EMBEDDING_MODEL: str = "keepitreal/vietnamese-sbert"
     MAX_TURNS: int = 5
     TOP_K: int = int(os.getenv("TOP_K", "40"))
     TOP_P: float = float(os.getenv("TOP_P", "0.85"))
     TEMPERATURE: float = float(os.getenv("TEMPERATURE", "0.1"))
     WS_DISCONNECT_TTL_SECONDS: int = int(os.getenv("WS_DISCONNECT_TTL_SECONDS", "300"))
+    SESSION_TTL_SECONDS: int = int(os.getenv("SESSION_TTL_SECONDS", os.getenv("WS_DISCONNECT_TTL_SECONDS", "300")))
+    SESSION_MEMORY_BUDGET_MB: int = int(os.getenv("SESSION_MEMORY_BUDGET_MB", "64"))
+    # Multi-process mode (run.py WORKERS > 1): session state lives in the shared SESSION_BACKEND
+    WORKERS: int = int(os.getenv("WORKERS", "1"))
+    SESSION_BACKEND: str = os.getenv("SESSION_BACKEND", "sqlite")
+    SESSION_SHARED: bool = os.getenv("SESSION_SHARED", "1" if int(os.getenv("WORKERS", "1")) > 1 else "0").lower() not in ["0", "false", "no"]
+    SESSION_WHEEL_TICK_SECONDS: float = float(os.getenv("SESSION_WHEEL_TICK_SECONDS", "1"))
+    # Worker pools for blocking work (see app/core/executors.py)
+    CPU_WORKERS: int = int(os.getenv("CPU_WORKERS", str(min(4, os.cpu_count() or 1))))
+    IO_WORKERS: int = int(os.getenv("IO_WORKERS", "16"))
+    DB_WORKERS: int = int(os.getenv("DB_WORKERS", "4"))
+    PROCESS_WORKERS: int = int(os.getenv("PROCESS_WORKERS", "0"))
+    SQLITE_MMAP_SIZE: int = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+    SQLITE_BUSY_TIMEOUT_MS: int = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    SQLITE_STATEMENT_CACHE: int = int(os.getenv("SQLITE_STATEMENT_CACHE", "256"))
+    CHAT_WRITE_FLUSH_MS: int = int(os.getenv("CHAT_WRITE_FLUSH_MS", "20"))
+    CHAT_WRITE_BATCH: int = int(os.getenv("CHAT_WRITE_BATCH", "200"))
+    # Ollama gateway (app/services/llm_engine.py)
+    OLLAMA_HOST: str = os.getenv("OLLAMA_HOST", "http://127.0.0.1:11434")
+    LLM_MAX_IN_FLIGHT: int = int(os.getenv("LLM_MAX_IN_FLIGHT", "2"))
+    LLM_MAX_QUEUE: int = int(os.getenv("LLM_MAX_QUEUE", "32"))
+    LLM_KEEPALIVE_CONNECTIONS: int = int(os.getenv("LLM_KEEPALIVE_CONNECTIONS", "8"))
+    LLM_TIMEOUT_SECONDS: float = float(os.getenv("LLM_TIMEOUT_SECONDS", "300"))
+    LLM_KEEP_ALIVE: str = os.getenv("LLM_KEEP_ALIVE", "30m")
+    # Prompt assembly (app/services/prompt_builder.py)
+    PROMPT_CONTINUE_CONTEXT: bool = os.getenv("PROMPT_CONTINUE_CONTEXT", "0").lower() not in ["0", "false", "no"]
+    PROMPT_CONTINUE_MAX_RATIO: float = float(os.getenv("PROMPT_CONTINUE_MAX_RATIO", "0.75"))
+    TOKENIZER_NAME: str = os.getenv("TOKENIZER_NAME", "Qwen/Qwen2.5-7B-Instruct")
+    PROMPT_TOKEN_CACHE_SIZE: int = int(os.getenv("PROMPT_TOKEN_CACHE_SIZE", "8192"))
+    PROMPT_MAX_NEW_TOKENS: int = int(os.getenv("PROMPT_MAX_NEW_TOKENS", "1024"))
+    PROMPT_SAFETY_TOKENS: int = int(os.getenv("PROMPT_SAFETY_TOKENS", "64"))
+    PROMPT_CONTEXT_SHARE: float = float(os.getenv("PROMPT_CONTEXT_SHARE", "0.6"))
+    PROMPT_HISTORY_AI_CLIP: int = int(os.getenv("PROMPT_HISTORY_AI_CLIP", "160"))
+    PROMPT_CONTEXT_CACHE_SIZE: int = int(os.getenv("PROMPT_CONTEXT_CACHE_SIZE", "256"))
+    PROMPT_LOG: bool = os.getenv("PROMPT_LOG", "0").lower() not in ["0", "false", "no"]  # per-turn token breakdown
+    # LLM stream framing (SentenceBuffer): sentence | chars | latency
+    STREAM_FLUSH_POLICY: str = os.getenv("STREAM_FLUSH_POLICY", "sentence")
+    STREAM_FLUSH_CHARS: int = int(os.getenv("STREAM_FLUSH_CHARS", "240"))
+    STREAM_FLUSH_MS: int = int(os.getenv("STREAM_FLUSH_MS", "120"))
+    # Websocket multiplexing: concurrent answers per connection, outbound frame queue per connection
+    WS_MAX_CONCURRENT: int = int(os.getenv("WS_MAX_CONCURRENT", "4"))
+    WS_SEND_QUEUE: int = int(os.getenv("WS_SEND_QUEUE", "256"))
+    # Canned answers (app/utils/streaming.py): 0 = one frame, >0 = typing effect in STREAM_PACE_CHARS chunks
+    STREAM_PACE_MS: int = int(os.getenv("STREAM_PACE_MS", "0"))
+    STREAM_PACE_CHARS: int = int(os.getenv("STREAM_PACE_CHARS", "80"))
+    # Query embedding service (micro-batching worker + vector cache)
+    EMBED_BATCH_WINDOW_MS: float = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+    EMBED_MAX_BATCH: int = int(os.getenv("EMBED_MAX_BATCH", "32"))
+    EMBED_CACHE_SIZE: int = int(os.getenv("EMBED_CACHE_SIZE", "4096"))
+    EMBED_CACHE_TTL_SECONDS: int = int(os.getenv("EMBED_CACHE_TTL_SECONDS", "86400"))
+    # Startup warm-up (app/services/warmup.py); BLOCKING=1 holds the lifespan until it is done
+    WARMUP_ENABLED: bool = os.getenv("WARMUP_ENABLED", "1").lower() not in ["0", "false", "no"]
+    WARMUP_BLOCKING: bool = os.getenv("WARMUP_BLOCKING", "0").lower() not in ["0", "false", "no"]
+    WARMUP_TIMEOUT_SECONDS: float = float(os.getenv("WARMUP_TIMEOUT_SECONDS", "300"))
+    # Semantic response cache (app/services/response_cache.py)
+    RESPONSE_CACHE_ENABLED: bool = os.getenv("RESPONSE_CACHE_ENABLED", "1").lower() not in ["0", "false", "no"]
+    RESPONSE_CACHE_SIZE: int = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+    RESPONSE_CACHE_TTL_SECONDS: int = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "86400"))
+    RESPONSE_CACHE_SIMILARITY: float = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.93"))
+    INTENT_CACHE_SIZE: int = int(os.getenv("INTENT_CACHE_SIZE", "2048"))
+    INTENT_CACHE_TTL_SECONDS: int = int(os.getenv("INTENT_CACHE_TTL_SECONDS", "3600"))
 
 settings = Settings()
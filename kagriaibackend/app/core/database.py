@@ -1,6 +1,7 @@
 import sqlite3
 import os
 from typing import List, Optional
+from app.core.db_pool import SQLitePool
 
 # Define DB path
 DB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "db")
@@ -20,10 +21,51 @@ def get_chat_db_connection():
     conn.row_factory = sqlite3.Row
     return conn
 
-def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+# Persistent per-thread connections (WAL) used by the request path
+catalog_pool = SQLitePool(DB_PATH)
+chat_pool = SQLitePool(CHAT_DB_PATH)
+
+# Versioned schema migrations. Each database records the last applied step in
+# PRAGMA user_version, so startup only runs steps it has not seen yet.
+# Steps must stay idempotent: databases created before versioning start at 0.
+def _ensure_columns(cursor, table: str, columns: List[str]):
+    existing = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+    for col in columns:
+        if col not in existing:
+            try:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {col} TEXT")
+            except Exception as e:
+                print(f"Skip adding column {table}.{col}: {e}")
+
+def apply_migrations(conn: sqlite3.Connection, migrations: list, label: str) -> int:
+    """
+    Run every (version, name, fn) step newer than PRAGMA user_version, each in its own
+    transaction together with the user_version bump. Returns the resulting version.
+    """
+    conn.commit()
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, name, fn in migrations:
+        if version <= current:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        # Another worker process may have applied it while we waited for the write lock
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+            conn.rollback()
+            current = version
+            continue
+        try:
+            fn(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        current = version
+        print(f"{label}: applied migration {version} ({name})")
+    return current
+
+def _catalog_v1_schema(cursor):
+    """Base catalog tables plus the in-place upgrades older kagri.db files needed."""
     # Create Company Info Table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS company_info (
@@ -66,17 +108,8 @@ def init_db():
     ''')
     
     # Ensure columns exist (for upgrades)
-    def ensure_columns(table: str, columns: List[str]):
-        existing = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
-        for col in columns:
-            if col not in existing:
-                try:
-                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {col} TEXT")
-                except Exception as e:
-                    print(f"Skip adding column {table}.{col}: {e}")
-    
-    ensure_columns("company_info", ["vision", "mission", "core_values", "slogan", "factories", "license_tax"])
-    ensure_columns("experts", ["degree"])
+    _ensure_columns(cursor, "company_info", ["vision", "mission", "core_values", "slogan", "factories", "license_tax"])
+    _ensure_columns(cursor, "experts", ["degree"])
     # Remove chat tables from main DB if exist
     existing_tables = [row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()]
     for t in ["chat_sessions", "chat_turns"]:
@@ -114,7 +147,7 @@ def init_db():
         ''')
         try:
             # We need to explicitly list columns for INSERT INTO ... SELECT ...
-            # But wait, company_info structure might vary with ensure_columns.
+            # But wait, company_info structure might vary with _ensure_columns.
             # Safer way: Create new table with desired schema, copy matching columns.
             
             # Since we just created company_info_new with a fixed schema, let's select matching columns from old table.
@@ -188,109 +221,225 @@ def init_db():
             print("Experts table normalized: removed email/phone")
         except Exception as e:
             print(f"Failed to normalize experts table: {e}")
-    
+
+CATALOG_MIGRATIONS = [
+    (1, "base schema", _catalog_v1_schema),
+]
+
+def init_db():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    apply_migrations(conn, CATALOG_MIGRATIONS, "kagri.db")
+    init_fts(cursor)
+
     conn.commit()
     conn.close()
     print(f"Database initialized at {DB_PATH}")
 
-if __name__ == "__main__":
-    init_db()
-    
+# FTS5 indexes over the catalog. The tokenizer folds diacritics itself, so unaccented queries
+# ("than thu") match accented text and the triggers are plain SQL: kagri.db stays writable from
+# any SQLite client. unicode61 keeps "đ" (no decomposition); fts_terms() adds the đ variant.
+FTS_TOKENIZER = "unicode61 remove_diacritics 2"
+FTS_TABLES = {
+    "products_fts": {
+        "source": "products",
+        "columns": ["code", "name", "ingredients", "usage", "category"],
+    },
+    "experts_fts": {
+        "source": "experts",
+        "columns": ["name", "title", "degree", "bio"],
+    },
+    "company_info_fts": {
+        "source": "company_info",
+        "columns": ["name", "address", "introduction", "vision", "mission", "core_values", "slogan", "factories"],
+    },
+}
+
+def fts_available(cursor) -> bool:
+    try:
+        return bool(cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()[0])
+    except Exception:
+        return False
+
+def _fts_values(spec: dict, prefix: str) -> str:
+    return ", ".join(f"{prefix}.{c}" for c in spec["columns"])
+
+def _drop_stale_fts(cursor, fts: str, src: str):
+    """Tables from the vn_fold() layout (shadow *_folded columns, UDF triggers) are rebuilt."""
+    row = cursor.execute("SELECT sql FROM sqlite_master WHERE name = ?", (fts,)).fetchone()
+    if row is None or FTS_TOKENIZER in row[0]:
+        return
+    for suffix in ("ai", "au", "ad"):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {src}_fts_{suffix}")
+    cursor.execute(f"DROP TABLE {fts}")
+    print(f"Dropped {fts} (old tokenizer/vn_fold layout)")
+
+def init_fts(cursor):
+    """
+    Create FTS5 tables plus insert/update/delete triggers, and backfill when out of sync.
+    """
+    if not fts_available(cursor):
+        print("SQLite FTS5 not available; catalog search falls back to a table scan")
+        return
+    for fts, spec in FTS_TABLES.items():
+        src = spec["source"]
+        _drop_stale_fts(cursor, fts, src)
+        col_list = ", ".join(spec["columns"])
+        cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({col_list}, tokenize='{FTS_TOKENIZER}')")
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {src}_fts_ai AFTER INSERT ON {src} BEGIN
+                INSERT INTO {fts} (rowid, {col_list}) VALUES (new.id, {_fts_values(spec, "new")});
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {src}_fts_au AFTER UPDATE ON {src} BEGIN
+                DELETE FROM {fts} WHERE rowid = old.id;
+                INSERT INTO {fts} (rowid, {col_list}) VALUES (new.id, {_fts_values(spec, "new")});
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {src}_fts_ad AFTER DELETE ON {src} BEGIN
+                DELETE FROM {fts} WHERE rowid = old.id;
+            END
+        ''')
+        src_count = cursor.execute(f"SELECT COUNT(*) FROM {src}").fetchone()[0]
+        fts_count = cursor.execute(f"SELECT COUNT(*) FROM {fts}").fetchone()[0]
+        if src_count != fts_count:
+            cursor.execute(f"DELETE FROM {fts}")
+            cursor.execute(f"INSERT INTO {fts} (rowid, {col_list}) SELECT id, {_fts_values(spec, src)} FROM {src}")
+            print(f"Rebuilt {fts} ({src_count} rows)")
+
 def save_chat_session(session_id: str, turns: list, last_product_code: Optional[str]):
-    conn = get_chat_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO chat_sessions (session_id, last_product_code, created_at, updated_at)
-        VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-        ON CONFLICT(session_id) DO UPDATE SET
-            last_product_code=excluded.last_product_code,
-            updated_at=CURRENT_TIMESTAMP
-    ''', (session_id, last_product_code))
-    cursor.execute('DELETE FROM chat_turns WHERE session_id = ?', (session_id,))
-    for idx, t in enumerate(turns):
-        cursor.execute('''
+    with chat_pool.transaction() as conn:
+        conn.execute('''
+            INSERT INTO chat_sessions (session_id, last_product_code, created_at, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+            ON CONFLICT(session_id) DO UPDATE SET
+                last_product_code=excluded.last_product_code,
+                updated_at=CURRENT_TIMESTAMP
+        ''', (session_id, last_product_code))
+        conn.execute('DELETE FROM chat_turns WHERE session_id = ?', (session_id,))
+        conn.executemany('''
             INSERT INTO chat_turns (session_id, turn_index, user, ai, user_image_path)
             VALUES (?, ?, ?, ?, ?)
-        ''', (session_id, idx, t.get("user", ""), t.get("ai", ""), t.get("user_image_path")))
-    conn.commit()
-    conn.close()
+        ''', [(session_id, idx, t.get("user", ""), t.get("ai", ""), t.get("user_image_path")) for idx, t in enumerate(turns)])
     
-def load_chat_session(session_id: str):
-    conn = get_chat_db_connection()
-    cursor = conn.cursor()
-    session_row = cursor.execute('SELECT session_id, last_product_code FROM chat_sessions WHERE session_id = ?', (session_id,)).fetchone()
+def load_chat_session(session_id: str, limit: Optional[int] = None, before: Optional[int] = None):
+    """before: only turns with turn_index < before (the window as it was when that turn began)."""
+    conn = chat_pool.connection()
+    session_row = conn.execute('SELECT session_id, last_product_code FROM chat_sessions WHERE session_id = ?', (session_id,)).fetchone()
     if not session_row:
-        conn.close()
         return None
-    turn_rows = cursor.execute('SELECT user, ai FROM chat_turns WHERE session_id = ? ORDER BY turn_index ASC', (session_id,)).fetchall()
-    conn.close()
+    upper = before if before is not None else 2 ** 62
+    if limit:
+        # Only the most recent turns (prompt window), still returned oldest first
+        turn_rows = conn.execute('SELECT user, ai FROM chat_turns WHERE session_id = ? AND turn_index < ? ORDER BY turn_index DESC LIMIT ?', (session_id, upper, limit)).fetchall()[::-1]
+    else:
+        turn_rows = conn.execute('SELECT user, ai FROM chat_turns WHERE session_id = ? AND turn_index < ? ORDER BY turn_index ASC', (session_id, upper)).fetchall()
     turns = [{"user": r["user"], "ai": r["ai"]} for r in turn_rows]
     return {"turns": turns, "meta": {"last_product_code": session_row["last_product_code"]}}
 
-def append_chat_turn(session_id: str, user: str, ai: str, user_image_path: Optional[str] = None, last_product_code: Optional[str] = None):
-    conn = get_chat_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
+def _insert_turn(conn, session_id: str, user: str, ai: str, user_image_path: Optional[str], last_product_code: Optional[str]) -> int:
+    conn.execute('''
         INSERT INTO chat_sessions (session_id, last_product_code, created_at, updated_at)
         VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
         ON CONFLICT(session_id) DO UPDATE SET
             last_product_code=COALESCE(excluded.last_product_code, chat_sessions.last_product_code),
             updated_at=CURRENT_TIMESTAMP
     ''', (session_id, last_product_code))
-    next_idx_row = cursor.execute('SELECT COALESCE(MAX(turn_index), -1) + 1 AS next_idx FROM chat_turns WHERE session_id = ?', (session_id,)).fetchone()
-    next_idx = next_idx_row["next_idx"] if next_idx_row else 0
-    cursor.execute('''
+    # Index assigned inside the write transaction, so concurrent worker processes never collide
+    cur = conn.execute('''
         INSERT INTO chat_turns (session_id, turn_index, user, ai, user_image_path)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (session_id, next_idx, user, ai, user_image_path))
-    conn.commit()
-    conn.close()
+        SELECT ?, COALESCE(MAX(turn_index), -1) + 1, ?, ?, ? FROM chat_turns WHERE session_id = ?
+    ''', (session_id, user, ai, user_image_path, session_id))
+    return conn.execute('SELECT turn_index FROM chat_turns WHERE id = ?', (cur.lastrowid,)).fetchone()["turn_index"]
+
+def append_chat_turn(session_id: str, user: str, ai: str, user_image_path: Optional[str] = None, last_product_code: Optional[str] = None):
+    with chat_pool.transaction() as conn:
+        _insert_turn(conn, session_id, user, ai, user_image_path, last_product_code)
 
 def append_user_turn(session_id: str, user: str, user_image_path: Optional[str] = None, last_product_code: Optional[str] = None) -> int:
-    conn = get_chat_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO chat_sessions (session_id, last_product_code, created_at, updated_at)
-        VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-        ON CONFLICT(session_id) DO UPDATE SET
-            last_product_code=COALESCE(excluded.last_product_code, chat_sessions.last_product_code),
-            updated_at=CURRENT_TIMESTAMP
-    ''', (session_id, last_product_code))
-    next_idx_row = cursor.execute('SELECT COALESCE(MAX(turn_index), -1) + 1 AS next_idx FROM chat_turns WHERE session_id = ?', (session_id,)).fetchone()
-    next_idx = next_idx_row["next_idx"] if next_idx_row else 0
-    cursor.execute('''
-        INSERT INTO chat_turns (session_id, turn_index, user, ai, user_image_path)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (session_id, next_idx, user, "", user_image_path))
-    conn.commit()
-    conn.close()
-    return next_idx
+    with chat_pool.transaction() as conn:
+        return _insert_turn(conn, session_id, user, "", user_image_path, last_product_code)
 
 def update_ai_turn(session_id: str, turn_index: int, ai: str):
-    conn = get_chat_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
+    chat_pool.execute('''
         UPDATE chat_turns
         SET ai = ?
         WHERE session_id = ? AND turn_index = ?
     ''', (ai, session_id, turn_index))
-    conn.commit()
-    conn.close()
 
 def update_user_image_path(session_id: str, turn_index: int, user_image_path: str):
-    conn = get_chat_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
+    chat_pool.execute('''
         UPDATE chat_turns
         SET user_image_path = ?
         WHERE session_id = ? AND turn_index = ?
     ''', (user_image_path, session_id, turn_index))
-    conn.commit()
-    conn.close()
 
-def init_chat_db():
-    conn = get_chat_db_connection()
-    cursor = conn.cursor()
+def next_turn_index(session_id: str) -> int:
+    row = chat_pool.fetchone('SELECT COALESCE(MAX(turn_index), -1) + 1 AS next_idx FROM chat_turns WHERE session_id = ?', (session_id,))
+    return row["next_idx"] if row else 0
+
+def write_turn_batch(ops: list):
+    """
+    Apply queued chat writes in one transaction, in order. Each op is a tuple:
+    ("user_turn", session_id, turn_index, user, user_image_path, last_product_code)
+    ("ai", session_id, turn_index, ai)
+    ("image", session_id, turn_index, user_image_path)
+    ("meta", session_id, last_product_code)
+    """
+    with chat_pool.transaction() as conn:
+        for op in ops:
+            kind = op[0]
+            if kind == "user_turn":
+                _, session_id, turn_index, user, user_image_path, last_product_code = op
+                conn.execute('''
+                    INSERT INTO chat_sessions (session_id, last_product_code, created_at, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                    ON CONFLICT(session_id) DO UPDATE SET
+                        last_product_code=COALESCE(excluded.last_product_code, chat_sessions.last_product_code),
+                        updated_at=CURRENT_TIMESTAMP
+                ''', (session_id, last_product_code))
+                conn.execute('''
+                    INSERT INTO chat_turns (session_id, turn_index, user, ai, user_image_path)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (session_id, turn_index, user, "", user_image_path))
+            elif kind == "ai":
+                _, session_id, turn_index, ai = op
+                conn.execute('UPDATE chat_turns SET ai = ? WHERE session_id = ? AND turn_index = ?', (ai, session_id, turn_index))
+            elif kind == "meta":
+                _, session_id, last_product_code = op
+                conn.execute('''
+                    INSERT INTO chat_sessions (session_id, last_product_code, created_at, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                    ON CONFLICT(session_id) DO UPDATE SET
+                        last_product_code=excluded.last_product_code,
+                        updated_at=CURRENT_TIMESTAMP
+                ''', (session_id, last_product_code))
+            elif kind == "image":
+                _, session_id, turn_index, user_image_path = op
+                conn.execute('UPDATE chat_turns SET user_image_path = ? WHERE session_id = ? AND turn_index = ?', (user_image_path, session_id, turn_index))
+
+# Async API for the websocket/REST handlers: same helpers, run on the db executor threads.
+async def asave_chat_session(session_id: str, turns: list, last_product_code: Optional[str]):
+    return await chat_pool.run(save_chat_session, session_id, turns, last_product_code)
+
+async def aload_chat_session(session_id: str, limit: Optional[int] = None, before: Optional[int] = None):
+    return await chat_pool.run(load_chat_session, session_id, limit, before)
+
+async def aappend_chat_turn(session_id: str, user: str, ai: str, user_image_path: Optional[str] = None, last_product_code: Optional[str] = None):
+    return await chat_pool.run(append_chat_turn, session_id, user, ai, user_image_path, last_product_code)
+
+async def aappend_user_turn(session_id: str, user: str, user_image_path: Optional[str] = None, last_product_code: Optional[str] = None) -> int:
+    return await chat_pool.run(append_user_turn, session_id, user, user_image_path, last_product_code)
+
+async def aupdate_ai_turn(session_id: str, turn_index: int, ai: str):
+    return await chat_pool.run(update_ai_turn, session_id, turn_index, ai)
+
+async def aupdate_user_image_path(session_id: str, turn_index: int, user_image_path: str):
+    return await chat_pool.run(update_user_image_path, session_id, turn_index, user_image_path)
+
+def _chat_v1_schema(cursor):
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS chat_sessions (
         session_id TEXT PRIMARY KEY,
@@ -310,13 +459,43 @@ def init_chat_db():
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
     ''')
-    # Ensure column exists
-    existing = [row[1] for row in cursor.execute("PRAGMA table_info(chat_turns)").fetchall()]
-    if "user_image_path" not in existing:
-        try:
-            cursor.execute("ALTER TABLE chat_turns ADD COLUMN user_image_path TEXT")
-        except Exception as e:
-            print(f"Skip adding column chat_turns.user_image_path: {e}")
-    conn.commit()
+    _ensure_columns(cursor, "chat_turns", ["user_image_path"])
+
+def _chat_v2_turn_indexes(cursor):
+    """
+    Every chat query filters on (session_id, turn_index); without an index each one
+    scanned the whole table. Older databases may hold duplicate indexes from racing
+    appends, so those sessions are renumbered in insertion order first.
+    """
+    cursor.execute('''
+        UPDATE chat_turns SET turn_index = (
+            SELECT COUNT(*) FROM chat_turns t2
+            WHERE t2.session_id = chat_turns.session_id AND t2.id < chat_turns.id
+        )
+        WHERE session_id IN (
+            SELECT session_id FROM chat_turns GROUP BY session_id, turn_index HAVING COUNT(*) > 1
+        )
+    ''')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS ux_chat_turns_session_turn ON chat_turns (session_id, turn_index)')
+
+def _chat_v3_drop_history_index(cursor):
+    """
+    ix_chat_turns_history (session_id, turn_index, user, ai) copied the text of every turn:
+    ~2x chat.db size and write cost for a read ux_chat_turns_session_turn already serves.
+    """
+    cursor.execute('DROP INDEX IF EXISTS ix_chat_turns_history')
+
+CHAT_MIGRATIONS = [
+    (1, "chat tables", _chat_v1_schema),
+    (2, "chat_turns indexes", _chat_v2_turn_indexes),
+    (3, "drop covering history index", _chat_v3_drop_history_index),
+]
+
+def init_chat_db():
+    conn = get_chat_db_connection()
+    apply_migrations(conn, CHAT_MIGRATIONS, "chat.db")
     conn.close()
     print(f"Chat database initialized at {CHAT_DB_PATH}")
+
+if __name__ == "__main__":
+    init_db()
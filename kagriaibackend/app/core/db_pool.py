@@ -0,0 +1,86 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+from app.core.config import settings
+from app.core.executors import executors
+
+class SQLitePool:
+    """
+    One persistent connection per thread (the db executor threads, the event loop thread,
+    scripts), opened in WAL mode with synchronous=NORMAL and mmap. Connections are never
+    closed per call, so sqlite3's per-connection prepared statement cache is reused.
+    """
+    def __init__(self, path: str, on_connect: Optional[Callable[[sqlite3.Connection], None]] = None):
+        self.path = path
+        self.on_connect = on_connect
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all: List[sqlite3.Connection] = []
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=settings.SQLITE_BUSY_TIMEOUT_MS / 1000.0,
+            isolation_level=None,  # autocommit; explicit BEGIN IMMEDIATE in transaction()
+            check_same_thread=False,  # only used by its own thread, but close_all() runs elsewhere
+            cached_statements=settings.SQLITE_STATEMENT_CACHE,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+        conn.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if self.on_connect:
+            self.on_connect(conn)
+        with self._lock:
+            self._all.append(conn)
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        Write transaction on this thread's connection. BEGIN IMMEDIATE takes the write lock
+        up front so concurrent writers wait on busy_timeout instead of failing on upgrade.
+        """
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def execute(self, sql: str, params=()):
+        return self.connection().execute(sql, params)
+
+    def fetchone(self, sql: str, params=()):
+        return self.connection().execute(sql, params).fetchone()
+
+    def fetchall(self, sql: str, params=()):
+        return self.connection().execute(sql, params).fetchall()
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        """
+        Async API: run a sync repository function on the db executor threads.
+        """
+        return await executors.run_db(fn, *args, **kwargs)
+
+    def close_all(self):
+        with self._lock:
+            conns, self._all = self._all, []
+        for conn in conns:
+            try:
+                conn.close()
+            except Exception as e:
+                print(f"SQLite close error ({self.path}): {e}")
+        self._local = threading.local()
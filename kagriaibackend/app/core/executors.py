@@ -0,0 +1,96 @@
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Any, Callable, Dict
+from app.core.config import settings
+
+
+def _init_process_worker():
+    # Load the YOLO models once per worker process instead of once per call
+    from app.services.diagnosis import diagnosis_service
+    diagnosis_service.ensure_models()
+
+
+def _diagnose_in_process(image_base64: str, plant_type: str) -> Dict[str, Any]:
+    from app.services.diagnosis import diagnosis_service
+    return diagnosis_service.predict(image_base64, plant_type)
+
+
+def _warmup_in_process() -> int:
+    from app.services.diagnosis import diagnosis_service
+    return diagnosis_service.warmup()
+
+
+class ExecutionLayer:
+    """
+    Sized worker pools per workload class, so blocking work never runs on the event loop.
+    - cpu: model inference (SentenceTransformer/FAISS/YOLO release the GIL in native code)
+    - io: outbound HTTP (Ollama sync client, market price scraping, file writes)
+    - db: sqlite helpers
+    - process: optional process pool for YOLO diagnosis (PROCESS_WORKERS > 0)
+    """
+    def __init__(self):
+        self.sizes = {
+            "cpu": settings.CPU_WORKERS,
+            "io": settings.IO_WORKERS,
+            "db": settings.DB_WORKERS,
+            "process": settings.PROCESS_WORKERS,
+        }
+        self._pools: Dict[str, Executor] = {}
+
+    def _get_pool(self, kind: str) -> Executor:
+        pool = self._pools.get(kind)
+        if pool is None:
+            if kind == "process":
+                pool = ProcessPoolExecutor(
+                    max_workers=self.sizes["process"],
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_process_worker,
+                )
+            else:
+                pool = ThreadPoolExecutor(max_workers=self.sizes[kind], thread_name_prefix=f"kagri-{kind}")
+            self._pools[kind] = pool
+        return pool
+
+    async def run(self, kind: str, fn: Callable, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_pool(kind), functools.partial(fn, *args, **kwargs))
+
+    async def run_cpu(self, fn: Callable, *args, **kwargs):
+        return await self.run("cpu", fn, *args, **kwargs)
+
+    async def run_io(self, fn: Callable, *args, **kwargs):
+        return await self.run("io", fn, *args, **kwargs)
+
+    async def run_db(self, fn: Callable, *args, **kwargs):
+        return await self.run("db", fn, *args, **kwargs)
+
+    async def diagnose(self, image_base64: str, plant_type: str) -> Dict[str, Any]:
+        """
+        Run YOLO diagnosis in the process pool if enabled, otherwise in the cpu thread pool.
+        """
+        if self.sizes["process"] > 0:
+            return await self.run("process", _diagnose_in_process, image_base64, plant_type)
+        from app.services.diagnosis import diagnosis_service
+        return await self.run_cpu(diagnosis_service.predict, image_base64, plant_type)
+
+    async def warmup_diagnosis(self) -> int:
+        """
+        Dummy YOLO inference where diagnose() will run: one per process worker (spawns them), else once in the cpu pool.
+        """
+        if self.sizes["process"] > 0:
+            counts = await asyncio.gather(*(self.run("process", _warmup_in_process) for _ in range(self.sizes["process"])))
+            return max(counts)
+        from app.services.diagnosis import diagnosis_service
+        return await self.run_cpu(diagnosis_service.warmup)
+
+    def shutdown(self, wait: bool = True):
+        for kind, pool in list(self._pools.items()):
+            try:
+                pool.shutdown(wait=wait, cancel_futures=True)
+            except Exception as e:
+                print(f"Executor {kind} shutdown error: {e}")
+        self._pools = {}
+
+executors = ExecutionLayer()
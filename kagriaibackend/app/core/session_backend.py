@@ -0,0 +1,118 @@
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+from app.core.config import settings
+from app.core.chat_writer import chat_writer
+
+class SessionBackend(ABC):
+    """
+    Shared store for conversation state (turns + last_product_code) behind ConversationManager.
+    Every worker process talks to the same backend, so any worker can pick up a session.
+    append_user_turn() returns the index the backend assigned; when it is not the head a
+    resident conversation expected, another worker wrote turns in between and the window is
+    reloaded (load(before=turn_index)).
+    """
+    name = "base"
+
+    @abstractmethod
+    async def load(self, session_id: str, limit: Optional[int] = None, before: Optional[int] = None) -> Optional[dict]:
+        """{"turns": [{"user", "ai"}...] (oldest first, turn_index < before), "meta": {...}, "head": next_index} or None"""
+        ...
+
+    @abstractmethod
+    async def append_user_turn(self, session_id: str, user: str, user_image_path: Optional[str], last_product_code: Optional[str]) -> int:
+        ...
+
+    @abstractmethod
+    async def update_ai_turn(self, session_id: str, turn_index: int, ai: str):
+        ...
+
+    @abstractmethod
+    async def update_user_image_path(self, session_id: str, turn_index: int, user_image_path: str):
+        ...
+
+    @abstractmethod
+    async def set_last_product_code(self, session_id: str, last_product_code: Optional[str]):
+        ...
+
+    def forget(self, session_id: str):
+        """Drop per-process bookkeeping for a session that left the local cache."""
+
+class SQLiteSessionBackend(SessionBackend):
+    """
+    Default backend: chat.db (WAL, shared by all worker processes) through the write-behind
+    chat_writer.
+    """
+    name = "sqlite"
+
+    async def load(self, session_id: str, limit: Optional[int] = None, before: Optional[int] = None) -> Optional[dict]:
+        loaded = await chat_writer.load_chat_session(session_id, limit=limit, before=before)
+        if loaded is None:
+            return None
+        # Reseed the turn counter from the database, other workers may have appended
+        loaded["head"] = await chat_writer.next_turn_index(session_id)
+        if not chat_writer.shared:
+            chat_writer.seed(session_id, loaded["head"])
+        return loaded
+
+    async def append_user_turn(self, session_id, user, user_image_path, last_product_code) -> int:
+        return await chat_writer.append_user_turn(session_id, user, user_image_path, last_product_code)
+
+    async def update_ai_turn(self, session_id, turn_index, ai):
+        await chat_writer.update_ai_turn(session_id, turn_index, ai)
+
+    async def update_user_image_path(self, session_id, turn_index, user_image_path):
+        await chat_writer.update_user_image_path(session_id, turn_index, user_image_path)
+
+    async def set_last_product_code(self, session_id, last_product_code):
+        await chat_writer.update_last_product_code(session_id, last_product_code)
+
+    def forget(self, session_id: str):
+        chat_writer.forget(session_id)
+
+class InMemorySessionBackend(SessionBackend):
+    """
+    In-process fake for tests and scripts: several ConversationManager instances sharing one
+    of these behave like worker processes sharing chat.db.
+    """
+    name = "memory"
+
+    def __init__(self):
+        self.sessions: Dict[str, dict] = {}
+
+    def _session(self, session_id: str) -> dict:
+        return self.sessions.setdefault(session_id, {"turns": [], "meta": {"last_product_code": None}})
+
+    async def load(self, session_id, limit=None, before=None):
+        s = self.sessions.get(session_id)
+        if s is None:
+            return None
+        turns: List[dict] = s["turns"][:before] if before is not None else s["turns"]
+        turns = turns[-limit:] if limit else turns
+        return {"turns": [{"user": t["user"], "ai": t["ai"]} for t in turns], "meta": dict(s["meta"]), "head": len(s["turns"])}
+
+    async def append_user_turn(self, session_id, user, user_image_path, last_product_code):
+        s = self._session(session_id)
+        if last_product_code is not None:
+            s["meta"]["last_product_code"] = last_product_code
+        s["turns"].append({"user": user, "ai": "", "user_image_path": user_image_path})
+        return len(s["turns"]) - 1
+
+    async def update_ai_turn(self, session_id, turn_index, ai):
+        self._session(session_id)["turns"][turn_index]["ai"] = ai
+
+    async def update_user_image_path(self, session_id, turn_index, user_image_path):
+        self._session(session_id)["turns"][turn_index]["user_image_path"] = user_image_path
+
+    async def set_last_product_code(self, session_id, last_product_code):
+        self._session(session_id)["meta"]["last_product_code"] = last_product_code
+
+SESSION_BACKENDS = {
+    "sqlite": SQLiteSessionBackend,
+    "memory": InMemorySessionBackend,
+}
+
+def create_session_backend(name: str = None) -> SessionBackend:
+    name = (name or settings.SESSION_BACKEND).lower()
+    if name not in SESSION_BACKENDS:
+        raise ValueError(f"Unknown SESSION_BACKEND '{name}' (choose from {', '.join(SESSION_BACKENDS)})")
+    return SESSION_BACKENDS[name]()
@@ -2,13 +2,23 @@ import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 import os
 from app.api import chatws
+from app.api.chatws import save_upload, manager as ws_manager
 from app.api import weatherpost
 from app.core.config import settings
-from app.core.database import init_db, init_chat_db, append_user_turn, update_ai_turn, update_user_image_path
+from app.core.database import init_db, init_chat_db, catalog_pool, chat_pool
+from app.core.chat_writer import chat_writer
+from app.core.executors import executors
 from app.services.conversation import conversation_manager
+from app.services.llm_engine import llm_engine, llm_gateway
+from app.services.prompt_builder import prompt_builder
+from app.services.response_cache import response_cache
+from app.services.fast_paths import fast_paths
+from app.services.embedding_service import embedding_service
+from app.services.product_index import product_index
+from app.services.warmup import warmup
 from app.services.diagnosis import diagnosis_service
 from app.services.time_service import time_service
 from pydantic import BaseModel
@@ -31,17 +41,37 @@ class ConvertRequest(BaseModel):
 async def lifespan(app: FastAPI):
     init_db()
     init_chat_db()
+    chat_writer.start()
+    await executors.run_db(product_index.build)
+    # kagri.db changes seen by the response cache (data_version) also refresh the code map
+    response_cache.add_hook(product_index.invalidate)
+    # Warm models in the background (readiness: /api/kagriai/ready), or before serving if WARMUP_BLOCKING
+    warmup_task = None
+    if not settings.WARMUP_ENABLED:
+        warmup.skip()
+    elif settings.WARMUP_BLOCKING:
+        await warmup.run()
+    else:
+        warmup_task = asyncio.create_task(warmup.run())
     # Startup: Create background task for cleanup
     task = asyncio.create_task(cleanup_loop())
     yield
     # Shutdown
     task.cancel()
+    if warmup_task is not None:
+        warmup_task.cancel()
+    # Commit queued chat turns before the db threads go away
+    await chat_writer.stop()
+    embedding_service.stop()
+    executors.shutdown(wait=False)
+    chat_pool.close_all()
+    catalog_pool.close_all()
 
 async def cleanup_loop():
     while True:
         try:
             conversation_manager.cleanup()
-            await asyncio.sleep(60) # Check every minute
+            await asyncio.sleep(settings.SESSION_WHEEL_TICK_SECONDS)
         except asyncio.CancelledError:
             break
 
@@ -67,86 +97,53 @@ IMAGES_DIR = os.path.join(BASE_DIR, "data", "images")
 if os.path.exists(IMAGES_DIR):
     app.mount("/images", StaticFiles(directory=IMAGES_DIR), name="images")
 
-@app.post("/api/diagnose/durian")
-async def diagnose_durian(request: DiagnosisRequest):
+async def run_diagnosis(request: DiagnosisRequest, plant_type: str):
     session_id = request.session_id
     turn_idx = None
     img_path_abs = None
+    conv = None
     if session_id:
         base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         uploads_dir = os.path.join(base_dir, "app", "data", "uploads")
         os.makedirs(uploads_dir, exist_ok=True)
         filename = f"{session_id}-{uuid.uuid4().hex}.png"
         img_path_abs = os.path.join(uploads_dir, filename)
-        img_b64 = request.image
-        if "," in img_b64:
-            img_b64 = img_b64.split(",", 1)[1]
-        with open(img_path_abs, "wb") as f:
-            f.write(base64.b64decode(img_b64))
-        turn_idx = append_user_turn(session_id, "[image] " + (request.text or ""), None, None)
-        update_user_image_path(session_id, turn_idx, img_path_abs)
-    result = diagnosis_service.predict(request.image, "durian")
-    if session_id and turn_idx is not None:
-        preds = result.get("predictions", [])
-        if result.get("error"):
-            text_reply = "Dạ, ảnh chưa hợp lệ hoặc mô hình chưa sẵn sàng ạ."
-        elif not preds:
-            text_reply = "Dạ, em chưa phát hiện được bệnh rõ ràng từ ảnh này. Anh/chị vui lòng thử ảnh khác rõ nét hơn ạ."
-        else:
-            top = preds[0]
-            lines = []
-            lines.append(f"Dạ, ảnh cho thấy khả năng cao: {top['name']} ({top['probability']}%).")
-            if len(preds) > 1:
-                lines.append("Các khả năng tiếp theo:")
-                for p in preds[1:]:
-                    lines.append(f"- {p['name']} ({p['probability']}%)")
-            lines.append("Em gửi kèm ảnh mẫu bệnh để anh/chị đối chiếu ạ.")
-            text_reply = "\n".join(lines)
-        update_ai_turn(session_id, turn_idx, text_reply)
+        await executors.run_io(save_upload, img_path_abs, request.image)
+        conv = await conversation_manager.get(session_id)
+        turn_idx = await conversation_manager.begin_turn(conv, "[image] " + (request.text or ""))
+        await conversation_manager.attach_image(conv, turn_idx, img_path_abs)
+    result = await executors.diagnose(request.image, plant_type)
+    if conv is not None and turn_idx is not None:
+        text_reply = diagnosis_service.reply_text(result)
+        await conversation_manager.finish_turn(conv, turn_idx, "[image] " + (request.text or ""), text_reply)
     return result
 
+@app.post("/api/diagnose/durian")
+async def diagnose_durian(request: DiagnosisRequest):
+    return await run_diagnosis(request, "durian")
+
 @app.post("/api/diagnose/coffee")
 async def diagnose_coffee(request: DiagnosisRequest):
-    session_id = request.session_id
-    turn_idx = None
-    img_path_abs = None
-    if session_id:
-        base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        uploads_dir = os.path.join(base_dir, "app", "data", "uploads")
-        os.makedirs(uploads_dir, exist_ok=True)
-        filename = f"{session_id}-{uuid.uuid4().hex}.png"
-        img_path_abs = os.path.join(uploads_dir, filename)
-        img_b64 = request.image
-        if "," in img_b64:
-            img_b64 = img_b64.split(",", 1)[1]
-        with open(img_path_abs, "wb") as f:
-            f.write(base64.b64decode(img_b64))
-        turn_idx = append_user_turn(session_id, "[image] " + (request.text or ""), None, None)
-        update_user_image_path(session_id, turn_idx, img_path_abs)
-    result = diagnosis_service.predict(request.image, "coffee")
-    if session_id and turn_idx is not None:
-        preds = result.get("predictions", [])
-        if result.get("error"):
-            text_reply = "Dạ, ảnh chưa hợp lệ hoặc mô hình chưa sẵn sàng ạ."
-        elif not preds:
-            text_reply = "Dạ, em chưa phát hiện được bệnh rõ ràng từ ảnh này. Anh/chị vui lòng thử ảnh khác rõ nét hơn ạ."
-        else:
-            top = preds[0]
-            lines = []
-            lines.append(f"Dạ, ảnh cho thấy khả năng cao: {top['name']} ({top['probability']}%).")
-            if len(preds) > 1:
-                lines.append("Các khả năng tiếp theo:")
-                for p in preds[1:]:
-                    lines.append(f"- {p['name']} ({p['probability']}%)")
-            lines.append("Em gửi kèm ảnh mẫu bệnh để anh/chị đối chiếu ạ.")
-            text_reply = "\n".join(lines)
-        update_ai_turn(session_id, turn_idx, text_reply)
-    return result
+    return await run_diagnosis(request, "coffee")
 
 @app.get("/")
 def health_check():
     return {"status": "ok", "service": "Kagri AI Server"}
 
+@app.get("/api/kagriai/ready")
+def readiness():
+    # 503 until the startup warm-up has finished, so the load balancer keeps traffic away from cold models
+    return JSONResponse(warmup.stats(), status_code=200 if warmup.ready else 503)
+
+@app.get("/api/kagriai/stats")
+def runtime_stats():
+    return {"intent": llm_engine.get_intent_stats(), "llm": llm_gateway.stats(), "prompt": prompt_builder.stats(), "chat_writer": chat_writer.stats(), "sessions": conversation_manager.stats(), "response_cache": response_cache.stats(), "websocket": ws_manager.stats(), "fast_paths": fast_paths.stats(), "embeddings": embedding_service.stats(), "warmup": warmup.stats()}
+
+@app.post("/api/kagriai/response-cache/invalidate")
+def invalidate_response_cache():
+    response_cache.invalidate("api")
+    return {"status": "ok"}
+
 @app.post("/api/convert/lunar-to-solar")
 async def convert_lunar_to_solar(req: ConvertRequest):
     text = time_service.convert_lunar_solar(req.date, is_lunar=True)
@@ -1,50 +1,273 @@
-from typing import Dict, List, Any
-from dataclasses import dataclass, field
+import sys
+import time
+import asyncio
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional
 from app.core.config import settings
+from app.core.session_backend import SessionBackend, create_session_backend
+
+# Short, repeated strings (fixed replies, "[image] " prefixes) are interned so many
+# sessions share one copy; full AI answers are stored as-is.
+INTERN_MAX_LEN = 64
+# Rough per-turn / per-session overhead on top of the string payloads
+TURN_OVERHEAD = 72
+SESSION_OVERHEAD = 512
+
+def _compact(text: Optional[str]) -> str:
+    text = text or ""
+    return sys.intern(text) if len(text) <= INTERN_MAX_LEN else text
 
-@dataclass
 class Turn:
-    user: str
-    ai: str
+    __slots__ = ("user", "ai")
+
+    def __init__(self, user: str, ai: str):
+        self.user = _compact(user)
+        self.ai = _compact(ai)
+
+    @property
+    def nbytes(self) -> int:
+        return TURN_OVERHEAD + sys.getsizeof(self.user) + sys.getsizeof(self.ai)
+
+    def to_dict(self) -> dict:
+        return {"user": self.user, "ai": self.ai}
 
-@dataclass
 class Conversation:
-    session_id: str
-    turns: List[Turn] = field(default_factory=list)
-    meta: Dict[str, Any] = field(default_factory=lambda: {"last_product_code": None})
+    """
+    Resident state of one chat session: the sliding window of the last MAX_TURNS turns
+    used for prompt building, plus meta. The full transcript lives only in chat.db.
+    """
+    __slots__ = ("session_id", "turns", "meta", "nbytes", "last_access", "pins", "head")
+
+    def __init__(self, session_id: str, max_turns: int):
+        self.session_id = session_id
+        self.turns: Deque[Turn] = deque(maxlen=max_turns)
+        self.meta: Dict[str, Any] = {"last_product_code": None}
+        self.nbytes = SESSION_OVERHEAD
+        self.last_access = time.monotonic()
+        self.pins = 0
+        self.head = 0  # next turn index as last seen in the backend
+
+    def history(self) -> List[dict]:
+        return [t.to_dict() for t in self.turns]
+
+class TimerWheel:
+    """
+    Hashed timer wheel: one slot per tick, ids are placed in the slot of their deadline.
+    Deadlines further than one revolution away are parked in the last slot and re-checked.
+    """
+    def __init__(self, slots: int, tick: float):
+        self.tick = tick
+        self.slots: List[set] = [set() for _ in range(slots)]
+        self.cursor = 0
+
+    def schedule(self, key: str, delay: float):
+        ticks = min(len(self.slots) - 1, max(1, int(delay / self.tick) + 1))
+        self.slots[(self.cursor + ticks) % len(self.slots)].add(key)
+
+    def advance(self) -> set:
+        self.cursor = (self.cursor + 1) % len(self.slots)
+        due, self.slots[self.cursor] = self.slots[self.cursor], set()
+        return due
 
 class ConversationManager:
-    def __init__(self, max_turns: int = 5):
-        self.conversations: Dict[str, Conversation] = {}
+    """
+    Single conversation store for the websocket handler and the diagnosis REST endpoints.
+    - Sliding window per session (deque(maxlen=MAX_TURNS)); every turn is persisted through
+      the session backend (chat.db by default) and evicted sessions are reloaded lazily.
+    - Shared mode (WORKERS > 1 or SESSION_SHARED): the backend assigns turn indexes; when the
+      index of a new turn is past the resident head, another worker wrote turns in between and
+      the window is reloaded in place (tasks holding the Conversation keep a valid object).
+    - Global memory budget (SESSION_MEMORY_BUDGET_MB): least recently used unpinned sessions are evicted.
+    - Idle expiry (SESSION_TTL_SECONDS) for sessions without an open connection, driven by a
+      timer wheel that cleanup() advances; main.cleanup_loop calls it periodically.
+    """
+    def __init__(self, max_turns: int = 5, budget_bytes: int = None, ttl: float = None, tick: float = None,
+                 backend: Optional[SessionBackend] = None, shared: Optional[bool] = None):
         self.max_turns = max_turns
+        self.backend = backend or create_session_backend()
+        self.shared = settings.SESSION_SHARED if shared is None else shared
+        self.budget_bytes = budget_bytes or settings.SESSION_MEMORY_BUDGET_MB * 1024 * 1024
+        self.ttl = ttl if ttl is not None else settings.SESSION_TTL_SECONDS
+        self.tick = tick or settings.SESSION_WHEEL_TICK_SECONDS
+        self.conversations: "OrderedDict[str, Conversation]" = OrderedDict()
+        self.total_bytes = 0
+        self.wheel = TimerWheel(slots=max(2, int(self.ttl / self.tick) + 2), tick=self.tick)
+        self._last_tick = time.monotonic()
+        self._loading: Dict[str, asyncio.Future] = {}
+        self.counters = {"hits": 0, "loads": 0, "stale_reloads": 0, "ttl_evictions": 0, "budget_evictions": 0}
+
+    # --- Expiry / eviction ---
+    def cleanup(self):
+        """
+        Advance the wheel by the ticks elapsed since the last call and evict due sessions
+        that are idle and unpinned.
+        """
+        now = time.monotonic()
+        ticks = int((now - self._last_tick) / self.tick)
+        if ticks <= 0:
+            return
+        self._last_tick += ticks * self.tick
+        for _ in range(min(ticks, len(self.wheel.slots))):
+            for sid in self.wheel.advance():
+                conv = self.conversations.get(sid)
+                if conv is None:
+                    continue
+                remaining = conv.last_access + self.ttl - now
+                if conv.pins > 0:
+                    self.wheel.schedule(sid, self.ttl)
+                elif remaining > 0:
+                    self.wheel.schedule(sid, remaining)
+                else:
+                    self._evict(sid)
+                    self.counters["ttl_evictions"] += 1
+
+    def _touch(self, conv: Conversation):
+        conv.last_access = time.monotonic()
+        self.conversations.move_to_end(conv.session_id)
+
+    def _evict(self, session_id: str):
+        conv = self.conversations.pop(session_id, None)
+        if conv is not None:
+            self.total_bytes -= conv.nbytes
+            self.backend.forget(session_id)
 
-    def get_conversation(self, session_id: str) -> Conversation:
-        if session_id not in self.conversations:
-            self.conversations[session_id] = Conversation(session_id=session_id)
-        return self.conversations[session_id]
+    def _enforce_budget(self):
+        if self.total_bytes <= self.budget_bytes:
+            return
+        for sid in list(self.conversations.keys()):
+            if self.total_bytes <= self.budget_bytes:
+                break
+            if self.conversations[sid].pins > 0:
+                continue
+            self._evict(sid)
+            self.counters["budget_evictions"] += 1
 
-    def add_turn(self, session_id: str, user_msg: str, ai_msg: str):
-        conv = self.get_conversation(session_id)
-        conv.turns.append(Turn(user=user_msg, ai=ai_msg))
-        # Enforce max turns limit
-        if len(conv.turns) > self.max_turns:
-            conv.turns.pop(0)
+    def _admit(self, conv: Conversation):
+        self.conversations[conv.session_id] = conv
+        self.total_bytes += conv.nbytes
+        self.wheel.schedule(conv.session_id, self.ttl)
+        self._enforce_budget()
+
+    # --- Access ---
+    async def get(self, session_id: str) -> Conversation:
+        """
+        Resident conversation for session_id, loading the recent window from chat.db on a miss.
+        Concurrent misses for the same id share one load.
+        """
+        conv = self.conversations.get(session_id)
+        if conv is not None:
+            self.counters["hits"] += 1
+            self._touch(conv)
+            return conv
+        pending = self._loading.get(session_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        fut = asyncio.get_running_loop().create_future()
+        self._loading[session_id] = fut
+        try:
+            loaded = await self.backend.load(session_id, limit=self.max_turns)
+            conv = Conversation(session_id, self.max_turns)
+            if loaded:
+                for t in loaded.get("turns", []):
+                    self._append(conv, t.get("user"), t.get("ai"))
+                conv.meta.update(loaded.get("meta") or {})
+                conv.head = loaded.get("head", 0)
+            self.counters["loads"] += 1
+            self._admit(conv)
+            fut.set_result(conv)
+            return conv
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # mark retrieved when nobody else is waiting
+            raise
+        finally:
+            self._loading.pop(session_id, None)
+
+    def pin(self, conv: Conversation):
+        # Pinned conversations (open websocket) are never evicted
+        conv.pins += 1
+
+    def release(self, session_id: str):
+        conv = self.conversations.get(session_id)
+        if conv is not None and conv.pins > 0:
+            conv.pins -= 1
+            conv.last_access = time.monotonic()
+
+    # --- Turns ---
+    def _append(self, conv: Conversation, user: str, ai: str) -> int:
+        delta = -conv.turns[0].nbytes if len(conv.turns) == conv.turns.maxlen else 0
+        turn = Turn(user, ai)
+        conv.turns.append(turn)
+        delta += turn.nbytes
+        conv.nbytes += delta
+        return delta
+
+    def add_turn(self, conv: Conversation, user_msg: str, ai_msg: str):
+        """Add a turn to the prompt window only (persistence goes through begin/finish_turn)."""
+        delta = self._append(conv, user_msg, ai_msg)
+        if conv.session_id in self.conversations:
+            self.total_bytes += delta
+            self._touch(conv)
+            self._enforce_budget()
+
+    async def begin_turn(self, conv: Conversation, user_msg: str, user_image_path: Optional[str] = None) -> int:
+        """Persist the user message right away; returns the turn index for finish_turn."""
+        turn_index = await self.backend.append_user_turn(conv.session_id, user_msg, user_image_path, conv.meta.get("last_product_code"))
+        if self.shared and turn_index > conv.head:
+            # Another worker served this session meanwhile: refresh the window before the prompt is built
+            self.counters["stale_reloads"] += 1
+            await self._reload(conv, before=turn_index)
+        conv.head = max(conv.head, turn_index + 1)
+        return turn_index
+
+    async def _reload(self, conv: Conversation, before: int):
+        loaded = await self.backend.load(conv.session_id, limit=self.max_turns, before=before)
+        if not loaded:
+            return
+        old_bytes = conv.nbytes
+        conv.turns.clear()
+        conv.nbytes = SESSION_OVERHEAD
+        for t in loaded.get("turns", []):
+            self._append(conv, t.get("user"), t.get("ai"))
+        conv.meta.update(loaded.get("meta") or {})
+        if conv.session_id in self.conversations:
+            self.total_bytes += conv.nbytes - old_bytes
+
+    async def finish_turn(self, conv: Conversation, turn_index: int, user_msg: str, ai_msg: str):
+        self.add_turn(conv, user_msg, ai_msg)
+        await self.backend.update_ai_turn(conv.session_id, turn_index, ai_msg)
+
+    async def attach_image(self, conv: Conversation, turn_index: int, user_image_path: str):
+        await self.backend.update_user_image_path(conv.session_id, turn_index, user_image_path)
 
     def get_history(self, session_id: str) -> List[dict]:
-        conv = self.get_conversation(session_id)
-        return [{"user": t.user, "ai": t.ai} for t in conv.turns]
-    
-    def update_meta(self, session_id: str, key: str, value: Any):
-        conv = self.get_conversation(session_id)
+        conv = self.conversations.get(session_id)
+        return conv.history() if conv else []
+
+    async def update_meta(self, conv: Conversation, key: str, value: Any):
         conv.meta[key] = value
+        if key == "last_product_code":
+            # Shared so a reconnect served by another worker keeps the product context
+            await self.backend.set_last_product_code(conv.session_id, value)
 
     def get_meta(self, session_id: str, key: str) -> Any:
-        conv = self.get_conversation(session_id)
-        return conv.meta.get(key)
-    
+        conv = self.conversations.get(session_id)
+        return conv.meta.get(key) if conv else None
+
     def clear_session(self, session_id: str):
-        if session_id in self.conversations:
-            del self.conversations[session_id]
+        self._evict(session_id)
+
+    def stats(self) -> dict:
+        return {
+            "resident_sessions": len(self.conversations),
+            "pinned_sessions": sum(1 for c in self.conversations.values() if c.pins > 0),
+            "resident_bytes": self.total_bytes,
+            "budget_bytes": self.budget_bytes,
+            "ttl_seconds": self.ttl,
+            "backend": self.backend.name,
+            "shared": self.shared,
+            **self.counters,
+        }
 
 # Singleton instance with default setting
 conversation_manager = ConversationManager(max_turns=settings.MAX_TURNS)
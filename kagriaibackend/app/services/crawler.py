@@ -1,22 +1,32 @@
-import requests
-from bs4 import BeautifulSoup
 import os
 import hashlib
 from app.core.config import settings
 from urllib.parse import urljoin, urlparse
 from app.core.database import get_db_connection, init_db
+from app.services.product_index import product_index
+from typing import TYPE_CHECKING
 import time
 import re
 
+# requests/bs4 are imported by the crawl entry points, so importing this module stays cheap
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup
+
 class KagriCrawler:
     def __init__(self, base_url="https://kagri.vn/"):
         self.base_url = base_url
         self.visited = set()
         self.docs_path = settings.DOCS_PATH
-        init_db()
+        self._db_ready = False
         self.headers = {"User-Agent": "KagriCrawler/1.0"}
         self.product_urls = set()
 
+    def ensure_db(self):
+        # Schema is created on the first crawl/write, not when the module is imported
+        if not self._db_ready:
+            init_db()
+            self._db_ready = True
+
     def clean_text(self, text):
         lines = (line.strip() for line in text.splitlines())
         chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
@@ -34,21 +44,21 @@ class KagriCrawler:
             f.write(f"Source: {url}\n\n")
             f.write(content)
     
-    def select_main(self, soup: BeautifulSoup):
+    def select_main(self, soup: "BeautifulSoup"):
         for sel in ["#main", ".site-content", ".entry-content", "main"]:
             node = soup.select_one(sel)
             if node:
                 return node
         return soup
     
-    def is_product_page(self, soup: BeautifulSoup, url: str) -> bool:
+    def is_product_page(self, soup: "BeautifulSoup", url: str) -> bool:
         if "/san-pham/" in url:
             return True
         text = self.select_main(soup).get_text(" ").lower()
         signals = ["thành phần", "hướng dẫn sử dụng", "liều lượng", "bảo quản", "lưu ý", "mã sản phẩm", "sku"]
         return any(sig in text for sig in signals)
     
-    def get_section(self, root: BeautifulSoup, keywords):
+    def get_section(self, root: "BeautifulSoup", keywords):
         txt = ""
         # Kagri specific IDs
         id_map = {
@@ -115,7 +125,7 @@ class KagriCrawler:
                     break
         return txt
     
-    def get_category(self, root: BeautifulSoup):
+    def get_category(self, root: "BeautifulSoup"):
         # Prefer breadcrumbs with product-category
         for a in root.select(".woocommerce-breadcrumb a"):
             href = a.get("href", "")
@@ -145,7 +155,7 @@ class KagriCrawler:
                     return name
         return ""
     
-    def parse_product(self, soup: BeautifulSoup, url: str):
+    def parse_product(self, soup: "BeautifulSoup", url: str):
         root = self.select_main(soup)
         name_node = root.select_one("h1") or soup.select_one("h1")
         name = name_node.get_text(strip=True) if name_node else ""
@@ -206,12 +216,13 @@ class KagriCrawler:
                 data["description"], data["benefits"], data["storage"], data["caution"]
             ))
             conn.commit()
+            product_index.invalidate()
         except Exception as e:
             print(f"DB error inserting product {data.get('code')}: {e}")
         finally:
             conn.close()
     
-    def extract_company_info(self, soup: BeautifulSoup, url: str):
+    def extract_company_info(self, soup: "BeautifulSoup", url: str):
         root = self.select_main(soup)
         text = self.clean_text(root.get_text())
         def find_value(keys):
@@ -253,7 +264,7 @@ class KagriCrawler:
         finally:
             conn.close()
     
-    def parse_experts(self, soup: BeautifulSoup, url: str):
+    def parse_experts(self, soup: "BeautifulSoup", url: str):
         experts = []
         for card in soup.find_all(["section", "div"], string=lambda s: s and ("chuyên gia" in s.lower())):
             name = card.get_text(strip=True)
@@ -279,6 +290,9 @@ class KagriCrawler:
             conn.close()
 
     def crawl(self, max_pages=20):
+        import requests
+        from bs4 import BeautifulSoup
+        self.ensure_db()
         queue = [self.base_url]
         count = 0
         
@@ -353,6 +367,7 @@ class KagriCrawler:
             print(f"Prune error: {e}")
     
     def prune_products(self):
+        self.ensure_db()
         conn = get_db_connection()
         cur = conn.cursor()
         try:
@@ -403,12 +418,16 @@ class KagriCrawler:
             for did in dup_ids:
                 cur.execute("DELETE FROM products WHERE id = ?", (did,))
             conn.commit()
+            product_index.invalidate()
             if dup_ids:
                 print(f"Removed {len(dup_ids)} duplicate/empty URL product rows.")
         finally:
             conn.close()
     
     def sync_missing_products(self):
+        import requests
+        from bs4 import BeautifulSoup
+        self.ensure_db()
         try:
             conn = get_db_connection()
             cur = conn.cursor()
@@ -447,6 +466,8 @@ class KagriCrawler:
             print(f"Sync missing products error: {e}")
     
     def get_archive_product_links(self):
+        import requests
+        from bs4 import BeautifulSoup
         urls = set()
         try:
             # Collect from /san-pham/ archive pages
@@ -566,6 +587,9 @@ class KagriCrawler:
             return set()
     
     def validate_and_update_product(self, url: str):
+        import requests
+        from bs4 import BeautifulSoup
+        self.ensure_db()
         try:
             r = requests.get(url, timeout=10, headers=self.headers)
             if r.status_code != 200:
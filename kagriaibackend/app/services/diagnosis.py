@@ -1,8 +1,6 @@
 import os
 import base64
-import numpy as np
-import cv2
-from ultralytics import YOLO
+import threading
 from typing import List, Dict, Any
 
 class DiagnosisService:
@@ -16,8 +14,12 @@ class DiagnosisService:
         
         self.durian_model = None
         self.coffee_model = None
-        
-        self.load_models()
+        # ultralytics/torch are imported and the weights loaded on first use (or in the warm-up), not at import
+        self._models_loaded = False
+        self._models_lock = threading.Lock()
+        # A YOLO instance is not thread-safe: with PROCESS_WORKERS=0 several cpu-pool threads
+        # share it, so each model runs one inference at a time (decode stays outside the lock)
+        self._predict_locks = {"durian": threading.Lock(), "coffee": threading.Lock()}
         
         self.durian_map = {
             "anthracnose_disease": "Thán thư",
@@ -39,8 +41,16 @@ class DiagnosisService:
             "Phoma": "Đốm nấm Phoma"
         }
 
+    def ensure_models(self):
+        if not self._models_loaded:
+            with self._models_lock:
+                if not self._models_loaded:
+                    self.load_models()
+                    self._models_loaded = True
+
     def load_models(self):
         try:
+            from ultralytics import YOLO
             if os.path.exists(self.durian_model_path):
                 self.durian_model = YOLO(self.durian_model_path)
                 print(f"Durian model loaded from {self.durian_model_path}")
@@ -86,7 +96,41 @@ class DiagnosisService:
                 
         return images
 
+    def reply_text(self, result: Dict[str, Any]) -> str:
+        """
+        Chat reply for a predict() result, shared by the websocket image query and the
+        /api/diagnose endpoints so the stored answer always has the same format.
+        """
+        preds = result.get("predictions", [])
+        if result.get("error"):
+            return "Dạ, ảnh chưa hợp lệ hoặc mô hình chưa sẵn sàng ạ."
+        if not preds:
+            return "Dạ, em chưa phát hiện được bệnh rõ ràng từ ảnh này. Anh/chị vui lòng thử ảnh khác rõ nét hơn ạ."
+        top = preds[0]
+        lines = []
+        lines.append(f"Dạ, ảnh cho thấy khả năng cao: {top['name']} ({top['probability']}%).")
+        if len(preds) > 1:
+            lines.append("Các khả năng tiếp theo:")
+            for p in preds[1:]:
+                lines.append(f"- {p['name']} ({p['probability']}%)")
+        lines.append("Em gửi kèm ảnh mẫu bệnh để anh/chị đối chiếu ạ.")
+        return "\n".join(lines)
+
+    def warmup(self) -> int:
+        """One dummy inference per loaded model (first predict pays the fuse/allocation setup). Returns models warmed."""
+        import numpy as np
+        self.ensure_models()
+        img = np.zeros((640, 640, 3), dtype=np.uint8)
+        warmed = 0
+        for plant_type, model in (("durian", self.durian_model), ("coffee", self.coffee_model)):
+            if model is not None:
+                with self._predict_locks[plant_type]:
+                    model(img, verbose=False)
+                warmed += 1
+        return warmed
+
     def predict(self, image_base64: str, plant_type: str) -> Dict[str, Any]:
+        self.ensure_models()
         if plant_type == "durian":
             model = self.durian_model
             mapping = self.durian_map
@@ -100,6 +144,8 @@ class DiagnosisService:
             return {"error": "Model not loaded"}
 
         try:
+            import numpy as np
+            import cv2
             if "," in image_base64:
                 image_base64 = image_base64.split(",")[1]
             
@@ -110,7 +156,8 @@ class DiagnosisService:
             if img is None:
                 return {"error": "Invalid image"}
 
-            results = model(img)
+            with self._predict_locks[plant_type]:
+                results = model(img)
             
             output = []
             
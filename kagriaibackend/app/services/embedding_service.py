@@ -0,0 +1,145 @@
+import time
+import queue
+import asyncio
+import threading
+import unicodedata
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, List, Optional
+from app.core.config import settings
+from app.utils.cache import TTLCache
+
+if TYPE_CHECKING:
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64]
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+
+def normalize_text(text: str) -> str:
+    """Cache key: NFC, collapsed whitespace (case is kept, the SBERT model is case-sensitive)."""
+    return " ".join(unicodedata.normalize("NFC", text or "").split())
+
+def _bucket(value: float, bounds: List[float]) -> str:
+    for bound in bounds:
+        if value <= bound:
+            return f"<={bound}"
+    return f">{bounds[-1]}"
+
+class EmbeddingService:
+    """
+    In-process query embedding service around the SentenceTransformer (HuggingFaceEmbeddings).
+    Concurrent encodes are queued to one dedicated worker thread; when more than one is waiting it
+    collects for up to EMBED_BATCH_WINDOW_MS and encodes up to EMBED_MAX_BATCH texts in a
+    single forward pass (a lone request is encoded immediately).
+    Vectors are cached per normalized text (LRU + TTL).
+    embed() blocks (worker pools / scripts), aembed() awaits (event loop).
+    """
+    def __init__(self, window_ms: float = None, max_batch: int = None, cache_size: int = None):
+        self.window = (window_ms if window_ms is not None else settings.EMBED_BATCH_WINDOW_MS) / 1000.0
+        self.max_batch = max_batch or settings.EMBED_MAX_BATCH
+        self.cache = TTLCache(maxsize=cache_size or settings.EMBED_CACHE_SIZE, ttl=settings.EMBED_CACHE_TTL_SECONDS)
+        self.model: Optional["HuggingFaceEmbeddings"] = None
+        self._model_lock = threading.Lock()
+        self._queue: "queue.Queue" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self.counters = {"requests": 0, "encoded": 0, "batches": 0, "errors": 0}
+        self.batch_sizes = {_bucket(b, BATCH_SIZE_BUCKETS): 0 for b in BATCH_SIZE_BUCKETS + [BATCH_SIZE_BUCKETS[-1] + 1]}
+        self.latency_ms = {_bucket(b, LATENCY_BUCKETS_MS): 0 for b in LATENCY_BUCKETS_MS + [LATENCY_BUCKETS_MS[-1] + 1]}
+
+    def ensure_model(self) -> "HuggingFaceEmbeddings":
+        if self.model is None:
+            with self._model_lock:
+                if self.model is None:
+                    # torch/sentence-transformers load here, not at import
+                    from langchain_huggingface import HuggingFaceEmbeddings
+                    self.model = HuggingFaceEmbeddings(model_name=settings.EMBEDDING_MODEL)
+        return self.model
+
+    # --- Worker ---
+    def start(self):
+        with self._start_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="embedding-worker", daemon=True)
+                self._worker.start()
+
+    def stop(self, timeout: float = 5.0):
+        worker = self._worker
+        if worker is not None and worker.is_alive():
+            self._queue.put(None)
+            worker.join(timeout)
+        self._worker = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                # A lone request is encoded right away; the window only applies under concurrency
+                remaining = deadline - time.monotonic() if len(batch) > 1 or not self._queue.empty() else 0
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)  # stop after this batch
+                    break
+                batch.append(item)
+            self._encode(batch)
+
+    def _encode(self, batch: list):
+        # Same text queued twice in one window is encoded once
+        texts = list(dict.fromkeys(key for key, _, _ in batch))
+        try:
+            vectors = dict(zip(texts, self.ensure_model().embed_documents(texts)))
+        except Exception as e:
+            self.counters["errors"] += 1
+            for _, fut, _ in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        self.counters["batches"] += 1
+        self.counters["encoded"] += len(texts)
+        self.batch_sizes[_bucket(len(texts), BATCH_SIZE_BUCKETS)] += 1
+        now = time.perf_counter()
+        for key, fut, queued_at in batch:
+            vector = vectors[key]
+            self.cache.set(key, vector)
+            self.latency_ms[_bucket((now - queued_at) * 1000, LATENCY_BUCKETS_MS)] += 1
+            if not fut.done():
+                fut.set_result(vector)
+
+    # --- API ---
+    def submit(self, text: str) -> Future:
+        self.counters["requests"] += 1
+        key = normalize_text(text)
+        fut: Future = Future()
+        cached = self.cache.get(key)
+        if cached is not None:
+            fut.set_result(cached)
+            return fut
+        self.start()
+        self._queue.put((key, fut, time.perf_counter()))
+        return fut
+
+    def embed(self, text: str, timeout: float = 60.0) -> List[float]:
+        return self.submit(text).result(timeout)
+
+    async def aembed(self, text: str) -> List[float]:
+        return await asyncio.wrap_future(self.submit(text))
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "queued": self._queue.qsize(),
+            "window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+            "avg_batch": round(self.counters["encoded"] / self.counters["batches"], 2) if self.counters["batches"] else 0.0,
+            "batch_size_histogram": dict(self.batch_sizes),
+            "latency_ms_histogram": dict(self.latency_ms),
+            "cache": self.cache.stats(),
+        }
+
+embedding_service = EmbeddingService()
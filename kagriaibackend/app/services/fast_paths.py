@@ -0,0 +1,202 @@
+import time
+from collections import deque
+from contextlib import aclosing
+from typing import AsyncIterator, Dict, List, Optional
+from app.core.executors import executors
+from app.services.intent_router import Route
+from app.services.hybrid_search import hybrid_engine
+from app.services.market_price import market_price_service
+from app.services.time_service import time_service
+
+class HandlerContext:
+    """What a handler may read about the message; history_text overrides the AI text saved to history."""
+    __slots__ = ("request_id", "user_text", "session", "history_text")
+
+    def __init__(self, request_id: str, user_text: str, session):
+        self.request_id = request_id
+        self.user_text = user_text
+        self.session = session
+        self.history_text: Optional[str] = None
+
+class FastPathHandler:
+    """
+    Answer that bypasses the LLM pipeline.
+    match(route) decides whether to try it; handle(route, ctx) is an async generator of answer
+    text. Yielding nothing (or failing before the first chunk) means "not mine after all" and the
+    message falls through to the next handler, then to the LLM. Frames, history and
+    update_ai_turn are done by the registry.
+    """
+    name = "base"
+    intent: Optional[str] = None
+
+    def match(self, route: Route) -> bool:
+        return self.intent is not None and self.intent in route.intents
+
+    async def handle(self, route: Route, ctx: HandlerContext) -> AsyncIterator[str]:
+        return
+        yield
+
+class HandlerRegistry:
+    """
+    Ordered fast-path handlers with per-handler metrics (calls, answered, passed, errors, latency).
+    Matching handlers are tried in route.intents order, handlers without an intent after them.
+    """
+    def __init__(self):
+        self.handlers: List[FastPathHandler] = []
+        self.metrics: Dict[str, dict] = {}
+
+    def register(self, handler_cls):
+        """Class decorator: @fast_paths.register"""
+        handler = handler_cls()
+        if handler.name in self.metrics:
+            raise ValueError(f"Fast-path handler '{handler.name}' already registered")
+        self.handlers.append(handler)
+        self.metrics[handler.name] = {"calls": 0, "answered": 0, "passed": 0, "errors": 0, "latency_ms": deque(maxlen=1024)}
+        return handler_cls
+
+    def candidates(self, route: Route) -> List[FastPathHandler]:
+        order = {intent: i for i, intent in enumerate(route.intents)}
+        matched = [h for h in self.handlers if h.match(route)]
+        return sorted(matched, key=lambda h: order.get(h.intent, len(order)))
+
+    async def dispatch(self, route: Route, turn, out) -> Optional[str]:
+        """
+        Run matching handlers until one answers; chunks go to out (ReplyStream) as they come.
+        Returns the name of the handler that answered, or None (use the LLM pipeline).
+        """
+        for handler in self.candidates(route):
+            m = self.metrics[handler.name]
+            m["calls"] += 1
+            ctx = HandlerContext(out.request_id, turn.user_text, turn.session)
+            chunks: List[str] = []
+            started = time.perf_counter()
+            try:
+                async with aclosing(handler.handle(route, ctx)) as answer:
+                    async for chunk in answer:
+                        if chunk:
+                            await out.write(chunk)
+                            chunks.append(chunk)
+                            turn.partial = "".join(chunks)
+            except Exception as e:
+                m["errors"] += 1
+                print(f"Fast path '{handler.name}' error: {e}")
+            finally:
+                m["latency_ms"].append((time.perf_counter() - started) * 1000)
+            if not chunks:
+                m["passed"] += 1
+                continue
+            await out.close()
+            await turn.finish(turn.user_text, ctx.history_text or "".join(chunks))
+            m["answered"] += 1
+            return handler.name
+        return None
+
+    def stats(self) -> dict:
+        out = {}
+        for name, m in self.metrics.items():
+            lat = sorted(m["latency_ms"])
+            pct = lambda p: round(lat[min(len(lat) - 1, int(round(p * (len(lat) - 1))))], 2) if lat else 0.0
+            out[name] = {
+                "calls": m["calls"],
+                "answered": m["answered"],
+                "passed": m["passed"],
+                "errors": m["errors"],
+                "latency_ms_p50": pct(0.5),
+                "latency_ms_p95": pct(0.95),
+                "latency_ms_max": round(lat[-1], 2) if lat else 0.0,
+            }
+        return out
+
+fast_paths = HandlerRegistry()
+
+# --- Handlers ---
+def _date_from_numbers(nums: list) -> str:
+    a, b, c = nums[0], nums[1], nums[2]
+    return f"{a}/{b}/{c}"
+
+@fast_paths.register
+class ConvertDateHandler(FastPathHandler):
+    name = "convert_date"
+    intent = "convert_date"
+
+    async def handle(self, route, ctx):
+        try:
+            convert_to_am = route.has("to_am")
+            convert_to_duong = route.has("to_duong")
+            has_am, has_duong = route.has("am"), route.has("duong")
+            if convert_to_duong and not convert_to_am:
+                is_lunar = True
+            elif convert_to_am and not convert_to_duong:
+                is_lunar = False
+            elif has_am and has_duong:
+                is_lunar = route.first("am") <= route.first("duong")
+            else:
+                is_lunar = has_am and not has_duong
+            result_text = time_service.get_date_info(_date_from_numbers(route.numbers), is_lunar=is_lunar)
+        except Exception as e:
+            ctx.history_text = "Không chuyển được ngày âm dương"
+            result_text = "Dạ, em không chuyển được ngày âm dương với định dạng vừa nhập ạ."
+        yield result_text
+
+@fast_paths.register
+class TimeHandler(FastPathHandler):
+    name = "time"
+    intent = "time"
+
+    async def handle(self, route, ctx):
+        if len(route.numbers) >= 3:
+            is_lunar_flag = route.has("am") and not route.has("duong")
+            yield time_service.get_date_info(_date_from_numbers(route.numbers), is_lunar=is_lunar_flag)
+        else:
+            yield time_service.get_current_time_info()
+
+DIAGNOSE_GUIDE = (
+    "Để chẩn đoán bệnh cây trồng qua ảnh, mời anh/chị bấm nút "
+    "“Chẩn đoán bệnh cây trồng qua ảnh” ở cạnh ô nhập, tải ảnh vết bệnh lên và chọn loại cây.\n\n"
+    "Lưu ý:\n"
+    "- Hiện hỗ trợ: Sầu Riêng (Thán thư, Ung thư thân, Thối trái, Rệp sáp, Nấm hồng, Bồ hóng, Cháy lá chết ngọn, Xì mủ thân, Bọ trĩ, Vàng lá) và Cà Phê (Gỉ sắt, Sâu vẽ bùa, Bệnh khô cành, Khỏe mạnh).\n"
+    "- Ảnh cần rõ nét, tập trung vết bệnh, ánh sáng tốt, khoảng cách 30–50 cm.\n"
+    "- Nếu bệnh ngoài danh sách, kết quả có thể chưa chính xác. Liên hệ hotline 0985.562.582 hoặc kagri.vn để được tư vấn chuyên gia."
+)
+
+@fast_paths.register
+class DiagnoseGuideHandler(FastPathHandler):
+    name = "diagnose_guide"
+    intent = "diagnose_guide"
+
+    async def handle(self, route, ctx):
+        yield DIAGNOSE_GUIDE
+
+@fast_paths.register
+class MarketPriceHandler(FastPathHandler):
+    name = "market_price"
+    intent = "market_price"
+
+    async def handle(self, route, ctx):
+        yield await executors.run_io(market_price_service.get_prices, route.text)
+
+@fast_paths.register
+class ProductListHandler(FastPathHandler):
+    name = "product_list"
+    intent = "product_list"
+
+    async def handle(self, route, ctx):
+        total_count, examples = await executors.run_db(hybrid_engine.get_product_overview, ctx.user_text, 3)
+        if total_count <= 0:
+            return
+        response_text = f"Dạ, hiện tại KAGRI đang cung cấp tổng cộng **{total_count} sản phẩm** phục vụ đa dạng nhu cầu của bà con nông dân ạ.\n\n"
+        response_text += "Các sản phẩm của KAGRI bao gồm thuốc trừ sâu, thuốc trừ bệnh, phân bón và các chế phẩm sinh học, giúp bảo vệ cây trồng khỏi sâu bệnh hại và tăng năng suất.\n\n"
+        response_text += f"Em xin phép giới thiệu {len(examples)} sản phẩm tiêu biểu với các công dụng khác nhau ạ:\n\n"
+
+        for i, prod in enumerate(examples, 1):
+            usage_text = prod.get('snippet') or prod['usage'] or "Đang cập nhật công dụng"
+            usage_text = " ".join(usage_text.split())
+            if len(usage_text) > 150:
+                usage_text = usage_text[:147] + "..."
+
+            response_text += f"{i}. **{prod['name']}** ({prod['code']})\n"
+            response_text += f"   - Công dụng: {usage_text}\n"
+            response_text += f"   👉 Chi tiết: {prod['url']}\n\n"
+
+        response_text += "Mời anh/chị xem thêm danh sách đầy đủ tại website hoặc hỏi em về loại bệnh cụ thể để em tư vấn sản phẩm phù hợp nhất ạ."
+        yield response_text
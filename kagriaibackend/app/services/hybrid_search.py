@@ -1,15 +1,71 @@
 import sqlite3
 import re
-from app.core.database import get_db_connection
+from app.core.database import catalog_pool, fts_available
+from app.core.executors import executors
+from app.services.product_index import product_index
 from app.services.rag_engine import rag_engine
 from app.services.llm_engine import llm_engine
+from app.services.intent_router import intent_router, Route
+from app.utils.text_processing import tokenize, fold_diacritics
+
+# Generic words of "list products" questions; dropped before full-text matching
+PRODUCT_LIST_STOPWORDS = {
+    "các", "sản", "phẩm", "danh", "sách", "của", "công", "ty", "tất", "cả", "đang", "có",
+    "bao", "nhiêu", "tổng", "số", "liệt", "kê", "giới", "thiệu", "nào", "gì", "kagri",
+    "cho", "em", "anh", "chị", "tôi", "mình", "những", "loại", "là", "và", "không", "ạ",
+}
+PRODUCT_LIST_STOPWORDS |= {fold_diacritics(w) for w in PRODUCT_LIST_STOPWORDS}
+
+def _d_variants(tok: str) -> list:
+    """
+    The FTS tokenizer folds every Vietnamese mark except "đ", so a syllable typed with a plain
+    leading "d" ("dong") may mean "đ" ("Đồng"): match both. "đ"/"d" only starts a syllable.
+    """
+    return [tok, "đ" + tok[1:]] if tok.startswith("d") else [tok]
+
+def fts_terms(query: str, stopwords: set = None) -> list:
+    """
+    Quoted FTS5 terms for a query. The tokenizer removes diacritics on both sides, so
+    unaccented tokens match accented text; a leading "d" also tries "đ".
+    """
+    terms = []
+    for tok in tokenize(query):
+        if stopwords and tok in stopwords:
+            continue
+        for variant in _d_variants(tok):
+            quoted = f'"{variant}"'
+            if quoted not in terms:
+                terms.append(quoted)
+    return terms
+
+def fts_phrases(query: str, stopwords: set = None) -> list:
+    """
+    Adjacent token pairs as FTS5 phrases ("thế thanh", "than thu"), for names and disease terms.
+    """
+    toks = [t for t in tokenize(query) if not (stopwords and t in stopwords)]
+    phrases = []
+    for a, b in zip(toks, toks[1:]):
+        for va in _d_variants(a):
+            for vb in _d_variants(b):
+                quoted = f'"{va} {vb}"'
+                if quoted not in phrases:
+                    phrases.append(quoted)
+    return phrases
 
 class HybridSearchEngine:
     def __init__(self):
         self.conn = None # Connection per request usually, but for simplicity here
+        self._fts = None
         
     def get_db(self):
-        return get_db_connection()
+        return catalog_pool.connection()
+
+    def fts_enabled(self) -> bool:
+        if self._fts is None:
+            conn = self.get_db()
+            has_tables = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'products_fts'").fetchone()[0] > 0
+            self._fts = fts_available(conn) and has_tables
+        return self._fts
 
     def analyze_intent(self, query: str) -> dict:
         """
@@ -21,50 +77,97 @@ class HybridSearchEngine:
         target_field = result.get("target_field")
         return {"intent": intent, "target_field": target_field}
 
+    async def aanalyze_intent(self, query: str) -> dict:
+        """
+        Async variant: keyword pre-pass and cache first, LLM only for ambiguous queries.
+        """
+        result = await llm_engine.aclassify_intent(query)
+        return {"intent": result.get("intent", "rag"), "target_field": result.get("target_field")}
+
     def search_db_product(self, query: str, code: str = None):
         """
-        Fuzzy search product in DB.
+        Best matching product for the query (or exact code), None if nothing matches.
         """
-        conn = self.get_db()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT code, name, url, ingredients, usage, category FROM products")
-        products = cursor.fetchall()
-        conn.close()
-        
-        # Exact code match
         if code:
-            for p in products:
-                if p['code'] == code:
-                    return p
-        
-        best_match = None
-        max_score = 0
-        
-        query_words = set(query.lower().split())
-        
-        for p in products:
-            # Score based on overlap
-            name_words = set(p['name'].lower().split())
-            p_code = p['code'].lower()
-            
-            score = 0
-            if p_code in query.lower():
-                score += 10 # High priority for code match
-            
-            overlap = len(query_words.intersection(name_words))
-            score += overlap
-            
-            if score > max_score and score > 0:
-                max_score = score
-                best_match = p
-                
-        return best_match
+            return product_index.get_by_code(code)
+        results = self.search_db_products(query, k=1)
+        return results[0][0] if results else None
+
+    def search_db_products(self, query: str, k: int = 5):
+        """
+        Top-k products as (product, score), matched on code/name via FTS5 bm25.
+        Falls back to a table scan (query tokens found in code/name) when FTS5 is unavailable.
+        """
+        terms = fts_terms(query)
+        if not terms:
+            return []
+        if not self.fts_enabled():
+            return self._scan_db_products(query, k)
+        conn = self.get_db()
+        rows = conn.execute('''
+            SELECT p.code, p.name, p.url, p.ingredients, p.usage, p.category,
+                   bm25(products_fts, 10.0, 5.0, 0.0, 0.0, 0.0) AS score
+            FROM products_fts JOIN products p ON p.id = products_fts.rowid
+            WHERE products_fts MATCH ?
+            ORDER BY score LIMIT ?
+        ''', ("{code name} : (" + " OR ".join(terms) + ")", k)).fetchall()
+        results = []
+        for r in rows:
+            product = dict(r)
+            score = -product.pop("score")
+            results.append((product, round(score, 4)))
+        return results
+
+    def _scan_db_products(self, query: str, k: int):
+        q_tokens = set(tokenize(query))
+        rows = self.get_db().execute("SELECT code, name, url, ingredients, usage, category FROM products").fetchall()
+        scored = []
+        for r in rows:
+            hits = len(q_tokens & set(tokenize(f"{r['code'] or ''} {r['name'] or ''}")))
+            if hits:
+                scored.append((dict(r), float(hits)))
+        scored.sort(key=lambda x: -x[1])
+        return scored[:k]
+
+    def search_products_fulltext(self, query: str, k: int = 3):
+        """
+        Products whose name or description matches the non-generic words of the query,
+        with a highlighted snippet. Empty list if nothing specific was asked.
+        Two-word phrases are tried first; single words only if no phrase matches.
+        """
+        if not self.fts_enabled():
+            return []
+        rows = []
+        conn = self.get_db()
+        for terms in (fts_phrases(query, PRODUCT_LIST_STOPWORDS), fts_terms(query, PRODUCT_LIST_STOPWORDS)):
+            if not terms:
+                continue
+            rows = conn.execute('''
+                SELECT p.code, p.name, p.url, p.usage,
+                       snippet(products_fts, -1, '**', '**', '…', 24) AS snippet
+                FROM products_fts JOIN products p ON p.id = products_fts.rowid
+                WHERE products_fts MATCH ?
+                ORDER BY bm25(products_fts, 2.0, 5.0, 0.5, 1.0, 0.5) LIMIT ?
+            ''', ("{name ingredients usage category} : (" + " OR ".join(terms) + ")", k)).fetchall()
+            if rows:
+                break
+        return [dict(r) for r in rows]
+
+    def get_product_overview(self, query: str, k: int = 3):
+        """
+        (total product count, k example products) for the product-list handler.
+        Examples are query-relevant when possible, random otherwise.
+        """
+        conn = self.get_db()
+        total = conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+        examples = self.search_products_fulltext(query, k=k)
+        if not examples and total:
+            examples = [dict(p) for p in self.search_db_products_random(limit=k)]
+        return total, examples
 
     def search_db_company(self):
         conn = self.get_db()
         row = conn.execute("SELECT * FROM company_info LIMIT 1").fetchone()
-        conn.close()
         return row
 
     def search_db_experts(self, query: str = None):
@@ -76,29 +179,33 @@ class HybridSearchEngine:
         conn = self.get_db()
         cursor = conn.cursor()
         
-        # Simple heuristic to extract name from query if possible, 
-        # but for now, let's just fetch all and filter in Python or use LIKE in SQL if simple.
-        # Given the small number of experts, fetching all is fine.
-        cursor.execute("SELECT name, title, degree, bio, profile_url FROM experts")
-        experts = cursor.fetchall()
-        conn.close()
-        
         if not query:
-            return experts[:2] # Return first 2 if no specific query
-            
-        # Filter by name if mentioned in query
-        query_lower = query.lower()
+            experts = cursor.execute("SELECT name, title, degree, bio, profile_url FROM experts LIMIT 2").fetchall()
+            return experts # Return first 2 if no specific query
+        
+        # Name match: any two adjacent words of the query form part of an expert's name
         matched_experts = []
-        for exp in experts:
-            if exp['name'].lower() in query_lower:
-                matched_experts.append(exp)
+        phrases = fts_phrases(query)
+        if phrases and self.fts_enabled():
+            matched_experts = cursor.execute('''
+                SELECT e.name, e.title, e.degree, e.bio, e.profile_url
+                FROM experts_fts JOIN experts e ON e.id = experts_fts.rowid
+                WHERE experts_fts MATCH ?
+                ORDER BY rank
+            ''', ("{name} : (" + " OR ".join(phrases) + ")",)).fetchall()
+        elif not self.fts_enabled():
+            query_lower = query.lower()
+            matched_experts = [exp for exp in cursor.execute("SELECT name, title, degree, bio, profile_url FROM experts").fetchall()
+                               if exp['name'].lower() in query_lower]
                 
         if matched_experts:
             return matched_experts
             
         # If asking about experts generally but no name match found, return top 2
+        query_lower = query.lower()
         if "chuyên gia" in query_lower or "bác sĩ" in query_lower:
-            return experts[:2]
+            experts = cursor.execute("SELECT name, title, degree, bio, profile_url FROM experts LIMIT 2").fetchall()
+            return experts
             
         return []
 
@@ -110,13 +217,29 @@ class HybridSearchEngine:
         cursor = conn.cursor()
         cursor.execute("SELECT code, name, url, ingredients, usage, category FROM products ORDER BY RANDOM() LIMIT ?", (limit,))
         products = cursor.fetchall()
-        conn.close()
         return products
 
-    def get_context(self, query: str, last_product_code: str = None):
+    def get_context(self, query: str, last_product_code: str = None, route: Route = None):
         analysis = self.analyze_intent(query)
+        return self.build_context(query, analysis, last_product_code, route)
+
+    async def aget_context(self, query: str, last_product_code: str = None, route: Route = None):
+        """
+        Non-blocking get_context: classify on the event loop, then run DB/RAG lookups in the cpu pool.
+        route: the intent_router result chatws already computed (keyword flags are not rescanned).
+        """
+        analysis = await self.aanalyze_intent(query)
+        return await executors.run_cpu(self.build_context, query, analysis, last_product_code, route)
+
+    def build_context(self, query: str, analysis: dict, last_product_code: str = None, route: Route = None):
         intent = analysis["intent"]
+        route = route or intent_router.route(query)
         context_parts = []
+        # Same pieces with a value rank (lower = keep first) for the token-budgeted prompt builder
+        sections = []
+        def add_part(kind: str, text: str, rank: int):
+            context_parts.append(text)
+            sections.append({"kind": kind, "text": text, "rank": rank})
         
         print(f"DEBUG: Query='{query}', Intent='{intent}', LastProduct='{last_product_code}'")
         
@@ -127,16 +250,13 @@ class HybridSearchEngine:
         
         fallback_msg = f"Xin lỗi bạn, hiện tại KAGRI AI chưa tìm thấy thông tin này trong hệ thống dữ liệu. Bạn vui lòng ghé thăm website {website} hoặc liên hệ hotline {hotline} để được hỗ trợ nhanh nhất."
 
-        # Detect special keywords
-        is_asking_expert = "chuyên gia" in query.lower() or "bác sĩ" in query.lower()
-        is_asking_consultation = "tư vấn" in query.lower() and "sản phẩm" in query.lower()
-        
-        # Enhanced company keywords detection
-        company_keywords = ["địa chỉ", "hotline", "số điện thoại", "sdt", "liên hệ", "công ty", "ở đâu", "website", "email", "trụ sở", "văn phòng"]
-        is_asking_company = any(kw in query.lower() for kw in company_keywords)
+        # Detect special keywords (matched once by intent_router)
+        is_asking_expert = route.has("expert")
+        is_asking_consultation = route.has("consult") and route.has("product")
+        is_asking_company = route.has("company")
 
         # 1. Company Info
-        if intent == "db_company" or "kagri" in query.lower() or is_asking_expert or is_asking_company:
+        if intent == "db_company" or route.has("kagri") or is_asking_expert or is_asking_company:
             if comp_info:
                 qlower = query.lower()
                 name = comp_info['name'] if comp_info['name'] else "KAGRI"
@@ -153,7 +273,7 @@ class HybridSearchEngine:
                 license_tax = comp_info['license_tax'] if 'license_tax' in comp_info.keys() and comp_info['license_tax'] else ""
                 
                 info = f"DỮ LIỆU CÔNG TY:\n- Tên: {name}\n- Hotline: {hl}\n- Địa chỉ: {addr}\n- Email: {em}\n- Website: {web}\n- Slogan: {slogan}\n- Giới thiệu: {intro}\n- Tầm nhìn: {vision}\n- Sứ mệnh: {mission}\n- Giá trị cốt lõi: {core_values}\n- Nhà máy: {factories}\n- Giấy phép/MST: {license_tax}\nMời xem chi tiết tại: {web}\n"
-                context_parts.append(info)
+                add_part("company", info, 0 if intent == "db_company" else 2)
                 
             # Special Logic: Experts
             if is_asking_expert:
@@ -166,10 +286,10 @@ class HybridSearchEngine:
                         expert_text += f"{idx}. {exp['degree']} {exp['name']} ({exp['title']})\n"
                         if exp['bio']: expert_text += f"   - Tiểu sử: {exp['bio']}\n"
                         if exp['profile_url']: expert_text += f"   - Xem chi tiết: {exp['profile_url']}\n"
-                    context_parts.append(expert_text)
+                    add_part("experts", expert_text, 1)
                 else:
                     # Found no experts matching the name or query
-                    context_parts.append("\nKHÔNG TÌM THẤY CHUYÊN GIA NÀO TRONG HỆ THỐNG TRÙNG KHỚP VỚI CÂU HỎI.\n")
+                    add_part("experts", "\nKHÔNG TÌM THẤY CHUYÊN GIA NÀO TRONG HỆ THỐNG TRÙNG KHỚP VỚI CÂU HỎI.\n", 1)
 
             # Only fallback if we really intended to find company info but found nothing
             if intent == "db_company" and not context_parts:
@@ -192,10 +312,10 @@ class HybridSearchEngine:
                     suggestion_text += f"  Link chi tiết: {p['url']}\n"
                     suggestion_text += f"  Mời xem chi tiết tại: {p['url']}\n"
                     suggestion_text += f"  Hoặc liên hệ hotline: {hotline}\n"
-                context_parts.append(suggestion_text)
+                add_part("suggestions", suggestion_text, 1)
                 product_found = True # Treat as found so we don't fallback
 
-        if (intent in ["db_product", "mixed"] or "sản phẩm" in query.lower()) and not is_asking_consultation:
+        if (intent in ["db_product", "mixed"] or route.has("product")) and not is_asking_consultation:
             product = self.search_db_product(query)
             # Context fallback: If no product found but we have last_product_code, use it regardless of intent
             if not product and last_product_code:
@@ -216,7 +336,7 @@ class HybridSearchEngine:
                 Mời xem chi tiết tại: {product['url']}
                 Hoặc liên hệ hotline: {hotline}
                 """
-                context_parts.append(product_db_info)
+                add_part("product", product_db_info, 0)
             else:
                  print("DEBUG: No product match in DB")
 
@@ -232,6 +352,10 @@ class HybridSearchEngine:
             if rag_docs:
                 rag_text = "\n".join(rag_docs)
                 context_parts.append(f"Thông tin bổ sung (Mô tả, công dụng, lưu ý):\n{rag_text}")
+                # One section per chunk, lower-ranked chunks are dropped first
+                for i, doc in enumerate(rag_docs):
+                    text = f"Thông tin bổ sung (Mô tả, công dụng, lưu ý):\n{doc}" if i == 0 else doc
+                    sections.append({"kind": "rag", "text": text, "rank": 3 + i})
 
         if not context_parts:
             # If strictly DB intent and failed -> Fallback
@@ -241,6 +365,6 @@ class HybridSearchEngine:
             # If RAG/Mixed but nothing found -> Return empty string to let LLM handle chitchat
             return {"text": "", "product_code": None}
 
-        return {"text": "\n".join(context_parts), "product_code": found_product_code}
+        return {"text": "\n".join(context_parts), "product_code": found_product_code, "sections": sections}
 
 hybrid_engine = HybridSearchEngine()
@@ -0,0 +1,167 @@
+import re
+from typing import Dict, List, Tuple
+
+# --- Keyword tables (substring match on the lowercased message) ---
+# Fast paths handled in chatws without the LLM
+TIME_KEYWORDS = ["mấy giờ", "ngày bao nhiêu", "hôm nay là", "thời gian", "ngày mấy", "giờ nào"]
+LUNAR_KEYWORDS = ["âm lịch", "lịch âm", "ngày âm", "hôm nay âm", "hôm nay âm lịch"]
+AM_KEYWORDS = ["âm", "am"]
+DUONG_KEYWORDS = ["dương", "duong"]
+CONVERT_KEYWORDS = ["chuyển", "chuyen", "đổi", "doi", "convert", "->", "sang", "bao nhiêu dương", "bao nhieu duong", "là ngày dương", "la ngay duong", "thứ mấy", "thu may", "thứ"]
+TO_AM_KEYWORDS = ["sang âm", "doi sang am", "đổi sang âm", "duong sang am", "dương sang âm"]
+TO_DUONG_KEYWORDS = ["sang dương", "doi sang duong", "đổi sang dương", "am sang duong", "âm sang dương"]
+DIAGNOSE_KEYWORDS = [
+    "chẩn đoán", "chẩn đoán bệnh", "chẩn đoán bệnh cây trồng",
+    "chẩn đoán qua ảnh", "chan doan", "chan doan benh", "chan doan qua anh"
+]
+PRICE_KEYWORDS = ["giá nông sản", "giá cà phê", "giá tiêu", "giá lúa", "giá gạo", "giá thóc", "giá sầu riêng", "giá heo", "giá lợn"]
+PRODUCT_LIST_KEYWORDS = ["các sản phẩm", "danh sách sản phẩm", "sản phẩm của công ty", "tất cả sản phẩm", "sản phẩm đang có"]
+PRODUCT_LIST_HINTS = ["bao nhiêu", "tổng số", "liệt kê", "giới thiệu", "nào", "gì"]
+
+# Context building (hybrid_search.build_context)
+PRODUCT_KEYWORDS = ["sản phẩm"]
+EXPERT_KEYWORDS = ["chuyên gia", "bác sĩ"]
+CONSULT_KEYWORDS = ["tư vấn"]
+CONTEXT_COMPANY_KEYWORDS = ["địa chỉ", "hotline", "số điện thoại", "sdt", "liên hệ", "công ty", "ở đâu", "website", "email", "trụ sở", "văn phòng"]
+KAGRI_KEYWORDS = ["kagri"]
+
+# Intent classifier pre-pass (llm_engine.rule_classify)
+COMPANY_KEYWORDS = ["địa chỉ", "hotline", "số điện thoại", "sđt", "email", "liên hệ", "công ty", "ở đâu", "giấy phép", "mst", "mã số thuế", "nhà máy", "slogan", "tầm nhìn", "sứ mệnh"]
+DB_FIELD_KEYWORDS = {
+    "ingredients": ["thành phần", "chứa gì", "chất gì", "hàm lượng"],
+    "usage": ["liều lượng", "cách dùng", "hướng dẫn sử dụng", "sử dụng thế nào", "pha như thế nào", "tưới bao nhiêu"],
+    "code": ["mã sản phẩm", "sku", "mã số"],
+    "url": ["link", "đường dẫn", "website", "trang web"],
+    "category": ["loại gì", "nhóm nào", "danh mục"]
+}
+RAG_KEYWORDS = ["công dụng", "tác dụng", "lợi ích", "mô tả", "là gì", "an toàn", "lưu ý", "độc hại", "có tốt không"]
+
+KEYWORD_GROUPS: Dict[str, List[str]] = {
+    "time": TIME_KEYWORDS,
+    "lunar": LUNAR_KEYWORDS,
+    "am": AM_KEYWORDS,
+    "duong": DUONG_KEYWORDS,
+    "convert": CONVERT_KEYWORDS,
+    "to_am": TO_AM_KEYWORDS,
+    "to_duong": TO_DUONG_KEYWORDS,
+    "diagnose": DIAGNOSE_KEYWORDS,
+    "price": PRICE_KEYWORDS,
+    "product_list": PRODUCT_LIST_KEYWORDS,
+    "product_list_hint": PRODUCT_LIST_HINTS,
+    "product": PRODUCT_KEYWORDS,
+    "expert": EXPERT_KEYWORDS,
+    "consult": CONSULT_KEYWORDS,
+    "company": CONTEXT_COMPANY_KEYWORDS,
+    "kagri": KAGRI_KEYWORDS,
+    "classify:company": COMPANY_KEYWORDS,
+    "classify:rag": RAG_KEYWORDS,
+    **{f"field:{field}": keywords for field, keywords in DB_FIELD_KEYWORDS.items()},
+}
+
+_NUMBERS = re.compile(r"\d{1,4}")
+
+Span = Tuple[int, int]
+
+def _trie_regex(words: List[str]) -> str:
+    """Alternation shaped as a trie: branches split on one char, optional tails are greedy (longest first)."""
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node: dict) -> str:
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
+class Route:
+    """Routing result: matched keyword spans per group, numbers, and fast-path intents in dispatch order."""
+    __slots__ = ("text", "spans", "numbers", "intents")
+
+    def __init__(self, text: str, spans: Dict[str, List[Span]], numbers: List[str]):
+        self.text = text
+        self.spans = spans
+        self.numbers = numbers
+        self.intents: List[str] = []
+
+    def has(self, group: str) -> bool:
+        return group in self.spans
+
+    def first(self, group: str) -> int:
+        spans = self.spans.get(group)
+        return min(spans)[0] if spans else 9999
+
+    @property
+    def intent(self) -> str:
+        return self.intents[0] if self.intents else "chat"
+
+    def to_dict(self) -> dict:
+        return {"intent": self.intent, "intents": list(self.intents), "numbers": list(self.numbers),
+                "spans": {g: [list(s) for s in sorted(spans)] for g, spans in self.spans.items()}}
+
+class IntentRouter:
+    """
+    All keyword tables compiled into one trie-shaped regex, run once per message.
+    The scan restarts one char after each match, so every start position reports its longest
+    keyword; each keyword carries the (group, offset) of every shorter keyword inside it, so
+    overlapping matches ("hôm nay âm lịch" -> lunar + am) are not lost and spans stay exact.
+    Answers for fast-path intents live in fast_paths (handler registry).
+    """
+    def __init__(self, groups: Dict[str, List[str]] = None):
+        self.groups = groups or KEYWORD_GROUPS
+        keyword_groups: Dict[str, set] = {}
+        for group, keywords in self.groups.items():
+            for kw in keywords:
+                keyword_groups.setdefault(kw, set()).add(group)
+        # keyword -> [(group, offset, length)] for every keyword occurring inside it (itself included)
+        self._hits: Dict[str, List[Tuple[str, int, int]]] = {}
+        for kw in keyword_groups:
+            hits = []
+            for inner, inner_groups in keyword_groups.items():
+                pos = kw.find(inner)
+                while pos != -1:
+                    hits.extend((g, pos, len(inner)) for g in inner_groups)
+                    pos = kw.find(inner, pos + 1)
+            self._hits[kw] = hits
+        self._pattern = re.compile(_trie_regex(list(keyword_groups)))
+
+    def scan(self, text: str) -> Dict[str, List[Span]]:
+        """group -> (start, end) spans of its keywords in text (already lowercased), in scan order."""
+        found: Dict[str, List[Span]] = {}
+        hits = self._hits
+        search = self._pattern.search
+        m = search(text)
+        while m is not None:
+            start = m.start()
+            for group, offset, length in hits[m.group()]:
+                begin = start + offset
+                spans = found.get(group)
+                if spans is None:
+                    found[group] = [(begin, begin + length)]
+                elif (begin, begin + length) not in spans:
+                    spans.append((begin, begin + length))
+            m = search(text, start + 1)
+        return found
+
+    def route(self, user_text: str) -> Route:
+        text = (user_text or "").lower().strip()
+        r = Route(text, self.scan(text), _NUMBERS.findall(text))
+        if len(r.numbers) >= 3 and (r.has("convert") or (r.has("am") and r.has("duong"))):
+            r.intents.append("convert_date")
+        elif r.has("time") or r.has("lunar"):
+            r.intents.append("time")
+        if r.has("diagnose"):
+            r.intents.append("diagnose_guide")
+        if r.has("price"):
+            r.intents.append("market_price")
+        if r.has("product_list") or (r.has("product") and r.has("product_list_hint")):
+            r.intents.append("product_list")
+        return r
+
+intent_router = IntentRouter()
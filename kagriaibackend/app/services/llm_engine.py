@@ -1,48 +1,250 @@
 import os
 import sys
-from typing import AsyncGenerator, Optional
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+from collections import deque
+from contextlib import aclosing, asynccontextmanager
+from typing import AsyncGenerator, AsyncIterator, Dict, List, Optional
 from app.core.config import settings
 from app.utils.text_processing import SentenceBuffer
+from app.utils.cache import TTLCache
+# Keyword tables (COMPANY/DB_FIELD/RAG) live in intent_router: one compiled matcher for all of them
+from app.services.intent_router import intent_router, COMPANY_KEYWORDS, DB_FIELD_KEYWORDS, RAG_KEYWORDS
+import httpx
 import ollama
 import json
+import re
+
+def normalize_query(query: str) -> str:
+    """
+    Cache key for a query: lowercase, collapsed whitespace, no trailing punctuation.
+    """
+    q = " ".join((query or "").lower().split())
+    return re.sub(r"[\s?!.,;:]+$", "", q)
+
+# Gateway priorities: lower runs first
+PRIORITY_CHAT = 0
+PRIORITY_CLASSIFY = 1
+PRIORITY_WEATHER = 2
+PRIORITY_NAMES = {PRIORITY_CHAT: "chat", PRIORITY_CLASSIFY: "classify", PRIORITY_WEATHER: "weather"}
+
+BUSY_REPLY = "Dạ, hệ thống đang bận xử lý nhiều yêu cầu, anh/chị vui lòng thử lại sau ít phút ạ."
+
+class LLMBusyError(Exception):
+    """Raised when the gateway backlog is full (load shedding)."""
+
+class LLMGateway:
+    """
+    Single entry point to Ollama for the whole process.
+    - One AsyncClient (one keep-alive httpx pool) per event loop.
+    - At most LLM_MAX_IN_FLIGHT generations run at once; the rest wait in a priority queue
+      (chat before classification before weather enrichment, FIFO within a priority).
+    - More than LLM_MAX_QUEUE waiters: new requests fail fast with LLMBusyError.
+    """
+    def __init__(self, max_in_flight: int = None, max_queue: int = None):
+        self.max_in_flight = max_in_flight or settings.LLM_MAX_IN_FLIGHT
+        self.max_queue = max_queue if max_queue is not None else settings.LLM_MAX_QUEUE
+        self.in_flight = 0
+        self._waiters = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._client = None
+        self._client_loop = None
+        self._loop = None
+        # Scripts without a server loop get their own blocking client (httpx.Client is thread-safe)
+        self._sync_client = None
+        self._sync_lock = threading.Lock()
+        self.metrics = {
+            name: {"requests": 0, "shed": 0, "errors": 0, "cancelled": 0, "waits_ms": deque(maxlen=1024), "max_wait_ms": 0.0}
+            for name in PRIORITY_NAMES.values()
+        }
+
+    @property
+    def client(self) -> ollama.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            self._client = ollama.AsyncClient(
+                host=settings.OLLAMA_HOST,
+                timeout=settings.LLM_TIMEOUT_SECONDS,
+                limits=httpx.Limits(
+                    max_connections=max(self.max_in_flight, settings.LLM_KEEPALIVE_CONNECTIONS),
+                    max_keepalive_connections=settings.LLM_KEEPALIVE_CONNECTIONS,
+                ),
+            )
+            self._client_loop = loop
+        return self._client
+
+    async def _acquire(self, priority: int):
+        m = self.metrics[PRIORITY_NAMES[priority]]
+        m["requests"] += 1
+        self._loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+        else:
+            if len(self._waiters) >= self.max_queue:
+                m["shed"] += 1
+                raise LLMBusyError("LLM backlog full")
+            fut = self._loop.create_future()
+            heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    # Slot was handed over just as we got cancelled: pass it on
+                    self._release()
+                else:
+                    self._waiters = [w for w in self._waiters if w[2] is not fut]
+                    heapq.heapify(self._waiters)
+                raise
+        wait_ms = (time.perf_counter() - started) * 1000
+        m["waits_ms"].append(wait_ms)
+        m["max_wait_ms"] = max(m["max_wait_ms"], wait_ms)
+
+    def _release(self):
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)  # slot transferred, in_flight unchanged
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_CHAT):
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def generate(self, prompt: str, options: dict, priority: int, raw: bool = False, **kwargs) -> dict:
+        kwargs.setdefault("keep_alive", settings.LLM_KEEP_ALIVE)
+        m = self.metrics[PRIORITY_NAMES[priority]]
+        try:
+            async with self.slot(priority):
+                return await self.client.generate(model=settings.MODEL_NAME, prompt=prompt, stream=False, options=options, raw=raw, **kwargs)
+        except asyncio.CancelledError:
+            m["cancelled"] += 1
+            raise
+        except LLMBusyError:
+            raise  # counted as shed
+        except Exception:
+            m["errors"] += 1
+            raise
+
+    async def stream(self, prompt: str, options: dict, priority: int = PRIORITY_CHAT, raw: bool = False, **kwargs) -> AsyncIterator[dict]:
+        """
+        Streaming generate; the slot is held until the stream is exhausted or closed.
+        keep_alive keeps the model (and its prompt KV cache) loaded between turns.
+        """
+        kwargs.setdefault("keep_alive", settings.LLM_KEEP_ALIVE)
+        m = self.metrics[PRIORITY_NAMES[priority]]
+        try:
+            async with self.slot(priority):
+                stream = await self.client.generate(model=settings.MODEL_NAME, prompt=prompt, stream=True, options=options, raw=raw, **kwargs)
+                async for part in stream:
+                    yield part
+        except (asyncio.CancelledError, GeneratorExit):
+            # Caller stopped reading (cancel / disconnect), also while still queued for a slot:
+            # leaving here closes the HTTP stream, Ollama aborts the generation and the slot is released
+            m["cancelled"] += 1
+            raise
+        except LLMBusyError:
+            raise  # counted as shed
+        except Exception:
+            m["errors"] += 1
+            raise
+
+    @property
+    def sync_client(self) -> ollama.Client:
+        if self._sync_client is None:
+            with self._sync_lock:
+                if self._sync_client is None:
+                    self._sync_client = ollama.Client(host=settings.OLLAMA_HOST, timeout=settings.LLM_TIMEOUT_SECONDS)
+        return self._sync_client
+
+    def generate_sync(self, prompt: str, options: dict, priority: int, raw: bool = False, timeout: float = None) -> dict:
+        """
+        Blocking bridge for worker threads and scripts. With a server loop the request goes
+        through generate() there (slots, priority, shedding); without one (scripts) it is a plain
+        call on sync_client, and the loop-bound client, queue and in_flight are left alone.
+        """
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is not None:
+            raise RuntimeError("generate_sync() called on an event loop, use await generate()")
+        if self._loop is not None and self._loop.is_running():
+            coro = self.generate(prompt, options, priority, raw)
+            return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout or settings.LLM_TIMEOUT_SECONDS)
+        return self.sync_client.generate(model=settings.MODEL_NAME, prompt=prompt, stream=False, options=options,
+                                         raw=raw, keep_alive=settings.LLM_KEEP_ALIVE)
+
+    def stats(self) -> dict:
+        out = {"in_flight": self.in_flight, "queued": len(self._waiters), "max_in_flight": self.max_in_flight, "max_queue": self.max_queue}
+        for name, m in self.metrics.items():
+            waits = sorted(m["waits_ms"])
+            pct = lambda p: round(waits[min(len(waits) - 1, int(round(p * (len(waits) - 1))))], 2) if waits else 0.0
+            out[name] = {
+                "requests": m["requests"],
+                "shed": m["shed"],
+                "errors": m["errors"],
+                "cancelled": m["cancelled"],
+                "wait_ms_p50": pct(0.5),
+                "wait_ms_p95": pct(0.95),
+                "wait_ms_max": round(m["max_wait_ms"], 2),
+            }
+        return out
+
+llm_gateway = LLMGateway()
 
 class LLMEngine:
     def __init__(self):
         self.model_name = settings.MODEL_NAME
-        self.client = ollama.AsyncClient()
+        self.gateway = llm_gateway
         self.model = True # Assume true, check later or let it fail gracefully
+        self.intent_cache = TTLCache(maxsize=settings.INTENT_CACHE_SIZE, ttl=settings.INTENT_CACHE_TTL_SECONDS)
+        self.intent_stats = {"requests": 0, "cache_hits": 0, "rule_hits": 0, "llm_calls": 0, "llm_errors": 0}
 
-    async def generate_stream(self, prompt: str, max_tokens: int = 4096) -> AsyncGenerator[dict, None]:
+    async def generate_stream(self, prompt: str, max_tokens: int = 4096, context: Optional[List[int]] = None) -> AsyncGenerator[dict, None]:
         """
         Generates response and yields sentences using Ollama Async.
+        The final item carries Ollama's timing/eval stats (and context) under "stats".
         """
         buffer = SentenceBuffer()
+        final_stats = None
         
         try:
-            # Stream from Ollama Async
-            stream = await self.client.generate(
-                model=self.model_name,
-                prompt=prompt,
-                stream=True,
+            # Stream from Ollama through the shared gateway (chat has top priority)
+            stream = self.gateway.stream(
+                prompt,
                 options={
                     "num_ctx": settings.N_CTX,
                     "temperature": settings.TEMPERATURE,
                     "num_predict": max_tokens,
                     "stop": ["<|im_end|>", "<|im_start|>", "User:", "\nUser"]
                 },
-                raw=True
+                priority=PRIORITY_CHAT,
+                raw=True,
+                **({"context": context} if context else {})
             )
 
-            async for output in stream:
-                token = output.get("response", "")
-                if not token:
-                    continue
-                sentences = buffer.add_token(token)
-                for sentence in sentences:
-                    yield {
-                        "sentence": sentence,
-                        "is_final": False
-                    }
+            async with aclosing(stream):
+                async for output in stream:
+                    if output.get("done"):
+                        final_stats = {k: output.get(k) for k in ("prompt_eval_count", "prompt_eval_duration", "eval_count", "eval_duration", "context")}
+                    token = output.get("response", "")
+                    if not token:
+                        continue
+                    sentences = buffer.add_token(token)
+                    for sentence in sentences:
+                        yield {
+                            "sentence": sentence,
+                            "is_final": False
+                        }
             
             # Flush remaining buffer
             final_sentence = buffer.flush()
@@ -55,6 +257,12 @@ class LLMEngine:
             # Signal completion
             yield {
                 "sentence": "",
+                "is_final": True,
+                "stats": final_stats
+            }
+        except LLMBusyError:
+            yield {
+                "sentence": BUSY_REPLY,
                 "is_final": True
             }
         except Exception as e:
@@ -70,11 +278,7 @@ class LLMEngine:
         """
         return True
     
-    def classify_intent(self, query: str) -> dict:
-        """
-        Use LLM to classify whether to search DB, RAG, or both.
-        Returns a dict: {"intent": "db_company"|"db_product"|"rag"|"mixed", "target_field": optional}
-        """
+    def _intent_prompt(self, query: str) -> str:
         instruction = (
             "Bạn là bộ phân loại truy vấn cho hệ thống tìm kiếm lai (DB + RAG). "
             "Phân loại câu hỏi dưới đây vào một trong các nhóm sau và trả về JSON:\n"
@@ -85,56 +289,132 @@ class LLMEngine:
             "Nếu db_product, hãy suy ra 'target_field' trong [ingredients, usage, code, url, category] nếu phù hợp, nếu không thì để null.\n"
             "CHỈ TRẢ VỀ JSON hợp lệ với các khóa: intent, target_field."
         )
-        prompt = f"<|im_start|>system\n{instruction}<|im_end|>\n<|im_start|>user\n{query}\n<|im_end|>\n<|im_start|>assistant\n"
+        return f"<|im_start|>system\n{instruction}<|im_end|>\n<|im_start|>user\n{query}\n<|im_end|>\n<|im_start|>assistant\n"
+
+    def _parse_intent(self, text: str) -> dict:
+        text = text.strip()
+        # Extract JSON block if present
+        if "{" in text and "}" in text:
+            start = text.find("{")
+            end = text.rfind("}") + 1
+            text = text[start:end]
+
+        # Try parse JSON from the response
+        # Some models may wrap JSON in code fences; strip them
+        if text.startswith("```"):
+            text = text.strip("` \n")
+            # after stripping backticks, there might be "json\n"
+            if text.lower().startswith("json"):
+                text = text[4:].strip()
+        data = json.loads(text)
+        intent = data.get("intent", "rag")
+        target_field = data.get("target_field")
+        return {"intent": intent, "target_field": target_field}
+
+    def rule_classify(self, query: str) -> Optional[dict]:
+        """
+        Keyword pre-pass. Returns a result only when exactly one keyword group matches,
+        otherwise None (ambiguous or unknown -> ask the LLM).
+        """
+        groups = intent_router.scan(normalize_query(query))
+        matches = []
+        if "classify:company" in groups:
+            matches.append({"intent": "db_company", "target_field": None})
+        fields = [field for field in DB_FIELD_KEYWORDS if f"field:{field}" in groups]
+        if len(fields) == 1:
+            matches.append({"intent": "db_product", "target_field": fields[0]})
+        elif len(fields) > 1:
+            return None
+        if "classify:rag" in groups:
+            matches.append({"intent": "rag", "target_field": None})
+        if len(matches) == 1:
+            return matches[0]
+        return None
+
+    def heuristic_classify(self, query: str) -> dict:
+        """
+        Fallback heuristic when the LLM is unavailable: first matching group wins.
+        """
+        groups = intent_router.scan(normalize_query(query))
+        if "classify:company" in groups:
+            return {"intent": "db_company", "target_field": None}
+        for field in DB_FIELD_KEYWORDS:
+            if f"field:{field}" in groups:
+                return {"intent": "db_product", "target_field": field}
+        return {"intent": "rag", "target_field": None}
+
+    def _classify_cached(self, key: str) -> Optional[dict]:
+        self.intent_stats["requests"] += 1
+        cached = self.intent_cache.get(key)
+        if cached is not None:
+            self.intent_stats["cache_hits"] += 1
+            return dict(cached)
+        ruled = self.rule_classify(key)
+        if ruled is not None:
+            self.intent_stats["rule_hits"] += 1
+            self.intent_cache.set(key, ruled)
+            return dict(ruled)
+        self.intent_stats["llm_calls"] += 1
+        return None
+
+    def classify_intent(self, query: str) -> dict:
+        """
+        Use LLM to classify whether to search DB, RAG, or both.
+        Returns a dict: {"intent": "db_company"|"db_product"|"rag"|"mixed", "target_field": optional}
+        Blocking version for scripts/worker threads; the websocket path uses aclassify_intent.
+        """
+        key = normalize_query(query)
+        result = self._classify_cached(key)
+        if result is not None:
+            return result
         try:
-            result = ollama.generate(
-                model=self.model_name,
-                prompt=prompt,
-                stream=False,
+            response = self.gateway.generate_sync(
+                self._intent_prompt(query),
                 options={
                     "temperature": settings.TEMPERATURE,
                     "stop": ["<|im_end|>"]
-                }
+                },
+                priority=PRIORITY_CLASSIFY
             )
-            text = result.get("response", "").strip()
-            
-            # Extract JSON block if present
-            if "{" in text and "}" in text:
-                start = text.find("{")
-                end = text.rfind("}") + 1
-                text = text[start:end]
-
-            # Try parse JSON from the response
-            # Some models may wrap JSON in code fences; strip them
-            if text.startswith("```"):
-                text = text.strip("` \n")
-                # after stripping backticks, there might be "json\n"
-                if text.lower().startswith("json"):
-                    text = text[4:].strip()
-            data = json.loads(text)
-            intent = data.get("intent", "rag")
-            target_field = data.get("target_field")
-            return {"intent": intent, "target_field": target_field}
+            result = self._parse_intent(response.get("response", ""))
+            self.intent_cache.set(key, result)
+            return dict(result)
         except Exception as e:
             print(f"LLM classify_intent error: {e}")
-            # Fallback simple heuristic
-            q = query.lower()
-            company_keywords = ["địa chỉ", "hotline", "số điện thoại", "sđt", "email", "liên hệ", "công ty", "ở đâu", "giấy phép", "mst", "mã số thuế", "nhà máy", "slogan", "tầm nhìn", "sứ mệnh"]
-            if any(kw in q for kw in company_keywords):
-                return {"intent": "db_company", "target_field": None}
-            db_keywords = {
-                "ingredients": ["thành phần", "chứa gì", "chất gì", "hàm lượng"],
-                "usage": ["liều lượng", "cách dùng", "hướng dẫn sử dụng", "sử dụng thế nào", "pha như thế nào", "tưới bao nhiêu"],
-                "code": ["mã sản phẩm", "sku", "mã số"],
-                "url": ["link", "đường dẫn", "website", "trang web"],
-                "category": ["loại gì", "nhóm nào", "danh mục"]
-            }
-            for field, keywords in db_keywords.items():
-                if any(kw in q for kw in keywords):
-                    return {"intent": "db_product", "target_field": field}
-            rag_keywords = ["công dụng", "tác dụng", "lợi ích", "mô tả", "là gì", "an toàn", "lưu ý", "độc hại", "có tốt không"]
-            if any(kw in q for kw in rag_keywords):
-                return {"intent": "rag", "target_field": None}
-            return {"intent": "rag", "target_field": None}
+            self.intent_stats["llm_errors"] += 1
+            return self.heuristic_classify(query)
+
+    async def aclassify_intent(self, query: str) -> dict:
+        """
+        Async classifier: cache -> keyword pre-pass -> Ollama (only for ambiguous queries).
+        """
+        key = normalize_query(query)
+        result = self._classify_cached(key)
+        if result is not None:
+            return result
+        try:
+            response = await self.gateway.generate(
+                self._intent_prompt(query),
+                options={
+                    "temperature": settings.TEMPERATURE,
+                    "stop": ["<|im_end|>"]
+                },
+                priority=PRIORITY_CLASSIFY
+            )
+            result = self._parse_intent(response.get("response", ""))
+            self.intent_cache.set(key, result)
+            return dict(result)
+        except Exception as e:
+            print(f"LLM classify_intent error: {e}")
+            self.intent_stats["llm_errors"] += 1
+            return self.heuristic_classify(query)
+
+    def get_intent_stats(self) -> dict:
+        stats = dict(self.intent_stats)
+        total = stats["requests"]
+        stats["cache_hit_rate"] = round(stats["cache_hits"] / total, 4) if total else 0.0
+        stats["llm_rate"] = round(stats["llm_calls"] / total, 4) if total else 0.0
+        stats["cache"] = self.intent_cache.stats()
+        return stats
 
 llm_engine = LLMEngine()
@@ -1,5 +1,3 @@
-import requests
-from bs4 import BeautifulSoup
 import random
 import datetime
 
@@ -93,6 +91,8 @@ class MarketPriceService:
         return table
 
     def _get_pepper_prices(self):
+        import requests
+        from bs4 import BeautifulSoup
         url = "https://giatieu.com/"
         try:
             resp = requests.get(url, headers=self.headers, timeout=5)
@@ -183,6 +183,7 @@ class MarketPriceService:
 
     # --- Realtime helpers ---
     def _clean_text(self, html):
+        from bs4 import BeautifulSoup
         try:
             soup = BeautifulSoup(html, 'html.parser')
             # Remove scripts/styles
@@ -199,6 +200,8 @@ class MarketPriceService:
         return re.findall(r"\d{1,3}(?:[.,]\d{3})", s)
 
     def _get_coffee_prices_rt(self):
+        import requests
+        from bs4 import BeautifulSoup
         # Use tag page on Baoquocte to get latest article that contains domestic coffee prices
         try:
             list_url = "https://baoquocte.vn/tag/gia-ca-phe-hom-nay-185757.tag"
@@ -239,6 +242,8 @@ class MarketPriceService:
         return self._get_coffee_prices_mock()
 
     def _get_rice_prices_rt(self):
+        import requests
+        from bs4 import BeautifulSoup
         # Pull latest article from Vietnambiz rice category, parse key varieties and ranges
         try:
             cat_url = "https://vietnambiz.vn/gia-gao.html"
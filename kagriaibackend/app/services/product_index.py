@@ -0,0 +1,56 @@
+import sqlite3
+import threading
+from typing import Dict, Optional
+from app.core.database import catalog_pool
+
+class ProductIndex:
+    """
+    Exact product-code lookup (code -> product row) for follow-ups on last_product_code.
+    Ranking is FTS5's job (hybrid_search); this is only a dict, built at startup and rebuilt
+    on the next lookup after invalidate() (crawler writes, and the response cache hook that
+    fires when kagri.db's data_version changes, e.g. scripts/import_db.py).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirty = True
+        self.by_code: Dict[str, dict] = {}
+
+    def invalidate(self, reason: str = None):
+        self._dirty = True
+
+    def build(self):
+        with self._lock:
+            self._build_locked()
+
+    def _build_locked(self):
+        # Clean before reading: an invalidate() that lands during the read triggers another rebuild
+        self._dirty = False
+        try:
+            rows = catalog_pool.connection().execute(
+                "SELECT code, name, url, ingredients, usage, category FROM products"
+            ).fetchall()
+        except sqlite3.Error as e:
+            print(f"Product code map build error: {e}")
+            self._dirty = True
+            return
+        by_code = {}
+        for r in rows:
+            code = (r["code"] or "").strip()
+            if code:
+                by_code.setdefault(code.lower(), dict(r))
+        self.by_code = by_code
+        print(f"Product code map built: {len(by_code)} products")
+
+    def get_by_code(self, code: str) -> Optional[dict]:
+        """
+        Exact code lookup (same semantics as the products.code UNIQUE index).
+        """
+        if not code:
+            return None
+        if self._dirty:
+            with self._lock:
+                if self._dirty:
+                    self._build_locked()
+        return self.by_code.get(code.strip().lower())
+
+product_index = ProductIndex()
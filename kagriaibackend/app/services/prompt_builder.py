@@ -0,0 +1,200 @@
+import hashlib
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional
+from app.core.config import settings
+from app.utils.cache import TTLCache
+from app.utils.tokens import token_counter
+
+# Fixed rules: byte-identical on every request, so it stays the first block of the prompt
+# and Ollama/llama.cpp reuses its KV cache instead of re-evaluating it each turn.
+SYSTEM_RULES = """Bạn là trợ lý AI chuyên nghiệp của công ty KAGRI (Công ty Cổ phần Tập đoàn Nông nghiệp KAGRI). 
+Nhiệm vụ của bạn là hỗ trợ khách hàng trả lời các câu hỏi về sản phẩm nông nghiệp, phân bón, kỹ thuật trồng trọt và thông tin công ty.
+
+QUY TẮC QUAN TRỌNG (BẮT BUỘC TUÂN THỦ):
+1. NGÔN NGỮ: TUYỆT ĐỐI CHỈ DÙNG TIẾNG VIỆT.
+2. PHONG CÁCH TRẢ LỜI:
+   - Thân thiện, mềm mại, lễ phép, tận tâm.
+   - Luôn dùng từ "Dạ" ở đầu câu và "ạ" ở cuối câu khi phù hợp để thể hiện sự tôn trọng (Ví dụ: "Dạ, số điện thoại của công ty là... ạ").
+   - Tránh dùng từ ngữ quá chuyên môn gây khó hiểu, diễn đạt tự nhiên như người thật.
+3. CHÍNH XÁC VÀ TRUNG THỰC (QUAN TRỌNG NHẤT):
+   - Với câu hỏi về CÔNG TY, SẢN PHẨM, CHUYÊN GIA: CHỈ được sử dụng thông tin có trong phần "CONTEXT".
+   - TUYỆT ĐỐI KHÔNG sử dụng kiến thức bên ngoài để trả lời về các chủ đề này.
+   - Nếu Context KHÔNG chứa thông tin: Hãy trả lời "Dạ, hiện tại em chưa tìm thấy thông tin này trong hệ thống dữ liệu của KAGRI. Mời anh/chị liên hệ hotline 0985 562 582 để được hỗ trợ chi tiết ạ."
+   - KHÔNG ĐƯỢC BỊA ĐẶT (Hallucinate) bất kỳ thông tin nào.
+4. XỬ LÝ CÂU HỎI VỀ CÔNG TY:
+   - Trình bày ĐẦY ĐỦ và CHI TIẾT thông tin từ Context (Tầm nhìn, Sứ mệnh, Giá trị cốt lõi...).
+   - Với số điện thoại/địa chỉ: Trả lời chính xác kèm lời dẫn lịch sự.
+5. Khi trả lời về thông tin CÔNG TY / SẢN PHẨM / CHUYÊN GIA: LUÔN kèm lời mời "Mời xem chi tiết tại: <URL>" sử dụng đúng URL có trong Context.
+6. Với câu hỏi về SẢN PHẨM CỤ THỂ: Trả lời ĐẦY ĐỦ các trường (Tên, Thành phần, Công dụng, Hướng dẫn sử dụng) nếu có trong Context.
+"""
+
+CONTEXT_HEADER = "THÔNG TIN ĐƯỢC CUNG CẤP (CONTEXT):\n"
+ASSISTANT_OPEN = "<|im_start|>assistant\n"
+# Context pieces shorter than this are dropped rather than cut
+MIN_SECTION_TOKENS = 48
+
+def count_tokens(text: str) -> int:
+    return token_counter.count(text)
+
+def _block(role: str, text: str) -> str:
+    return f"<|im_start|>{role}\n{text}<|im_end|>\n"
+
+SYSTEM_PREFIX = _block("system", SYSTEM_RULES)
+
+@dataclass
+class ChatPrompt:
+    text: str
+    prompt_tokens: int  # tokens of the full conversation the model sees
+    context: Optional[List[int]] = None  # previous Ollama context when continuing a session
+    continued: bool = False
+    head: int = 0
+    sections: Dict[str, int] = field(default_factory=dict)  # tokens spent per section
+    context_key: str = ""  # hash of the context block the model has seen
+
+class PromptBuilder:
+    """
+    Assembles ChatML prompts in cache-friendly order:
+    fixed system rules -> retrieved context -> history -> user message.
+    With PROMPT_CONTINUE_CONTEXT the previous turn's Ollama `context` is reused and only the
+    user message is sent, while the retrieved context is unchanged and the session stays under
+    PROMPT_CONTINUE_MAX_RATIO of N_CTX. A new context means a full rebuild, so stale context
+    blocks never pile up in the continued conversation.
+    """
+    def __init__(self):
+        self.continue_context = settings.PROMPT_CONTINUE_CONTEXT
+        self.contexts = TTLCache(maxsize=settings.PROMPT_CONTEXT_CACHE_SIZE, ttl=settings.SESSION_TTL_SECONDS)
+        self.log = settings.PROMPT_LOG
+        self.metrics = {"turns": 0, "continued": 0, "context_changed": 0, "prompt_tokens": 0, "evaluated_tokens": 0, "saved_tokens": 0, "prompt_eval_ms": 0.0}
+
+    def budget(self, max_new_tokens: int) -> int:
+        """Prompt tokens available: N_CTX minus the generation reserve."""
+        return settings.N_CTX - max_new_tokens - settings.PROMPT_SAFETY_TOKENS
+
+    def fit_context(self, context_text: str, sections: Optional[List[dict]], limit: int):
+        """
+        Keep the most valuable context sections (lowest rank) that fit in `limit` tokens,
+        cutting the first one that does not fit and dropping the rest. Original order is kept.
+        Returns (text, tokens, dropped_count).
+        """
+        if not sections:
+            sections = [{"text": context_text or "", "rank": 0}]
+        kept = {}
+        used = count_tokens(CONTEXT_HEADER)
+        dropped = 0
+        for i in sorted(range(len(sections)), key=lambda i: sections[i]["rank"]):
+            text = sections[i]["text"]
+            n = count_tokens(text) + 1
+            if used + n <= limit:
+                kept[i] = text
+                used += n
+            elif limit - used >= MIN_SECTION_TOKENS:
+                kept[i] = token_counter.truncate(text, limit - used - 1)
+                used += count_tokens(kept[i]) + 1
+            else:
+                dropped += 1
+        return "\n".join(kept[i] for i in sorted(kept)), used, dropped
+
+    def fit_history(self, turns: Iterable, limit: int):
+        """
+        Newest turns first; an older turn that does not fit keeps its user message and a
+        clipped answer (PROMPT_HISTORY_AI_CLIP tokens), otherwise it and all older turns are dropped.
+        Returns (text, tokens, kept_count, total_count).
+        """
+        turns = list(turns)
+        blocks = []
+        used = 0
+        for t in reversed(turns):
+            block = _block("user", t.user) + _block("assistant", t.ai)
+            n = count_tokens(block)
+            if used + n > limit:
+                block = _block("user", t.user) + _block("assistant", token_counter.truncate(t.ai, settings.PROMPT_HISTORY_AI_CLIP))
+                n = count_tokens(block)
+                if used + n > limit:
+                    break
+            blocks.append(block)
+            used += n
+        return "".join(reversed(blocks)), used, len(blocks), len(turns)
+
+    def build(self, session_id: str, context_text: str, turns: Iterable, user_text: str, head: int = 0,
+              sections: Optional[List[dict]] = None, max_new_tokens: int = None) -> ChatPrompt:
+        """
+        head is the session's next turn index after the current user turn was stored; the saved
+        Ollama context is only continued when no other turn (non-LLM handler, other worker) came between.
+        The token budget (N_CTX - max_new_tokens) goes to the system rules and the user message
+        first, then PROMPT_CONTEXT_SHARE of the rest to context and the remainder to history.
+        """
+        max_new_tokens = max_new_tokens or settings.PROMPT_MAX_NEW_TOKENS
+        budget = self.budget(max_new_tokens)
+        system_tokens = count_tokens(SYSTEM_PREFIX)
+        user_block = _block("user", token_counter.truncate(user_text, budget // 4)) + ASSISTANT_OPEN
+        user_tokens = count_tokens(user_block)
+        available = max(0, budget - system_tokens - user_tokens)
+
+        turns = list(turns)
+        history_need = sum(count_tokens(_block("user", t.user) + _block("assistant", t.ai)) for t in turns)
+        context_limit = max(int(available * settings.PROMPT_CONTEXT_SHARE), available - history_need)
+        context_body, context_tokens, dropped = self.fit_context(context_text, sections, context_limit)
+        context_block = _block("system", CONTEXT_HEADER + context_body)
+        context_tokens = count_tokens(context_block)
+        context_key = hashlib.sha1(context_block.encode("utf-8")).hexdigest()
+
+        saved = self.contexts.get(session_id) if self.continue_context else None
+        if saved and saved[0] == head - 1:
+            prev, prev_key = saved[1], saved[2]
+            if prev_key != context_key:
+                self.metrics["context_changed"] += 1
+            else:
+                # Previous context ends right after the answer (stop token is not included);
+                # the same context block is already in it, only the user message is new
+                delta = "<|im_end|>\n" + user_block
+                total = len(prev) + count_tokens(delta)
+                if total <= min(budget, int(settings.N_CTX * settings.PROMPT_CONTINUE_MAX_RATIO)):
+                    return ChatPrompt(text=delta, prompt_tokens=total, context=prev, continued=True, head=head,
+                                      sections={"continued": len(prev), "user": user_tokens}, context_key=context_key)
+
+        history, history_tokens, kept, total_turns = self.fit_history(turns, max(0, available - context_tokens))
+        text = SYSTEM_PREFIX + context_block + history + user_block
+        spent = {"system": system_tokens, "context": context_tokens, "history": history_tokens, "user": user_tokens}
+        prompt_tokens = sum(spent.values())
+        if self.log:
+            print(f"[Prompt] session={session_id} tokens system={system_tokens} context={context_tokens} (dropped {dropped}) "
+                  f"history={history_tokens} ({kept}/{total_turns} turns) user={user_tokens} total={prompt_tokens}/{budget}"
+                  f"{'' if token_counter.exact else ' (estimated)'}")
+        return ChatPrompt(text=text, prompt_tokens=prompt_tokens, head=head, sections=spent, context_key=context_key)
+
+    def record(self, session_id: str, prompt: ChatPrompt, stats: Optional[dict]):
+        """
+        Account prompt-eval work from Ollama's final stream chunk (prompt_eval_count counts only
+        tokens that were not served from the KV cache) and keep the context for continuation.
+        """
+        if not stats:
+            return
+        evaluated = int(stats.get("prompt_eval_count") or 0)
+        saved = max(0, prompt.prompt_tokens - evaluated)
+        eval_ms = (stats.get("prompt_eval_duration") or 0) / 1e6
+        m = self.metrics
+        m["turns"] += 1
+        m["continued"] += int(prompt.continued)
+        m["prompt_tokens"] += prompt.prompt_tokens
+        m["evaluated_tokens"] += evaluated
+        m["saved_tokens"] += saved
+        m["prompt_eval_ms"] += eval_ms
+        if self.log:
+            print(f"[Prompt] session={session_id} prompt≈{prompt.prompt_tokens} evaluated={evaluated} saved≈{saved} prompt_eval={eval_ms:.0f}ms continued={prompt.continued}")
+        if self.continue_context and stats.get("context"):
+            self.contexts.set(session_id, (prompt.head, list(stats["context"]), prompt.context_key))
+
+    def forget(self, session_id: str):
+        self.contexts.pop(session_id)
+
+    def stats(self) -> dict:
+        m = dict(self.metrics)
+        turns = m["turns"]
+        m["prompt_eval_ms"] = round(m["prompt_eval_ms"], 1)
+        m["avg_saved_tokens"] = round(m["saved_tokens"] / turns, 1) if turns else 0.0
+        m["saved_ratio"] = round(m["saved_tokens"] / m["prompt_tokens"], 4) if m["prompt_tokens"] else 0.0
+        m["system_prefix_tokens"] = count_tokens(SYSTEM_PREFIX)
+        m["tokenizer"] = token_counter.name if token_counter.exact else "estimate"
+        return m
+
+prompt_builder = PromptBuilder()
@@ -1,13 +1,9 @@
 import os
+import threading
 from typing import List
-from langchain_community.document_loaders import DirectoryLoader, TextLoader
-try:
-    from langchain.text_splitter import RecursiveCharacterTextSplitter
-except ImportError:
-    from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
 from app.core.config import settings
+from app.services.embedding_service import embedding_service
+from app.services.vector_store import MmapVectorStore
 import hashlib
 import json
 
@@ -17,26 +13,49 @@ class RAGEngine:
         self.embeddings = None
         self.meta_path = os.path.join(settings.VECTOR_STORE_PATH, "meta.json")
         self.manifest = {"files": {}}
+        # Guards the lazy load and (re)builds: several cpu-pool threads hit ensure_initialized
+        # on the first requests. Reentrant because load_or_create_index may call rebuild_index.
+        self._index_lock = threading.RLock()
         # Lazy initialization to avoid blocking server startup
         try:
             self.manifest = self._load_manifest()
         except Exception:
             self.manifest = {"files": {}}
     
-    def ensure_initialized(self):
+    def ensure_embeddings(self):
+        # One SentenceTransformer per process, shared with the batched query embedding service
         if self.embeddings is None:
-            self.embeddings = HuggingFaceEmbeddings(model_name=settings.EMBEDDING_MODEL)
+            self.embeddings = embedding_service.ensure_model()
+        return self.embeddings
+
+    def ensure_initialized(self):
+        self.ensure_embeddings()
         if self.vector_store is None:
-            self.load_or_create_index()
+            with self._index_lock:
+                if self.vector_store is None:
+                    self.load_or_create_index()
+
+    def embed_query(self, text: str) -> List[float]:
+        """Micro-batched and cached (embedding_service)."""
+        return embedding_service.embed(text)
 
     def load_or_create_index(self):
-        if os.path.exists(os.path.join(settings.VECTOR_STORE_PATH, "index.faiss")):
+        with self._index_lock:
+            self._load_or_create_index()
+
+    def _load_or_create_index(self):
+        if MmapVectorStore.exists(settings.VECTOR_STORE_PATH):
             print("Loading existing vector store...")
-            self.vector_store = FAISS.load_local(
-                settings.VECTOR_STORE_PATH, 
-                self.embeddings,
-                allow_dangerous_deserialization=True
-            )
+            try:
+                self.vector_store = MmapVectorStore.load(settings.VECTOR_STORE_PATH)
+                return
+            except Exception as e:
+                print(f"Vector store unreadable ({e}). Rebuilding from docs...")
+                self.rebuild_index()
+        elif os.path.exists(os.path.join(settings.VECTOR_STORE_PATH, "index.faiss")):
+            # Old langchain layout (index.pkl): never unpickled, re-embedded into the new format
+            print("Legacy pickle vector store found. Rebuilding from docs...")
+            self.rebuild_index()
         else:
             print("Vector store not found. Creating new one from docs...")
             self.build_index()
@@ -49,8 +68,17 @@ class RAGEngine:
             return {"files": {}}  # path -> sha1
 
     def build_index(self):
-        if self.embeddings is None:
-            self.embeddings = HuggingFaceEmbeddings(model_name=settings.EMBEDDING_MODEL)
+        with self._index_lock:
+            self._build_index()
+
+    def _build_index(self):
+        # langchain loaders/splitters are only needed when (re)indexing
+        from langchain_community.document_loaders import DirectoryLoader, TextLoader
+        try:
+            from langchain.text_splitter import RecursiveCharacterTextSplitter
+        except ImportError:
+            from langchain_text_splitters import RecursiveCharacterTextSplitter
+        self.ensure_embeddings()
         if not os.path.exists(settings.DOCS_PATH):
             os.makedirs(settings.DOCS_PATH)
             # Maybe trigger crawler here or warn
@@ -98,12 +126,21 @@ class RAGEngine:
             return
         
         texts = text_splitter.split_documents(docs_to_process)
+        if not texts:
+            print("No chunks to embed.")
+            return
         
-        if self.vector_store:
-            self.vector_store.add_documents(texts)
+        contents = [doc.page_content for doc in texts]
+        metadatas = [doc.metadata for doc in texts]
+        vectors = self.embeddings.embed_documents(contents)
+        # Append to the index on disk (scripts call build_index without loading it first)
+        if self.vector_store is None and MmapVectorStore.exists(settings.VECTOR_STORE_PATH):
+            self.vector_store = MmapVectorStore.load(settings.VECTOR_STORE_PATH)
+        if self.vector_store is not None:
+            self.vector_store.add(contents, metadatas, vectors)
         else:
-            self.vector_store = FAISS.from_documents(texts, self.embeddings)
-        self.vector_store.save_local(settings.VECTOR_STORE_PATH)
+            self.vector_store = MmapVectorStore.from_texts(contents, metadatas, vectors)
+        self.vector_store.save(settings.VECTOR_STORE_PATH)
         
         # Update manifest
         for doc in docs_to_process:
@@ -129,26 +166,25 @@ class RAGEngine:
         if not self.vector_store:
             return []
         
-        docs = self.vector_store.similarity_search(query, k=k)
+        docs = self.vector_store.similarity_search_by_vector(self.embed_query(query), k=k)
         return [doc.page_content for doc in docs]
 
     def search_with_score(self, query: str, k: int = 3):
         self.ensure_initialized()
         if not self.vector_store:
             return []
-        return self.vector_store.similarity_search_with_score(query, k=k)
+        return self.vector_store.similarity_search_with_score_by_vector(self.embed_query(query), k=k)
     
     def rebuild_index(self):
         """
         Force rebuild: remove existing index and manifest, then build from filtered docs.
         """
+        with self._index_lock:
+            self._rebuild_index()
+
+    def _rebuild_index(self):
         try:
-            faiss_path = os.path.join(settings.VECTOR_STORE_PATH, "index.faiss")
-            pkl_path = os.path.join(settings.VECTOR_STORE_PATH, "index.pkl")
-            if os.path.exists(faiss_path):
-                os.remove(faiss_path)
-            if os.path.exists(pkl_path):
-                os.remove(pkl_path)
+            MmapVectorStore.remove(settings.VECTOR_STORE_PATH)
             if os.path.exists(self.meta_path):
                 os.remove(self.meta_path)
             self.vector_store = None
@@ -0,0 +1,177 @@
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional
+import numpy as np
+from app.core.config import settings
+from app.core.database import DB_PATH
+from app.core.executors import executors
+from app.services.llm_engine import normalize_query
+from app.services.embedding_service import embedding_service
+
+def context_hash(context_text: str, history: Optional[Iterable] = None) -> str:
+    """Scope of an answer: the retrieved context plus the turns (user/ai) the prompt carries."""
+    h = hashlib.sha1((context_text or "").encode("utf-8"))
+    for turn in history or ():
+        h.update(b"\x1e" + turn.user.encode("utf-8") + b"\x1f" + turn.ai.encode("utf-8"))
+    return h.hexdigest()
+
+class CachedAnswer:
+    __slots__ = ("key", "scope", "vector", "sentences", "expires_at", "hits")
+
+    def __init__(self, key: int, scope: str, vector: np.ndarray, sentences: List[str], expires_at: float):
+        self.key = key
+        self.scope = scope
+        self.vector = vector
+        self.sentences = sentences
+        self.expires_at = expires_at
+        self.hits = 0
+
+class CacheLookup:
+    """Result of lookup(): the hit (if any) plus what store() needs on a miss."""
+    __slots__ = ("answer", "scope", "vector", "similarity")
+
+    def __init__(self, answer: Optional[CachedAnswer], scope: str, vector: Optional[np.ndarray], similarity: float):
+        self.answer = answer
+        self.scope = scope
+        self.vector = vector
+        self.similarity = similarity
+
+class SemanticResponseCache:
+    """
+    Cache of generated answers keyed by query embedding (embedding_service, same model as RAG),
+    matched by cosine similarity >= RESPONSE_CACHE_SIMILARITY and scoped to a hash of the
+    retrieved context and the conversation window: if products/company/experts data changes,
+    the context (and its hash) changes too, so an old answer is never replayed for new data,
+    and a follow-up ("còn giá thì sao?") only matches answers given after the same history.
+    Entries expire after RESPONSE_CACHE_TTL_SECONDS, the least recently used go first when full.
+    Invalidation: invalidate() from data writers (crawler), automatically when kagri.db's
+    PRAGMA data_version changes (scripts/import_db.py etc.), and any hooks added with add_hook().
+    """
+    def __init__(self, maxsize: int = None, ttl: float = None, threshold: float = None):
+        self.enabled = settings.RESPONSE_CACHE_ENABLED
+        self.maxsize = maxsize or settings.RESPONSE_CACHE_SIZE
+        self.ttl = ttl or settings.RESPONSE_CACHE_TTL_SECONDS
+        self.threshold = threshold or settings.RESPONSE_CACHE_SIMILARITY
+        self._entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self._scopes: Dict[str, List[int]] = {}
+        self._next_key = 0
+        self._lock = threading.Lock()
+        # PRAGMA data_version is per connection, so one shared connection keeps one baseline;
+        # _version_lock serializes it across cpu-pool threads (and its lazy creation)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._data_version = None
+        self._version_lock = threading.Lock()
+        self._hooks: List[Callable[[str], None]] = []
+        self.counters = {"lookups": 0, "hits": 0, "stores": 0, "invalidations": 0, "evictions": 0}
+
+    # --- Invalidation ---
+    def add_hook(self, fn: Callable[[str], None]):
+        """fn(reason) runs on every invalidate(), e.g. to drop derived caches."""
+        self._hooks.append(fn)
+
+    def invalidate(self, reason: str = "manual"):
+        with self._lock:
+            self._entries.clear()
+            self._scopes.clear()
+        self.counters["invalidations"] += 1
+        print(f"Response cache invalidated ({reason})")
+        for fn in self._hooks:
+            try:
+                fn(reason)
+            except Exception as e:
+                print(f"Response cache hook error: {e}")
+
+    def _check_catalog_version(self):
+        with self._version_lock:
+            try:
+                if self._conn is None:
+                    self._conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+                version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            except sqlite3.Error:
+                return
+            changed = self._data_version is not None and version != self._data_version
+            self._data_version = version
+        if changed:
+            self.invalidate("kagri.db changed")
+
+    # --- Storage ---
+    def _remove(self, key: int):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            keys = self._scopes.get(entry.scope)
+            if keys:
+                keys.remove(key)
+                if not keys:
+                    del self._scopes[entry.scope]
+
+    def _lookup_sync(self, embedding: List[float], scope: str) -> CacheLookup:
+        self._check_catalog_version()
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        vector = vector / norm if norm else vector
+        now = time.monotonic()
+        best, best_sim = None, 0.0
+        with self._lock:
+            for key in list(self._scopes.get(scope, [])):
+                entry = self._entries[key]
+                if entry.expires_at < now:
+                    self._remove(key)
+                    continue
+                sim = float(np.dot(entry.vector, vector))
+                if sim > best_sim:
+                    best, best_sim = entry, sim
+            if best is not None and best_sim >= self.threshold:
+                self._entries.move_to_end(best.key)
+                best.hits += 1
+            else:
+                best = None
+        return CacheLookup(best, scope, vector, best_sim)
+
+    async def lookup(self, query: str, context_text: str, history: Optional[Iterable] = None) -> Optional[CacheLookup]:
+        """
+        Embed the query (batched embedding_service) and search entries with the same scope
+        (context + history turns, see context_hash).
+        Returns None when the cache is disabled or the embedding model is unavailable.
+        """
+        if not self.enabled or not context_text:
+            return None
+        self.counters["lookups"] += 1
+        try:
+            embedding = await embedding_service.aembed(normalize_query(query))
+            result = await executors.run_cpu(self._lookup_sync, embedding, context_hash(context_text, history))
+        except Exception as e:
+            print(f"Response cache lookup error: {e}")
+            return None
+        if result.answer is not None:
+            self.counters["hits"] += 1
+        return result
+
+    def store(self, lookup: Optional[CacheLookup], sentences: List[str]):
+        if lookup is None or lookup.vector is None or not sentences:
+            return
+        with self._lock:
+            key = self._next_key
+            self._next_key += 1
+            self._entries[key] = CachedAnswer(key, lookup.scope, lookup.vector, list(sentences), time.monotonic() + self.ttl)
+            self._scopes.setdefault(lookup.scope, []).append(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.counters["evictions"] += 1
+        self.counters["stores"] += 1
+
+    def stats(self) -> dict:
+        lookups = self.counters["lookups"]
+        return {
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "scopes": len(self._scopes),
+            "maxsize": self.maxsize,
+            "threshold": self.threshold,
+            "hit_rate": round(self.counters["hits"] / lookups, 4) if lookups else 0.0,
+            **self.counters,
+        }
+
+response_cache = SemanticResponseCache()
@@ -1,6 +1,5 @@
 import datetime
 import pytz
-from lunarcalendar import Converter, Solar, Lunar
 
 class TimeService:
     def __init__(self):
@@ -34,6 +33,7 @@ class TimeService:
         gregorian_date = f"ngày {day} tháng {month} năm {year}"
         
         # 5. Lunar Date
+        from lunarcalendar import Converter, Solar
         solar = Solar(year, month, day)
         lunar = Converter.Solar2Lunar(solar)
         lunar_day = lunar.day
@@ -60,6 +60,7 @@ class TimeService:
         try:
             import re
             import datetime as dt
+            from lunarcalendar import Converter, Solar, Lunar
             cleaned = date_str.strip().replace(" ", "/").replace("-", "/").replace(".", "/")
             nums = re.findall(r"\d{1,4}", cleaned)
             if len(nums) < 3:
@@ -0,0 +1,212 @@
+import os
+import json
+import mmap
+from typing import List, Optional, Tuple
+import numpy as np
+from app.core.config import settings
+
+# On-disk layout (VECTOR_STORE_PATH):
+#   index.faiss          FAISS index, opened with IO_FLAG_MMAP (pages shared by every worker)
+#   docstore.jsonl       one {"text", "metadata"} JSON object per vector row
+#   docstore.offsets.npy int64 byte offsets of each line (+ end), np.load(mmap_mode="r")
+INDEX_FILE = "index.faiss"
+DOCS_FILE = "docstore.jsonl"
+OFFSETS_FILE = "docstore.offsets.npy"
+LEGACY_FILES = ["index.pkl"]  # langchain FAISS.save_local pickle, no longer read
+
+class Chunk:
+    """Search hit, same attribute names as a langchain Document."""
+    __slots__ = ("page_content", "metadata")
+
+    def __init__(self, page_content: str, metadata: dict):
+        self.page_content = page_content
+        self.metadata = metadata
+
+INDEX_TYPES = ("flat", "hnsw", "hnsw_sq8", "ivfpq")
+
+def index_kind(index) -> str:
+    import faiss
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw_sq8" if isinstance(index, faiss.IndexHNSWSQ) else "hnsw"
+    if faiss.try_extract_index_ivf(index) is not None:
+        return "ivfpq"
+    return "flat"
+
+def target_kind(count: int, kind: str = None, min_ann: int = None) -> str:
+    """Index type for a store of count chunks: the configured ANN type once past the threshold."""
+    kind = (kind or settings.VECTOR_INDEX_TYPE).lower()
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown VECTOR_INDEX_TYPE '{kind}' (expected one of {', '.join(INDEX_TYPES)})")
+    min_ann = settings.VECTOR_INDEX_ANN_MIN_CHUNKS if min_ann is None else min_ann
+    return kind if count >= min_ann else "flat"
+
+def _pq_m(dim: int) -> int:
+    if settings.PQ_M:
+        return settings.PQ_M
+    m = max(1, dim // 8)
+    while dim % m:
+        m -= 1
+    return m
+
+def make_index(matrix: np.ndarray, kind: str):
+    """Empty-or-trained FAISS index (L2, like the langchain default) for the vectors in matrix."""
+    import faiss
+    count, dim = matrix.shape
+    if kind == "flat":
+        return faiss.IndexFlatL2(dim)
+    if kind in ("hnsw", "hnsw_sq8"):
+        index = faiss.IndexHNSWFlat(dim, settings.HNSW_M) if kind == "hnsw" else \
+            faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, settings.HNSW_M)
+        index.hnsw.efConstruction = settings.HNSW_EF_CONSTRUCTION
+    elif kind == "ivfpq":
+        # k-means needs ~39 points per list; PQ codebooks need 256 points
+        nlist = settings.IVF_NLIST or int(4 * count ** 0.5)
+        nlist = max(1, min(nlist, count // 39))
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, nlist, _pq_m(dim), 8)
+    else:
+        raise ValueError(f"Unknown index type '{kind}'")
+    if not index.is_trained:
+        index.train(matrix)
+    return index
+
+def configure_search(index, ef_search: int = None, nprobe: int = None):
+    """Query-time knobs (not stored in index.faiss): HNSW efSearch, IVF nprobe."""
+    import faiss
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search or settings.HNSW_EF_SEARCH
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe or settings.IVF_NPROBE, ivf.nlist)
+    return index
+
+def _mmap_flags(index_path: str) -> int:
+    """
+    IVF indexes map their inverted lists with IO_FLAG_MMAP; flat/HNSW storage needs
+    IO_FLAG_MMAP_IFC (faiss >= 1.10). The two readers cannot be combined, so pick by the
+    fourcc at the start of index.faiss ("Iv.." = IVF family).
+    """
+    import faiss
+    with open(index_path, "rb") as f:
+        fourcc = f.read(4)
+    ifc = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    if fourcc.startswith(b"Iv") or not ifc:
+        return faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    return ifc | faiss.IO_FLAG_READ_ONLY
+
+class MmapVectorStore:
+    """
+    FAISS index + JSONL docstore without pickle. load() maps both files read-only, so N
+    worker processes share the same page-cache pages and startup does not read the whole
+    index. save() writes temp files and os.replace()s them: readers that already mapped the
+    old files keep a consistent view until they reload.
+    """
+    def __init__(self, index, blob, offsets: np.ndarray, path: Optional[str] = None):
+        self.index = index
+        self._blob = blob          # bytes or mmap of docstore.jsonl
+        self._offsets = offsets    # len == index.ntotal + 1
+        self.path = path           # set when the index is mapped from disk (read-only)
+
+    # --- Persistence ---
+    @staticmethod
+    def exists(path: str) -> bool:
+        return all(os.path.exists(os.path.join(path, name)) for name in (INDEX_FILE, DOCS_FILE, OFFSETS_FILE))
+
+    @classmethod
+    def load(cls, path: str, use_mmap: bool = None) -> "MmapVectorStore":
+        import faiss
+        use_mmap = settings.VECTOR_STORE_MMAP if use_mmap is None else use_mmap
+        index_path = os.path.join(path, INDEX_FILE)
+        flags = _mmap_flags(index_path) if use_mmap else 0
+        index = configure_search(faiss.read_index(index_path, flags))
+        offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r" if use_mmap else None)
+        with open(os.path.join(path, DOCS_FILE), "rb") as f:
+            if use_mmap and os.fstat(f.fileno()).st_size > 0:
+                blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                blob = f.read()
+        if len(offsets) != index.ntotal + 1 or int(offsets[-1]) != len(blob):
+            raise ValueError(f"Vector store at {path} is inconsistent ({index.ntotal} vectors, {len(offsets) - 1} docs)")
+        return cls(index, blob, offsets, path if use_mmap else None)
+
+    def save(self, path: str):
+        import faiss
+        os.makedirs(path, exist_ok=True)
+        targets = {name: os.path.join(path, name) for name in (DOCS_FILE, OFFSETS_FILE, INDEX_FILE)}
+        tmp = {name: target + ".tmp" for name, target in targets.items()}
+        with open(tmp[DOCS_FILE], "wb") as f:
+            f.write(self._blob[:])
+        with open(tmp[OFFSETS_FILE], "wb") as f:
+            np.save(f, np.asarray(self._offsets, dtype=np.int64))
+        faiss.write_index(self.index, tmp[INDEX_FILE])
+        for name in (DOCS_FILE, OFFSETS_FILE, INDEX_FILE):
+            os.replace(tmp[name], targets[name])
+
+    @staticmethod
+    def remove(path: str):
+        for name in [INDEX_FILE, DOCS_FILE, OFFSETS_FILE] + LEGACY_FILES:
+            file_path = os.path.join(path, name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    # --- Build ---
+    @staticmethod
+    def _encode(texts: List[str], metadatas: List[dict]) -> Tuple[bytes, List[int]]:
+        lines = [
+            (json.dumps({"text": text, "metadata": meta or {}}, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+            for text, meta in zip(texts, metadatas)
+        ]
+        lengths = [len(line) for line in lines]
+        return b"".join(lines), lengths
+
+    @classmethod
+    def from_texts(cls, texts: List[str], metadatas: List[dict], vectors, kind: str = None) -> "MmapVectorStore":
+        matrix = np.asarray(vectors, dtype=np.float32)
+        index = configure_search(make_index(matrix, target_kind(len(matrix), kind)))
+        store = cls(index, b"", np.zeros(1, dtype=np.int64))
+        store.add(texts, metadatas, matrix, kind)
+        return store
+
+    @property
+    def kind(self) -> str:
+        return index_kind(self.index)
+
+    def add(self, texts: List[str], metadatas: List[dict], vectors, kind: str = None):
+        if self.path is not None:
+            # A mapped index is read-only: load a private in-memory copy before writing
+            import faiss
+            self.index = configure_search(faiss.read_index(os.path.join(self.path, INDEX_FILE)))
+            self._blob = bytes(self._blob[:])
+            self._offsets = np.array(self._offsets, dtype=np.int64)
+            self.path = None
+        matrix = np.asarray(vectors, dtype=np.float32)
+        target = target_kind(self.index.ntotal + len(matrix), kind)
+        if self.kind == "flat" and target != "flat" and self.index.ntotal:
+            # Crossed the ANN threshold: train the new index on every vector (flat stores them exactly)
+            everything = np.vstack([self.index.reconstruct_n(0, self.index.ntotal), matrix])
+            index = configure_search(make_index(everything, target))
+            index.add(everything)
+            self.index = index
+            print(f"Vector index switched to {target} ({len(everything)} chunks)")
+        else:
+            self.index.add(matrix)
+        blob, lengths = self._encode(texts, metadatas)
+        self._offsets = np.concatenate([self._offsets, self._offsets[-1] + np.cumsum(lengths, dtype=np.int64)])
+        self._blob = bytes(self._blob[:]) + blob
+
+    # --- Query ---
+    def __len__(self) -> int:
+        return self.index.ntotal
+
+    def get(self, row: int) -> Chunk:
+        record = json.loads(self._blob[int(self._offsets[row]):int(self._offsets[row + 1])])
+        return Chunk(record["text"], record.get("metadata") or {})
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4) -> List[Tuple[Chunk, float]]:
+        if self.index.ntotal == 0:
+            return []
+        query = np.asarray([embedding], dtype=np.float32)
+        scores, rows = self.index.search(query, min(k, self.index.ntotal))
+        return [(self.get(int(row)), float(score)) for row, score in zip(rows[0], scores[0]) if row >= 0]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4) -> List[Chunk]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k)]
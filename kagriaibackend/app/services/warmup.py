@@ -0,0 +1,99 @@
+import time
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional
+from app.core.config import settings
+from app.core.executors import executors
+from app.services.embedding_service import embedding_service
+from app.services.rag_engine import rag_engine
+from app.services.llm_engine import llm_gateway, PRIORITY_CLASSIFY
+from app.services.prompt_builder import SYSTEM_PREFIX
+from app.utils.tokens import token_counter
+
+WARMUP_TEXT = "khởi động"
+
+class WarmupManager:
+    """
+    Startup warm-up: load and exercise every model once, in parallel, before the first user does.
+    - embeddings: one encode through embedding_service (loads the SentenceTransformer)
+    - faiss: load the index and run one query
+    - yolo: one dummy predict per loaded model, where diagnose() will run
+    - tokenizer: the chat model's HF tokenizer used for prompt token budgets (may hit the hub)
+    - ollama: load the model with the chat num_ctx and prefill the system prefix (keep_alive)
+    A failed component is reported but does not block readiness; /api/kagriai/ready flips
+    once every component has finished.
+    """
+    def __init__(self):
+        self.components: Dict[str, Callable[[], Awaitable]] = {
+            "embeddings": self._embeddings,
+            "faiss": self._faiss,
+            "yolo": self._yolo,
+            "tokenizer": self._tokenizer,
+            "ollama": self._ollama,
+        }
+        self.results: Dict[str, dict] = {name: {"status": "pending"} for name in self.components}
+        self.ready = False
+        self.started_at: Optional[float] = None
+        self.total_ms: Optional[float] = None
+
+    async def _embeddings(self):
+        vector = await executors.run_cpu(embedding_service.embed, WARMUP_TEXT)
+        return {"dim": len(vector)}
+
+    async def _faiss(self):
+        def query():
+            rag_engine.ensure_initialized()
+            return len(rag_engine.search(WARMUP_TEXT, k=1))
+        return {"hits": await executors.run_cpu(query)}
+
+    async def _yolo(self):
+        return {"models": await executors.warmup_diagnosis()}
+
+    async def _tokenizer(self):
+        return {"exact": await executors.run_cpu(token_counter.load)}
+
+    async def _ollama(self):
+        # Same num_ctx as chat, otherwise Ollama reloads the model on the first real request
+        res = await llm_gateway.generate(
+            SYSTEM_PREFIX,
+            options={"num_ctx": settings.N_CTX, "num_predict": 1},
+            priority=PRIORITY_CLASSIFY,
+            raw=True,
+        )
+        return {"load_ms": round((res.get("load_duration") or 0) / 1e6, 1)}
+
+    async def _run_one(self, name: str):
+        self.results[name] = {"status": "running"}
+        started = time.perf_counter()
+        try:
+            detail = await self.components[name]()
+            self.results[name] = {"status": "ok", "ms": round((time.perf_counter() - started) * 1000, 1), **(detail or {})}
+        except Exception as e:
+            self.results[name] = {"status": "error", "ms": round((time.perf_counter() - started) * 1000, 1), "error": str(e)}
+            print(f"Warm-up '{name}' failed: {e}")
+
+    async def run(self):
+        self.started_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(self._run_one(name) for name in self.components)),
+                timeout=settings.WARMUP_TIMEOUT_SECONDS,
+            )
+        except asyncio.TimeoutError:
+            for name, result in self.results.items():
+                if result["status"] in ("pending", "running"):
+                    self.results[name] = {"status": "timeout"}
+        self.total_ms = round((time.perf_counter() - self.started_at) * 1000, 1)
+        self.ready = True
+        timings = ", ".join(f"{name}={r.get('ms', '-')}ms ({r['status']})" for name, r in self.results.items())
+        print(f"Warm-up done in {self.total_ms}ms: {timings}")
+
+    def skip(self):
+        for name in self.components:
+            self.results[name] = {"status": "skipped"}
+        self.total_ms = 0.0
+        self.ready = True
+
+    def stats(self) -> dict:
+        return {"ready": self.ready, "total_ms": self.total_ms, "components": dict(self.results)}
+
+warmup = WarmupManager()
@@ -1,7 +1,7 @@
 import json
 from typing import List, Dict, Any
 from app.core.config import settings
-import ollama
+from app.services.llm_engine import llm_gateway, LLMBusyError, PRIORITY_WEATHER
 
 def _dedup(items: List[str]) -> List[str]:
     seen = set()
@@ -15,7 +15,7 @@ def _dedup(items: List[str]) -> List[str]:
             out.append(t)
     return out
 
-def enrich(items: List[Dict[str, Any]]) -> Dict[str, Any]:
+async def enrich(items: List[Dict[str, Any]]) -> Dict[str, Any]:
     relevant = []
     for x in items:
         st = str(x.get("status", "") or "").upper()
@@ -91,13 +91,13 @@ def enrich(items: List[Dict[str, Any]]) -> Dict[str, Any]:
         + "Chỉ trả về JSON hợp lệ:"
     )
     try:
-        result = ollama.generate(
-            model=settings.MODEL_NAME,
-            prompt=prompt,
-            stream=False,
+        # Lowest priority on the shared gateway: chat turns go first
+        result = await llm_gateway.generate(
+            prompt,
             options={
                 "temperature": settings.TEMPERATURE
-            }
+            },
+            priority=PRIORITY_WEATHER
         )
         text = str(result.get("response", "") or "").strip()
         if "{" in text and "}" in text:
@@ -114,6 +114,8 @@ def enrich(items: List[Dict[str, Any]]) -> Dict[str, Any]:
             recommendations_out = data["data"].get("recommendations")
             if isinstance(warnings_out, list) and isinstance(recommendations_out, list):
                 return {"data": {"warnings": warnings_out, "recommendations": recommendations_out}}
+    except LLMBusyError:
+        print("Weather enrich shed (LLM busy), returning seed warnings/recommendations")
     except Exception:
         pass
     warnings_out = [{"id": i + 1, "description": w} for i, w in enumerate(warnings_seed) if w]
@@ -0,0 +1,76 @@
+import json
+import asyncio
+from typing import List, Optional, Union
+from starlette.websockets import WebSocket, WebSocketState
+from app.core.config import settings
+
+def encode_frame(payload: dict) -> str:
+    # Compact, non-escaped UTF-8: Vietnamese text is ~3x smaller than with \uXXXX escapes
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
+def client_pace_ms(*sources) -> int:
+    """First valid pace_ms from the given sources (message, connection query), else STREAM_PACE_MS."""
+    for value in sources:
+        if value is None or value == "":
+            continue
+        try:
+            return max(0, int(value))
+        except (TypeError, ValueError):
+            continue
+    return settings.STREAM_PACE_MS
+
+async def stream_text(websocket: Union[WebSocket, "ClientConnection"], request_id: str, text: Union[str, List[str]],
+                      pace_ms: Optional[int] = None, chunk_chars: Optional[int] = None,
+                      start: bool = True, end: bool = True) -> str:
+    """
+    Send a ready answer as start -> stream -> end frames and return the full text.
+    Without pacing (default) the whole answer goes out as a single stream frame, written straight
+    to the socket back to back. Clients that want a typing effect ask for pace_ms; the text is then
+    cut into chunk_chars frames with that delay between them.
+    A list of sentences (cached LLM answer) is replayed as one stream frame per sentence, the
+    same framing as the live answer, with pace_ms between them when set.
+    websocket may be a raw WebSocket or chatws.ClientConnection (queued writer with backpressure).
+    """
+    full = "".join(text) if isinstance(text, list) else (text or "")
+    pace_ms = settings.STREAM_PACE_MS if pace_ms is None else pace_ms
+    chunk_chars = chunk_chars or settings.STREAM_PACE_CHARS
+    if isinstance(text, list):
+        chunks = [sentence for sentence in text if sentence]
+    elif pace_ms > 0:
+        chunks = [full[i:i + chunk_chars] for i in range(0, len(full), chunk_chars)]
+    else:
+        chunks = [full] if full else []
+
+    try:
+        if websocket.client_state != WebSocketState.CONNECTED:
+            return full
+        if start:
+            await websocket.send_text(encode_frame({"type": "start", "id": request_id}))
+        for i, chunk in enumerate(chunks):
+            if i and pace_ms > 0:
+                await asyncio.sleep(pace_ms / 1000.0)
+            await websocket.send_text(encode_frame({"type": "stream", "content": chunk, "id": request_id}))
+        if end:
+            await websocket.send_text(encode_frame({"type": "end", "id": request_id}))
+    except Exception as e:
+        print(f"stream_text error (ignored): {e}")
+    return full
+
+class ReplyStream:
+    """
+    Incremental answer on one request id: "start" before the first chunk, one stream frame per
+    chunk (stream_text, same pacing rules), "end" on close().
+    """
+    def __init__(self, websocket, request_id: str, pace_ms: Optional[int] = None):
+        self.websocket = websocket
+        self.request_id = request_id
+        self.pace_ms = pace_ms
+        self.started = False
+
+    async def write(self, text: str):
+        await stream_text(self.websocket, self.request_id, text, pace_ms=self.pace_ms, start=not self.started, end=False)
+        self.started = True
+
+    async def close(self):
+        if self.started:
+            await stream_text(self.websocket, self.request_id, "", start=False, end=True)
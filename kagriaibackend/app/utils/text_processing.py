@@ -1,38 +1,116 @@
 import re
+import time
+import unicodedata
 from typing import Generator, List
+from app.core.config import settings
+
+# A sentence ends at ., !, ? or a newline followed by whitespace; matched on small windows only
+_SENTENCE_END = re.compile(r'(?<=[.!?\n])\s')
+
+FLUSH_POLICIES = ("sentence", "chars", "latency")
 
 class SentenceBuffer:
-    def __init__(self):
-        self.buffer = ""
-        # Regex for sentence endings: ., !, ?, or newlines, followed by space or end of string
-        self.sentence_end_pattern = re.compile(r'(?<=[.!?\n])\s+')
+    """
+    Incremental stream chunker for LLM tokens.
+    Each token is scanned once (plus one char of lookbehind) and kept in a list, so long runs
+    without punctuation (markdown tables, lists) stay linear instead of re-searching the whole buffer.
+    Flush policies:
+      - "sentence": one chunk per sentence; pending text longer than max_chars is cut at the last
+        line break (or space).
+      - "chars": coalesce into chunks of >= max_chars, cut at the last sentence end (or space).
+      - "latency": one chunk per sentence, plus pending words once the oldest is max_latency_ms old
+        (checked when a token arrives).
+    """
+    def __init__(self, policy: str = None, max_chars: int = None, max_latency_ms: float = None, clock=time.monotonic):
+        self.policy = (policy or settings.STREAM_FLUSH_POLICY).lower()
+        if self.policy not in FLUSH_POLICIES:
+            raise ValueError(f"Unknown flush policy '{self.policy}' (choose from {', '.join(FLUSH_POLICIES)})")
+        self.max_chars = max_chars or settings.STREAM_FLUSH_CHARS
+        self.max_latency = (max_latency_ms if max_latency_ms is not None else settings.STREAM_FLUSH_MS) / 1000.0
+        self.clock = clock
+        self._parts: List[str] = []
+        self._head = 0          # stream offset of the first pending char
+        self._end = 0           # stream offset after the last token
+        self._tail = ""         # last char seen, for the lookbehind
+        self._boundary = -1     # stream offset of the last sentence end not yet flushed ("chars")
+        self._at_start = True   # pending text starts a new sentence (strip leading whitespace)
+        self._since = None      # clock() when the oldest pending char arrived
+
+    @property
+    def buffer(self) -> str:
+        return "".join(self._parts)
+
+    def _cut(self, offset: int, sentence_end: bool) -> str:
+        pending = "".join(self._parts)
+        n = offset - self._head
+        chunk, rest = pending[:n], pending[n:]
+        self._parts = [rest] if rest else []
+        self._head = offset
+        if self._at_start:
+            chunk = chunk.lstrip()
+        if sentence_end:
+            chunk = chunk.rstrip()
+        self._at_start = sentence_end
+        self._since = self.clock() if rest else None
+        return chunk
+
+    def _cut_at_space(self, force: bool) -> str:
+        pending = "".join(self._parts)
+        # Prefer a line break so markdown table rows / list items stay whole
+        pos = pending.rfind("\n")
+        if pos <= 0:
+            pos = pending.rfind(" ")
+        if pos > 0:
+            return self._cut(self._head + pos + 1, False)
+        return self._cut(self._end, False) if force else ""
 
     def add_token(self, token: str) -> List[str]:
         """
-        Adds a token to the buffer and returns a list of completed sentences.
+        Adds a token to the buffer and returns a list of completed chunks.
         """
-        self.buffer += token
-        sentences = []
-        
-        while True:
-            match = self.sentence_end_pattern.search(self.buffer)
-            if match:
-                end_pos = match.end()
-                sentence = self.buffer[:end_pos].strip()
-                if sentence:
-                    sentences.append(sentence)
-                self.buffer = self.buffer[end_pos:]
+        if not token:
+            return []
+        if self._since is None:
+            self._since = self.clock()
+        window = self._tail + token
+        base = self._end - len(self._tail)
+        self._parts.append(token)
+        self._end += len(token)
+        self._tail = token[-1]
+
+        chunks = []
+        for match in _SENTENCE_END.finditer(window):
+            offset = base + match.end()
+            if offset <= self._head:
+                continue
+            if self.policy == "chars":
+                self._boundary = offset
             else:
-                break
-        
-        return sentences
+                chunks.append(self._cut(offset, True))
+
+        pending = self._end - self._head
+        if self.policy == "chars":
+            if pending >= self.max_chars:
+                if self._boundary > self._head:
+                    chunks.append(self._cut(self._boundary, True))
+                else:
+                    chunks.append(self._cut_at_space(True))
+        elif pending >= self.max_chars:
+            chunks.append(self._cut_at_space(True))
+        elif self.policy == "latency" and pending and self.clock() - self._since >= self.max_latency:
+            chunks.append(self._cut_at_space(False))
+        return [c for c in chunks if c]
 
     def flush(self) -> str:
         """
-        Returns the remaining content in the buffer as the final sentence.
+        Returns the remaining content in the buffer as the final chunk.
         """
-        remaining = self.buffer.strip()
-        self.buffer = ""
+        remaining = "".join(self._parts).strip()
+        self._parts = []
+        self._head = self._end
+        self._boundary = -1
+        self._at_start = True
+        self._since = None
         return remaining
 
 def clean_text(text: str) -> str:
@@ -40,3 +118,20 @@ def clean_text(text: str) -> str:
     Basic text cleaning.
     """
     return text.strip()
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+def fold_diacritics(text: str) -> str:
+    """
+    Remove Vietnamese diacritics: "Đồng" -> "Dong".
+    """
+    text = (text or "").replace("đ", "d").replace("Đ", "D")
+    decomposed = unicodedata.normalize("NFD", text)
+    return "".join(ch for ch in decomposed if unicodedata.category(ch) != "Mn")
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercase word tokens (underscores split too, so product codes tokenize like names).
+    """
+    text = unicodedata.normalize("NFC", (text or "").lower().replace("_", " "))
+    return [t for t in _WORD_RE.findall(text) if t]
@@ -0,0 +1,78 @@
+import threading
+from typing import List, Optional
+from app.core.config import settings
+from app.utils.cache import TTLCache
+
+class TokenCounter:
+    """
+    Token counts with the chat model's tokenizer (HF tokenizer for TOKENIZER_NAME, loaded on
+    first use), cached per text so history turns and context chunks are only encoded once.
+    Falls back to a ~3 chars/token estimate when the tokenizer cannot be loaded.
+    Loading can hit the HF hub: it belongs in the startup warm-up, and callers on the event
+    loop go through executors.run_cpu (prompt_builder.build).
+    """
+    CHARS_PER_TOKEN = 3
+
+    def __init__(self, name: str = None):
+        self.name = name or settings.TOKENIZER_NAME
+        self._tokenizer = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        # Fast tokenizers are not safe for concurrent use from several cpu-pool threads ("Already borrowed")
+        self._encode_lock = threading.Lock()
+        self.cache = TTLCache(maxsize=settings.PROMPT_TOKEN_CACHE_SIZE, ttl=settings.SESSION_TTL_SECONDS)
+
+    @property
+    def tokenizer(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    try:
+                        from transformers import AutoTokenizer
+                        self._tokenizer = AutoTokenizer.from_pretrained(self.name)
+                        print(f"Tokenizer loaded: {self.name}")
+                    except Exception as e:
+                        print(f"Tokenizer {self.name} unavailable, using estimate: {e}")
+                    self._loaded = True
+        return self._tokenizer
+
+    @property
+    def exact(self) -> bool:
+        return self.tokenizer is not None
+
+    def load(self) -> bool:
+        """Warm-up hook: load the tokenizer now; True when counts are exact."""
+        return self.exact
+
+    def encode(self, text: str) -> Optional[List[int]]:
+        tok = self.tokenizer
+        if tok is None:
+            return None
+        with self._encode_lock:
+            return tok.encode(text, add_special_tokens=False)
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        cached = self.cache.get(text)
+        if cached is not None:
+            return cached
+        ids = self.encode(text)
+        n = len(ids) if ids is not None else (len(text) + self.CHARS_PER_TOKEN - 1) // self.CHARS_PER_TOKEN
+        self.cache.set(text, n)
+        return n
+
+    def truncate(self, text: str, max_tokens: int, suffix: str = "…") -> str:
+        """Cut text to at most max_tokens tokens (suffix included)."""
+        if max_tokens <= 0:
+            return ""
+        if self.count(text) <= max_tokens:
+            return text
+        keep = max(0, max_tokens - self.count(suffix))
+        ids = self.encode(text)
+        if ids is not None:
+            with self._encode_lock:
+                return self.tokenizer.decode(ids[:keep]) + suffix
+        return text[:keep * self.CHARS_PER_TOKEN] + suffix
+
+token_counter = TokenCounter()
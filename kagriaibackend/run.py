@@ -7,5 +7,13 @@ def to_bool(x: str) -> bool:
 if __name__ == "__main__":
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "8000"))
-    reload_flag = to_bool(os.getenv("RELOAD", "1"))
-    uvicorn.run("app.main:app", host=host, port=port, reload=reload_flag)
+    # Production: WORKERS=N starts N processes sharing session state through SESSION_BACKEND (chat.db)
+    workers = int(os.getenv("WORKERS", "1"))
+    reload_flag = to_bool(os.getenv("RELOAD", "1" if workers == 1 else "0"))
+    if workers > 1 and reload_flag:
+        print("RELOAD is not supported with WORKERS > 1, starting without reload")
+        reload_flag = False
+    # permessage-deflate for websocket frames (negotiated with clients that support it)
+    ws_compression = to_bool(os.getenv("WS_COMPRESSION", "1"))
+    uvicorn.run("app.main:app", host=host, port=port, reload=reload_flag, workers=workers,
+                ws_per_message_deflate=ws_compression)
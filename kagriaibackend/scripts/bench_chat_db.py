@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+import threading
+
+# Ensure KagriAI root is in sys.path
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from app.core import database
+from app.core.db_pool import SQLitePool
+
+# Micro-benchmark: chat turns/second (append_user_turn + update_ai_turn) with concurrent writers.
+# "legacy" reproduces the old connect-per-call helpers on a rollback-journal database,
+# "pooled" uses the WAL SQLitePool helpers from app.core.database.
+
+def legacy_connect(path):
+    conn = sqlite3.connect(path, timeout=5.0)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def legacy_append_user_turn(path, session_id, user):
+    conn = legacy_connect(path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO chat_sessions (session_id, last_product_code, created_at, updated_at)
+        VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+        ON CONFLICT(session_id) DO UPDATE SET updated_at=CURRENT_TIMESTAMP
+    ''', (session_id, None))
+    row = cursor.execute('SELECT COALESCE(MAX(turn_index), -1) + 1 AS next_idx FROM chat_turns WHERE session_id = ?', (session_id,)).fetchone()
+    next_idx = row["next_idx"]
+    cursor.execute('INSERT INTO chat_turns (session_id, turn_index, user, ai, user_image_path) VALUES (?, ?, ?, ?, ?)',
+                   (session_id, next_idx, user, "", None))
+    conn.commit()
+    conn.close()
+    return next_idx
+
+def legacy_update_ai_turn(path, session_id, turn_index, ai):
+    conn = legacy_connect(path)
+    conn.execute('UPDATE chat_turns SET ai = ? WHERE session_id = ? AND turn_index = ?', (ai, session_id, turn_index))
+    conn.commit()
+    conn.close()
+
+def run_mode(mode: str, writers: int, seconds: float, path: str):
+    database.CHAT_DB_PATH = path
+    database.chat_pool = SQLitePool(path)
+    if mode == "legacy":
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+    database.init_chat_db()
+    counts = [0] * writers
+    errors = [0] * writers
+    stop = time.perf_counter() + seconds
+    answer = "Dạ, " + "nội dung trả lời mẫu " * 40
+
+    def worker(i):
+        sid = f"bench-{i}"
+        while time.perf_counter() < stop:
+            try:
+                if mode == "legacy":
+                    idx = legacy_append_user_turn(path, sid, "câu hỏi")
+                    legacy_update_ai_turn(path, sid, idx, answer)
+                else:
+                    idx = database.append_user_turn(sid, "câu hỏi")
+                    database.update_ai_turn(sid, idx, answer)
+                counts[i] += 1
+            except sqlite3.OperationalError:
+                errors[i] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    database.chat_pool.close_all()
+    total = sum(counts)
+    print(f"{mode:7s} writers={writers:3d} turns/s={total / seconds:9.1f} lock_errors={sum(errors)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--writers", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--seconds", type=float, default=3.0)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        for writers in args.writers:
+            for mode in ("legacy", "pooled"):
+                run_mode(mode, writers, args.seconds, os.path.join(tmp, f"{mode}-{writers}.db"))
@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+
+# Ensure KagriAI root is in sys.path
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from app.services.embedding_service import EmbeddingService
+
+# Query embedding throughput on CPU with N concurrent sessions (threads, like the cpu pool).
+# "direct" is the old path: every query runs its own embed_query forward pass.
+# "batched" goes through EmbeddingService (micro-batching worker). Queries are unique unless
+# --repeat-ratio > 0, so the vector cache only helps when asked to.
+
+QUESTIONS = [
+    "sầu riêng bị thán thư phải xử lý thế nào",
+    "cách bón phân cho cà phê giai đoạn nuôi trái",
+    "rệp sáp hại rễ hồ tiêu dùng thuốc gì",
+    "cây có múi bị vàng lá gân xanh",
+    "liều lượng phun phân bón lá cho lúa đẻ nhánh",
+    "phòng bệnh nấm hồng trên sầu riêng mùa mưa",
+    "xì mủ thân sầu riêng điều trị ra sao",
+    "bọ trĩ hại đọt non xoài",
+]
+
+def run(embed, sessions, seconds, repeat_ratio):
+    latencies, lock = [], threading.Lock()
+    stop_at = time.perf_counter() + seconds
+    counter = iter(range(10 ** 9))
+
+    def session(seed):
+        rnd = random.Random(seed)
+        local = []
+        while time.perf_counter() < stop_at:
+            base = rnd.choice(QUESTIONS)
+            query = base if rnd.random() < repeat_ratio else f"{base} {next(counter)}"
+            started = time.perf_counter()
+            embed(query)
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(sessions)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    pct = lambda p: latencies[min(len(latencies) - 1, int(round(p * (len(latencies) - 1))))] * 1000 if latencies else 0.0
+    return len(latencies) / elapsed, pct(0.5), pct(0.99)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--window-ms", type=float, default=5.0)
+    parser.add_argument("--max-batch", type=int, default=32)
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="share of repeated (cacheable) queries")
+    args = parser.parse_args()
+
+    service = EmbeddingService(window_ms=args.window_ms, max_batch=args.max_batch)
+    model = service.ensure_model()
+    model.embed_query("khởi động")  # load weights before timing
+
+    for n in args.sessions:
+        qps, p50, p99 = run(model.embed_query, n, args.seconds, args.repeat_ratio)
+        print(f"sessions={n:<3} direct   {qps:8.1f} q/s  p50={p50:7.1f} ms  p99={p99:7.1f} ms")
+        service.cache.clear()
+        before = dict(service.counters)
+        qps, p50, p99 = run(service.embed, n, args.seconds, args.repeat_ratio)
+        batches = service.counters["batches"] - before["batches"]
+        encoded = service.counters["encoded"] - before["encoded"]
+        avg = encoded / batches if batches else 0.0
+        print(f"sessions={n:<3} batched  {qps:8.1f} q/s  p50={p50:7.1f} ms  p99={p99:7.1f} ms  avg_batch={avg:.1f}")
+    print(service.stats()["batch_size_histogram"])
+    service.stop()
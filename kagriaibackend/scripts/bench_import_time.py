@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+# KagriAI root: entry points are imported from here
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Import cost of the entry points, measured in a fresh interpreter with `python -X importtime`.
+# Heavy ML/scraping libraries must load on first use or in the startup warm-up
+# (app/services/warmup.py), never at import. With --check the run fails if one of them is
+# imported or an entry point goes over --budget-ms.
+
+TARGETS = [
+    "app.main",                   # uvicorn worker
+    "ingest",                     # crawl + reindex script
+    "app.services.crawler",
+    "app.core.database",          # scripts/update_experts.py, import_db.py, ...
+    "app.core.executors",         # process pool worker initializer
+]
+
+HEAVY = [
+    "torch", "ultralytics", "cv2", "sentence_transformers", "transformers", "faiss",
+    "langchain_community", "langchain_huggingface", "langchain", "langchain_text_splitters",
+    "bs4", "requests", "lunarcalendar",
+]
+
+def measure(module: str):
+    """Returns (wall_ms, total_us, rows) where rows are (self_us, cumulative_us, depth, name)."""
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BASE_DIR, capture_output=True, text=True,
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit {proc.returncode}")
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    total_us = sum(cum for _, cum, depth, _ in rows if depth == 0)
+    return wall_ms, total_us, rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", nargs="*", default=TARGETS)
+    parser.add_argument("--budget-ms", type=float, default=1000.0, help="max cumulative import time per entry point")
+    parser.add_argument("--top", type=int, default=8, help="slowest modules (self time) to list")
+    parser.add_argument("--check", action="store_true", help="fail on heavy imports or budget overrun")
+    args = parser.parse_args()
+
+    failures = 0
+    for module in args.modules:
+        try:
+            wall_ms, total_us, rows = measure(module)
+        except RuntimeError as e:
+            failures += 1
+            print(f"{module:<24} IMPORT FAILED: {e}")
+            continue
+        loaded = {name.split(".")[0] for _, _, _, name in rows}
+        heavy = [m for m in HEAVY if m in loaded]
+        over = total_us / 1000 > args.budget_ms
+        if heavy or over:
+            failures += 1
+        print(f"{module:<24} imports={total_us / 1000:8.1f} ms  process={wall_ms:8.1f} ms  modules={len(rows)}"
+              + (f"  OVER BUDGET ({args.budget_ms:.0f} ms)" if over else ""))
+        if heavy:
+            print(f"  heavy at import: {', '.join(heavy)}")
+        for self_us, cumulative_us, _, name in sorted(rows, reverse=True)[:args.top]:
+            print(f"  {self_us / 1000:7.1f} ms self  {cumulative_us / 1000:8.1f} ms cumulative  {name}")
+
+    if args.check and failures:
+        sys.exit(1)
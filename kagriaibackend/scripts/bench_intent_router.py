@@ -0,0 +1,99 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+
+# Ensure KagriAI root is in sys.path
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from app.services.intent_router import intent_router
+
+# Routing cost per message: "legacy" reproduces the old chatws cascade of any(k in lower_data ...)
+# scans (lower_data recomputed per handler) plus the build_context keyword scans; "router" is
+# intent_router.route(). With --check, every labelled message in the corpus must route to its
+# label (first fast-path intent, "chat" = LLM pipeline) and agree with the legacy cascade.
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_routing_corpus.jsonl")
+
+def legacy_route(user_text: str) -> str:
+    lower_data = user_text.lower().strip()
+    time_keywords = ["mấy giờ", "ngày bao nhiêu", "hôm nay là", "thời gian", "ngày mấy", "giờ nào"]
+    lunar_keywords = ["âm lịch", "lịch âm", "ngày âm", "hôm nay âm", "hôm nay âm lịch"]
+    is_time_query = any(k in lower_data for k in time_keywords) or any(k in lower_data for k in lunar_keywords)
+    nums = re.findall(r"\d{1,4}", lower_data)
+    am_keywords = ["âm", "am"]
+    duong_keywords = ["dương", "duong"]
+    convert_keywords = ["chuyển", "chuyen", "đổi", "doi", "convert", "->", "sang", "bao nhiêu dương", "bao nhieu duong", "là ngày dương", "la ngay duong", "thứ mấy", "thu may", "thứ"]
+    has_am = any(k in lower_data for k in am_keywords)
+    has_duong = any(k in lower_data for k in duong_keywords)
+    has_convert_kw = any(k in lower_data for k in convert_keywords)
+    if len(nums) >= 3 and (has_convert_kw or (has_am and has_duong)):
+        return "convert_date"
+    if is_time_query:
+        return "time"
+    lower_data = user_text.lower().strip()
+    diagnose_keywords = ["chẩn đoán", "chẩn đoán bệnh", "chẩn đoán bệnh cây trồng", "chẩn đoán qua ảnh", "chan doan", "chan doan benh", "chan doan qua anh"]
+    if any(k in lower_data for k in diagnose_keywords):
+        return "diagnose_guide"
+    lower_data = user_text.lower().strip()
+    price_keywords = ["giá nông sản", "giá cà phê", "giá tiêu", "giá lúa", "giá gạo", "giá thóc", "giá sầu riêng", "giá heo", "giá lợn"]
+    if any(k in lower_data for k in price_keywords):
+        return "market_price"
+    lower_data = user_text.lower().strip()
+    product_intent_keywords = ["các sản phẩm", "danh sách sản phẩm", "sản phẩm của công ty", "tất cả sản phẩm", "sản phẩm đang có"]
+    if any(k in lower_data for k in product_intent_keywords):
+        return "product_list"
+    if "sản phẩm" in lower_data and any(x in lower_data for x in ["bao nhiêu", "tổng số", "liệt kê", "giới thiệu", "nào", "gì"]):
+        return "product_list"
+    # get_context keyword scans
+    query = user_text
+    _ = "chuyên gia" in query.lower() or "bác sĩ" in query.lower()
+    _ = "tư vấn" in query.lower() and "sản phẩm" in query.lower()
+    company_keywords = ["địa chỉ", "hotline", "số điện thoại", "sdt", "liên hệ", "công ty", "ở đâu", "website", "email", "trụ sở", "văn phòng"]
+    _ = any(kw in query.lower() for kw in company_keywords)
+    _ = "kagri" in query.lower()
+    return "chat"
+
+def load_corpus(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def bench(name, fn, texts, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            fn(text)
+    per_msg = (time.perf_counter() - started) / (repeat * len(texts)) * 1e6
+    print(f"  {name:<8} {per_msg:8.2f} us/message")
+    return per_msg
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--check", action="store_true", help="fail if any labelled message routes wrong")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    texts = [row["text"] for row in corpus]
+
+    errors = 0
+    for row in corpus:
+        got = intent_router.route(row["text"]).intent
+        legacy = legacy_route(row["text"])
+        if got != row["intent"] or got != legacy:
+            errors += 1
+            print(f"  MISMATCH {row['text']!r}: label={row['intent']} router={got} legacy={legacy}")
+    print(f"{len(corpus)} labelled messages, {errors} mismatches")
+
+    print("routing cost:")
+    legacy_us = bench("legacy", legacy_route, texts, args.repeat)
+    router_us = bench("router", intent_router.route, texts, args.repeat)
+    print(f"  speedup  {legacy_us / router_us:8.2f}x")
+
+    if args.check and errors:
+        sys.exit(1)
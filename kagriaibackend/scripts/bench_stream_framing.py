@@ -0,0 +1,111 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+
+# Ensure KagriAI root is in sys.path
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from app.utils.text_processing import SentenceBuffer, FLUSH_POLICIES
+
+# Micro-benchmark: cost per token, websocket frames and first-frame delay of the stream chunker.
+# "legacy" reproduces the old string-append + whole-buffer regex SentenceBuffer.
+# Token streams come from --tokens (JSONL, one recorded stream per line: a list of tokens or
+# {"tokens": [...]}) or from the built-in samples (prose, markdown table, bullet list).
+
+class LegacySentenceBuffer:
+    def __init__(self):
+        self.buffer = ""
+        self.sentence_end_pattern = re.compile(r'(?<=[.!?\n])\s+')
+
+    def add_token(self, token):
+        self.buffer += token
+        sentences = []
+        while True:
+            match = self.sentence_end_pattern.search(self.buffer)
+            if not match:
+                break
+            sentence = self.buffer[:match.end()].strip()
+            if sentence:
+                sentences.append(sentence)
+            self.buffer = self.buffer[match.end():]
+        return sentences
+
+    def flush(self):
+        remaining = self.buffer.strip()
+        self.buffer = ""
+        return remaining
+
+PROSE = ("Dạ, sầu riêng giai đoạn nuôi trái cần bổ sung kali và canxi để trái chắc, cơm vàng đẹp. "
+         "Anh/chị nên bón phân theo từng đợt nhỏ, tưới đủ ẩm trước khi bón! Có cần em gợi ý sản phẩm không? ") * 6
+TABLE = "| Mã | Tên sản phẩm | Giá | Đơn vị |\n|---|---|---|---|\n" + "".join(
+    f"| KG{i:03d} | Phân bón lá cao cấp số {i} | {120 + i}000 | chai 500ml |\n" for i in range(60))
+BULLETS = "".join(f"- Bước {i}: phun ướt đều hai mặt lá, lặp lại sau 7 ngày nếu còn bệnh\n" for i in range(40))
+
+def tokenize_sample(text, size=4):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+def load_streams(path):
+    if not path:
+        return {"prose": tokenize_sample(PROSE), "table": tokenize_sample(TABLE), "bullets": tokenize_sample(BULLETS)}
+    streams = {}
+    with open(path, encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            line = line.strip()
+            if line:
+                item = json.loads(line)
+                streams[f"recorded-{i}"] = item["tokens"] if isinstance(item, dict) else item
+    return streams
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def run_stream(make_buffer, tokens, token_ms):
+    clock = FakeClock()
+    buf = make_buffer(clock)
+    frames, first = 0, None
+    for i, token in enumerate(tokens):
+        clock.now += token_ms / 1000.0
+        chunks = buf.add_token(token)
+        if chunks:
+            frames += len(chunks)
+            if first is None:
+                first = i + 1
+    if buf.flush():
+        frames += 1
+        if first is None:
+            first = len(tokens)
+    return frames, first or 0
+
+def bench(name, make_buffer, tokens, repeat, token_ms):
+    frames, first = run_stream(make_buffer, tokens, token_ms)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        run_stream(make_buffer, tokens, token_ms)
+    per_token = (time.perf_counter() - started) / (repeat * len(tokens)) * 1e6
+    print(f"  {name:<10} {per_token:8.2f} us/token  frames={frames:<4} first_frame_after={first} tokens (~{first * token_ms:.0f} ms)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", help="JSONL file of recorded token streams")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--token-ms", type=float, default=25.0, help="simulated inter-token delay")
+    parser.add_argument("--max-chars", type=int, default=240)
+    parser.add_argument("--max-latency-ms", type=float, default=120.0)
+    args = parser.parse_args()
+
+    for stream_name, tokens in load_streams(args.tokens).items():
+        size = sum(len(t) for t in tokens)
+        print(f"{stream_name}: {len(tokens)} tokens, {size} chars")
+        bench("legacy", lambda clock: LegacySentenceBuffer(), tokens, args.repeat, args.token_ms)
+        for policy in FLUSH_POLICIES:
+            bench(policy, lambda clock, p=policy: SentenceBuffer(p, args.max_chars, args.max_latency_ms, clock=clock),
+                  tokens, args.repeat, args.token_ms)
@@ -0,0 +1,101 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+# Ensure KagriAI root is in sys.path
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+from app.core.config import settings
+from app.services.vector_store import MmapVectorStore, configure_search, make_index
+from bench_embeddings import QUESTIONS
+
+# Recall@k and per-query latency of the ANN index types against the flat (exact) baseline,
+# on the chunks of our own vector store (data/vector_store, built by ingest.py).
+# --scale N grows the corpus to N vectors with jittered copies of the real chunks, to see
+# where flat search stops being cheap once handbooks are ingested (the ANN threshold is
+# VECTOR_INDEX_ANN_MIN_CHUNKS). Queries are the chat questions below, embedded with the
+# production model; --query-source docs uses jittered chunk vectors instead (no model needed).
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_routing_corpus.jsonl")
+
+def load_vectors(store: MmapVectorStore) -> np.ndarray:
+    if store.kind == "flat":
+        return store.index.reconstruct_n(0, store.index.ntotal)
+    # ANN indexes may not keep exact vectors: re-embed the chunk texts
+    from app.services.embedding_service import embedding_service
+    texts = [store.get(i).page_content for i in range(len(store))]
+    return np.asarray(embedding_service.ensure_model().embed_documents(texts), dtype=np.float32)
+
+def load_queries(source: str, base: np.ndarray, count: int, rng) -> np.ndarray:
+    if source == "docs":
+        picks = base[rng.choice(len(base), size=count)]
+        return (picks + rng.normal(0, picks.std() * 0.1, picks.shape)).astype(np.float32)
+    from app.services.embedding_service import embedding_service
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        texts = QUESTIONS + [json.loads(line)["text"] for line in f if line.strip()]
+    return np.asarray(embedding_service.ensure_model().embed_documents(texts[:count]), dtype=np.float32)
+
+def scale(base: np.ndarray, size: int, rng) -> np.ndarray:
+    if size <= len(base):
+        return base
+    extra = base[rng.choice(len(base), size=size - len(base))]
+    extra = extra + rng.normal(0, base.std() * 0.05, extra.shape)
+    return np.vstack([base, extra.astype(np.float32)])
+
+def measure(index, queries: np.ndarray, k: int, truth: np.ndarray):
+    latencies, recall = [], 0.0
+    for i, query in enumerate(queries):
+        started = time.perf_counter()
+        _, rows = index.search(query[None, :], k)  # one query per call, like rag_engine.search
+        latencies.append((time.perf_counter() - started) * 1000)
+        recall += len(set(rows[0]) & set(truth[i])) / k
+    latencies.sort()
+    pct = lambda p: latencies[min(len(latencies) - 1, int(round(p * (len(latencies) - 1))))]
+    return recall / len(queries), pct(0.5), pct(0.99)
+
+def size_mb(index) -> float:
+    import faiss
+    return faiss.serialize_index(index).nbytes / 2 ** 20
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", default=settings.VECTOR_STORE_PATH)
+    parser.add_argument("--scale", type=int, default=0, help="grow the corpus to this many vectors (synthetic)")
+    parser.add_argument("--k", type=int, default=3, help="rag_engine.search uses k=3")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--query-source", choices=["questions", "docs"], default="questions")
+    parser.add_argument("--ef", type=int, nargs="+", default=[16, 32, 64, 128])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16, 32])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    base = scale(load_vectors(MmapVectorStore.load(args.store, use_mmap=False)), args.scale, rng)
+    queries = load_queries(args.query_source, base, args.queries, rng)
+    print(f"{len(base)} vectors x {base.shape[1]} dims, {len(queries)} queries, k={args.k}")
+
+    flat = make_index(base, "flat")
+    flat.add(base)
+    _, truth = flat.search(queries, args.k)
+
+    print(f"{'index':<10} {'param':<12} {'build s':>8} {'MB':>8} {'recall':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    recall, p50, p99 = measure(flat, queries, args.k, truth)
+    print(f"{'flat':<10} {'-':<12} {0.0:8.2f} {size_mb(flat):8.1f} {recall:8.3f} {p50:8.3f} {p99:8.3f}")
+
+    for kind, knob, values in [("hnsw", "efSearch", args.ef), ("hnsw_sq8", "efSearch", args.ef), ("ivfpq", "nprobe", args.nprobe)]:
+        started = time.perf_counter()
+        try:
+            index = make_index(base, kind)
+            index.add(base)
+        except Exception as e:
+            print(f"{kind:<10} build failed: {e}")
+            continue
+        build_s = time.perf_counter() - started
+        for value in values:
+            configure_search(index, **({"ef_search": value} if knob == "efSearch" else {"nprobe": value}))
+            recall, p50, p99 = measure(index, queries, args.k, truth)
+            print(f"{kind:<10} {knob + '=' + str(value):<12} {build_s:8.2f} {size_mb(index):8.1f} {recall:8.3f} {p50:8.3f} {p99:8.3f}")
@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+import urllib.request
+
+# Benchmark: sessions per box with 1 vs N uvicorn workers.
+# Starts the server (run.py) once per worker count, then ramps concurrent websocket
+# sessions with the ws_load_test client and reports completed turns/s and p99 first frame.
+# A worker count "holds" a session level while p99 first frame stays under --slo seconds.
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.dirname(SCRIPTS_DIR)
+sys.path.insert(0, SCRIPTS_DIR)
+
+from ws_load_test import session, percentile
+
+def wait_ready(port: int, timeout: float) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=2) as r:
+                if r.status == 200:
+                    return True
+        except Exception:
+            time.sleep(1)
+    return False
+
+async def load(port: int, sessions: int, turns: int, timeout: float):
+    uri = f"ws://127.0.0.1:{port}/ws/kagriai"
+    started = time.perf_counter()
+    results = await asyncio.gather(*[session(uri, i, turns, timeout) for i in range(sessions)], return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    firsts, failed = [], 0
+    for r in results:
+        if isinstance(r, Exception):
+            failed += 1
+            continue
+        firsts.extend(r[1])
+    return len(firsts) / elapsed, percentile(firsts, 99), failed
+
+def run_workers(workers: int, args):
+    env = dict(os.environ, WORKERS=str(workers), RELOAD="0", PORT=str(args.port), HOST="127.0.0.1")
+    proc = subprocess.Popen([sys.executable, "run.py"], cwd=BASE_DIR, env=env)
+    try:
+        if not wait_ready(args.port, args.startup_timeout):
+            print(f"workers={workers}: server did not become ready")
+            return
+        held = 0
+        for n in args.sessions:
+            tps, p99, failed = asyncio.run(load(args.port, n, args.turns, args.timeout))
+            ok = failed == 0 and p99 <= args.slo
+            held = n if ok else held
+            print(f"workers={workers:2d} sessions={n:4d} turns/s={tps:7.2f} p99_first_frame={p99*1000:8.1f}ms failed={failed} {'ok' if ok else 'over SLO'}")
+        print(f"workers={workers:2d} -> sessions held within SLO: {held}")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count() or 2])
+    parser.add_argument("--sessions", type=int, nargs="+", default=[8, 16, 32, 64, 128])
+    parser.add_argument("--turns", type=int, default=2)
+    parser.add_argument("--port", type=int, default=8077)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--slo", type=float, default=5.0, help="p99 first-frame budget in seconds")
+    parser.add_argument("--startup-timeout", type=float, default=180.0)
+    args = parser.parse_args()
+    for w in args.workers:
+        run_workers(w, args)
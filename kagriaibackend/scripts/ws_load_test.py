@@ -0,0 +1,81 @@
+import asyncio
+import json
+import time
+import argparse
+import os
+import websockets
+
+# Load test: N concurrent chat sessions, measure gap between stream frames (token latency).
+# Run once against the old build and once against the new one (use --label before/after)
+# and compare p99; a blocked event loop shows up as long gaps for every session at once.
+
+QUERIES = [
+    "Sản phẩm KAGRI có thành phần gì?",
+    "Cách phòng bệnh thán thư trên sầu riêng?",
+    "Địa chỉ công ty ở đâu?",
+    "giá cà phê hôm nay",
+    "Cách bón phân cho cà phê giai đoạn ra hoa?",
+]
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100.0 * (len(values) - 1)))))
+    return values[k]
+
+async def session(uri: str, idx: int, turns: int, timeout: float):
+    gaps = []
+    first_frame = []
+    async with websockets.connect(uri, max_size=None) as ws:
+        for t in range(turns):
+            text = QUERIES[(idx + t) % len(QUERIES)]
+            sent = time.perf_counter()
+            await ws.send(json.dumps({"id": f"load-{idx}", "text": text}))
+            last = None
+            while True:
+                try:
+                    raw = await asyncio.wait_for(ws.recv(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                now = time.perf_counter()
+                msg = json.loads(raw)
+                if msg.get("type") == "stream":
+                    if last is None:
+                        first_frame.append(now - sent)
+                    else:
+                        gaps.append(now - last)
+                    last = now
+                if msg.get("type") in ("end", "error"):
+                    break
+    return gaps, first_frame
+
+async def run(args):
+    uri = f"ws://{args.host}:{args.port}/ws/kagriai"
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *[session(uri, i, args.turns, args.timeout) for i in range(args.sessions)],
+        return_exceptions=True
+    )
+    elapsed = time.perf_counter() - started
+    gaps, firsts, failed = [], [], 0
+    for r in results:
+        if isinstance(r, Exception):
+            failed += 1
+            print(f"Session error: {r}")
+            continue
+        gaps.extend(r[0])
+        firsts.extend(r[1])
+    print(f"[{args.label}] sessions={args.sessions} turns={args.turns} failed={failed} wall={elapsed:.1f}s")
+    print(f"  token gap ms   p50={percentile(gaps, 50)*1000:.1f} p99={percentile(gaps, 99)*1000:.1f} max={max(gaps or [0])*1000:.1f} n={len(gaps)}")
+    print(f"  first frame ms p50={percentile(firsts, 50)*1000:.1f} p99={percentile(firsts, 99)*1000:.1f} n={len(firsts)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=os.getenv("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--label", default="run")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,30 @@
+import os
+import sys
+import sqlite3
+import pytest
+
+# Tests import the app the same way run.py does (from the kagriaibackend directory)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core import database
+from app.core.db_pool import SQLitePool
+
+@pytest.fixture
+def chat_db(tmp_path, monkeypatch):
+    """Fresh migrated chat.db in tmp_path, swapped in for database.chat_pool."""
+    path = str(tmp_path / "chat.db")
+    conn = sqlite3.connect(path)
+    database.apply_migrations(conn, database.CHAT_MIGRATIONS, "chat.db")
+    conn.close()
+    pool = SQLitePool(path)
+    monkeypatch.setattr(database, "chat_pool", pool)
+    yield pool
+    pool.close_all()
+
+@pytest.fixture
+def catalog_db(tmp_path):
+    """Migrated kagri.db in tmp_path (plain sqlite3 connection, like init_db)."""
+    conn = sqlite3.connect(str(tmp_path / "kagri.db"))
+    database.apply_migrations(conn, database.CATALOG_MIGRATIONS, "kagri.db")
+    yield conn
+    conn.close()
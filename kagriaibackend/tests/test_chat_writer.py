@@ -0,0 +1,91 @@
+import asyncio
+from app.core import database
+from app.core.chat_writer import ChatWriter
+
+def _turns(pool, session_id):
+    return [tuple(r) for r in pool.fetchall(
+        "SELECT turn_index, user, ai FROM chat_turns WHERE session_id = ? ORDER BY turn_index", (session_id,))]
+
+def test_queued_writes_share_one_batch(chat_db):
+    async def scenario():
+        writer = ChatWriter(flush_ms=50, max_batch=100, shared=False)
+        writer.start()
+        for sid in ("a", "b"):
+            writer.seed(sid, 0)
+        for i in range(3):
+            for sid in ("a", "b"):
+                idx = await writer.append_user_turn(sid, f"{sid} hỏi {i}")
+                await writer.update_ai_turn(sid, idx, f"{sid} đáp {i}")
+        await writer.stop()
+        return writer
+
+    writer = asyncio.run(scenario())
+    assert writer.metrics["batches"] == 1
+    assert writer.metrics["records"] == 12
+    assert writer.metrics["errors"] == 0
+    assert _turns(chat_db, "a") == [(i, f"a hỏi {i}", f"a đáp {i}") for i in range(3)]
+    assert _turns(chat_db, "b") == [(i, f"b hỏi {i}", f"b đáp {i}") for i in range(3)]
+
+def test_max_batch_splits_batches(chat_db):
+    async def scenario():
+        writer = ChatWriter(flush_ms=50, max_batch=2, shared=False)
+        writer.start()
+        writer.seed("a", 0)
+        for i in range(5):
+            await writer.append_user_turn("a", f"q{i}")
+        await writer.stop()
+        return writer
+
+    writer = asyncio.run(scenario())
+    assert writer.metrics["batches"] == 3
+    assert writer.metrics["records"] == 5
+    assert [t[0] for t in _turns(chat_db, "a")] == [0, 1, 2, 3, 4]
+
+def test_taken_turn_index_is_remapped(chat_db):
+    # Another worker already wrote turn 0 of this session after our counter was seeded
+    database.write_turn_batch([("user_turn", "s", 0, "other worker", None, None), ("ai", "s", 0, "other answer")])
+
+    async def scenario():
+        writer = ChatWriter(flush_ms=20, max_batch=100, shared=False)
+        writer.start()
+        writer.seed("s", 0)
+        idx = await writer.append_user_turn("s", "mine")
+        await writer.update_ai_turn("s", idx, "my answer")
+        await writer.stop()
+        return writer, idx
+
+    writer, idx = asyncio.run(scenario())
+    assert idx == 0
+    assert writer.metrics["reseeded"] == 1
+    assert writer.metrics["dropped"] == 0
+    assert writer.remapped == {"s": {0: 1}}
+    assert writer.turn_counters["s"] == 2
+    # The other worker's turn is untouched and the answer update followed the moved turn
+    assert _turns(chat_db, "s") == [(0, "other worker", "other answer"), (1, "mine", "my answer")]
+
+def test_bad_record_does_not_cost_other_sessions(chat_db):
+    database.write_turn_batch([("user_turn", "s", 0, "other worker", None, None)])
+
+    async def scenario():
+        writer = ChatWriter(flush_ms=20, max_batch=100, shared=False)
+        writer.start()
+        writer.seed("s", 0)
+        writer.seed("t", 0)
+        await writer.append_user_turn("s", "conflicting")
+        await writer.append_user_turn("t", "unrelated")
+        await writer.stop()
+        return writer
+
+    asyncio.run(scenario())
+    assert _turns(chat_db, "t") == [(0, "unrelated", "")]
+    assert [t[1] for t in _turns(chat_db, "s")] == ["other worker", "conflicting"]
+
+def test_direct_writes_without_background_task(chat_db):
+    async def scenario():
+        writer = ChatWriter(shared=False)
+        idx = await writer.append_user_turn("d", "hello")
+        await writer.update_ai_turn("d", idx, "hi")
+        return idx
+
+    assert asyncio.run(scenario()) == 0
+    assert _turns(chat_db, "d") == [(0, "hello", "hi")]
@@ -0,0 +1,111 @@
+import asyncio
+import pytest
+from app.core.session_backend import SessionBackend
+from app.services import conversation
+from app.services.conversation import ConversationManager
+
+class MemoryBackend(SessionBackend):
+    name = "memory"
+
+    def __init__(self):
+        self.turns = {}
+        self.forgotten = []
+
+    async def load(self, session_id, limit=None, before=None):
+        return None
+
+    async def append_user_turn(self, session_id, user, user_image_path, last_product_code):
+        turns = self.turns.setdefault(session_id, [])
+        turns.append(user)
+        return len(turns) - 1
+
+    async def update_ai_turn(self, session_id, turn_index, ai):
+        pass
+
+    async def update_user_image_path(self, session_id, turn_index, user_image_path):
+        pass
+
+    async def set_last_product_code(self, session_id, last_product_code):
+        pass
+
+    def forget(self, session_id):
+        self.forgotten.append(session_id)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(conversation, "time", fake)
+    return fake
+
+def _manager(**kwargs):
+    return ConversationManager(max_turns=5, backend=MemoryBackend(), shared=False, **kwargs)
+
+def _get_all(manager, *session_ids):
+    async def scenario():
+        return [await manager.get(sid) for sid in session_ids]
+    return asyncio.run(scenario())
+
+def test_idle_sessions_expire_after_ttl(clock):
+    manager = _manager(ttl=10, tick=1)
+    idle, touched, pinned = _get_all(manager, "idle", "touched", "pinned")
+    manager.pin(pinned)
+
+    clock.now += 5
+    _get_all(manager, "touched")
+    clock.now += 6
+    manager.cleanup()
+    assert set(manager.conversations) == {"touched", "pinned"}
+    assert manager.counters["ttl_evictions"] == 1
+    assert manager.backend.forgotten == ["idle"]
+
+    clock.now += 5
+    manager.cleanup()
+    assert list(manager.conversations) == ["pinned"]
+    assert manager.counters["ttl_evictions"] == 2
+
+    # Released sessions expire one TTL after the connection closed
+    manager.release("pinned")
+    clock.now += 9
+    manager.cleanup()
+    assert "pinned" in manager.conversations
+    clock.now += 12
+    manager.cleanup()
+    assert manager.conversations == {}
+    assert manager.total_bytes == 0
+
+def test_cleanup_is_a_noop_within_one_tick(clock):
+    manager = _manager(ttl=10, tick=1)
+    _get_all(manager, "a")
+    clock.now += 0.5
+    manager.cleanup()
+    assert "a" in manager.conversations
+
+def test_budget_evicts_least_recently_used_unpinned(clock):
+    manager = _manager(budget_bytes=6000, ttl=3600, tick=1)
+    a, b, c = _get_all(manager, "a", "b", "c")
+    manager.pin(a)
+    manager.add_turn(a, "x" * 2000, "")
+    manager.add_turn(b, "y" * 2000, "")
+    assert manager.counters["budget_evictions"] == 0
+
+    manager.add_turn(c, "z" * 2000, "")
+    assert list(manager.conversations) == ["a", "c"]
+    assert manager.counters["budget_evictions"] == 1
+    assert manager.backend.forgotten == ["b"]
+    assert manager.total_bytes == a.nbytes + c.nbytes <= manager.budget_bytes
+
+def test_window_bytes_follow_the_sliding_window(clock):
+    manager = _manager(ttl=3600, tick=1)
+    (conv,) = _get_all(manager, "a")
+    for i in range(8):
+        manager.add_turn(conv, f"q{i}" * 100, f"a{i}" * 100)
+    assert [t.user[:2] for t in conv.turns] == ["q3", "q4", "q5", "q6", "q7"]
+    assert conv.nbytes == conversation.SESSION_OVERHEAD + sum(t.nbytes for t in conv.turns)
+    assert manager.total_bytes == conv.nbytes
@@ -0,0 +1,32 @@
+import json
+import os
+import pytest
+from app.services.intent_router import IntentRouter, intent_router
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "intent_routing_corpus.jsonl")
+
+def _corpus():
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+@pytest.mark.parametrize("row", _corpus(), ids=lambda row: row["text"])
+def test_corpus_routes_to_its_label(row):
+    assert intent_router.route(row["text"]).intent == row["intent"]
+
+def test_overlapping_keywords_keep_every_group():
+    route = intent_router.route("Hôm nay âm lịch là ngày mấy")
+    assert route.has("lunar")
+    assert route.has("am")
+    assert route.has("time")
+    assert route.intent == "time"
+
+def test_spans_point_at_the_keywords():
+    router = IntentRouter({"fruit": ["sầu riêng", "riêng"], "price": ["giá"]})
+    text = "giá sầu riêng"
+    spans = router.scan(text)
+    assert [text[s:e] for s, e in spans["fruit"]] == ["sầu riêng", "riêng"]
+    assert [text[s:e] for s, e in spans["price"]] == ["giá"]
+
+def test_convert_date_needs_three_numbers():
+    assert intent_router.route("đổi ngày 15/8/2024 sang âm").intent == "convert_date"
+    assert intent_router.route("đổi sang âm").intent != "convert_date"
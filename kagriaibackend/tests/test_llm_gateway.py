@@ -0,0 +1,113 @@
+import asyncio
+import pytest
+from app.services.llm_engine import LLMBusyError, LLMGateway, PRIORITY_CHAT, PRIORITY_CLASSIFY, PRIORITY_WEATHER
+
+class FakeClient:
+    """Stands in for ollama.AsyncClient: records the order generations start in."""
+    def __init__(self):
+        self.started = []
+        self.gates = {}
+
+    def hold(self, prompt):
+        self.gates[prompt] = asyncio.Event()
+        return self.gates[prompt]
+
+    async def generate(self, model, prompt, stream, options, raw, **kwargs):
+        self.started.append(prompt)
+        if prompt in self.gates:
+            await self.gates[prompt].wait()
+        if stream:
+            async def parts():
+                for token in ("a", "b"):
+                    yield {"response": token, "done": False}
+                yield {"response": "", "done": True}
+            return parts()
+        return {"response": prompt, "done": True}
+
+def _gateway(**kwargs):
+    gateway = LLMGateway(**kwargs)
+    client = FakeClient()
+    gateway._client = client
+    gateway._client_loop = asyncio.get_running_loop()
+    return gateway, client
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_waiters_run_by_priority_then_fifo():
+    async def scenario():
+        gateway, client = _gateway(max_in_flight=1, max_queue=8)
+        gate = client.hold("first")
+        tasks = [asyncio.create_task(gateway.generate("first", {}, PRIORITY_CHAT))]
+        await _settle()
+        for prompt, priority in [("weather", PRIORITY_WEATHER), ("classify", PRIORITY_CLASSIFY),
+                                 ("chat-1", PRIORITY_CHAT), ("chat-2", PRIORITY_CHAT)]:
+            tasks.append(asyncio.create_task(gateway.generate(prompt, {}, priority)))
+            await _settle()
+        assert client.started == ["first"]
+        gate.set()
+        await asyncio.gather(*tasks)
+        return gateway, client
+
+    gateway, client = asyncio.run(scenario())
+    assert client.started == ["first", "chat-1", "chat-2", "classify", "weather"]
+    assert gateway.in_flight == 0
+
+def test_full_backlog_is_shed():
+    async def scenario():
+        gateway, client = _gateway(max_in_flight=1, max_queue=1)
+        gate = client.hold("first")
+        running = asyncio.create_task(gateway.generate("first", {}, PRIORITY_CHAT))
+        await _settle()
+        queued = asyncio.create_task(gateway.generate("queued", {}, PRIORITY_CLASSIFY))
+        await _settle()
+        with pytest.raises(LLMBusyError):
+            await gateway.generate("shed", {}, PRIORITY_WEATHER)
+        gate.set()
+        await asyncio.gather(running, queued)
+        return gateway, client
+
+    gateway, client = asyncio.run(scenario())
+    assert client.started == ["first", "queued"]
+    assert gateway.metrics["weather"]["shed"] == 1
+    assert gateway.metrics["weather"]["errors"] == 0
+    assert gateway.in_flight == 0
+
+def test_cancel_while_queued_frees_the_place():
+    async def scenario():
+        gateway, client = _gateway(max_in_flight=1, max_queue=8)
+        gate = client.hold("first")
+        running = asyncio.create_task(gateway.generate("first", {}, PRIORITY_CHAT))
+        await _settle()
+        queued = asyncio.create_task(gateway.generate("queued", {}, PRIORITY_CHAT))
+        await _settle()
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        assert gateway._waiters == []
+        gate.set()
+        await running
+        return gateway, client
+
+    gateway, client = asyncio.run(scenario())
+    assert client.started == ["first"]
+    assert gateway.metrics["chat"]["cancelled"] == 1
+    assert gateway.in_flight == 0
+
+def test_stream_holds_the_slot_until_closed():
+    async def scenario():
+        gateway, client = _gateway(max_in_flight=1, max_queue=8)
+        parts = [p["response"] async for p in gateway.stream("s", {})]
+        assert gateway.in_flight == 0
+
+        stream = gateway.stream("early", {})
+        await stream.__anext__()
+        assert gateway.in_flight == 1
+        await stream.aclose()
+        return gateway, parts
+
+    gateway, parts = asyncio.run(scenario())
+    assert parts == ["a", "b", ""]
+    assert gateway.in_flight == 0
+    assert gateway.metrics["chat"]["cancelled"] == 1
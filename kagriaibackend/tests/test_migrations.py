@@ -0,0 +1,95 @@
+import sqlite3
+import pytest
+from app.core import database
+
+def _indexes(conn, table):
+    return {r[1] for r in conn.execute(f"PRAGMA index_list({table})").fetchall()}
+
+def _fts_rows(conn, fts, query):
+    return [r[0] for r in conn.execute(f"SELECT rowid FROM {fts} WHERE {fts} MATCH ? ORDER BY rowid", (query,)).fetchall()]
+
+def test_chat_migrations_from_scratch_and_rerun(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "chat.db"))
+    assert database.apply_migrations(conn, database.CHAT_MIGRATIONS, "chat.db") == 3
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == 3
+    assert "ux_chat_turns_session_turn" in _indexes(conn, "chat_turns")
+    assert "ix_chat_turns_history" not in _indexes(conn, "chat_turns")
+    # Already at the latest version: nothing runs again
+    assert database.apply_migrations(conn, database.CHAT_MIGRATIONS, "chat.db") == 3
+    conn.close()
+
+def test_unversioned_chat_db_is_renumbered_before_the_unique_index(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "chat.db"))
+    database._chat_v1_schema(conn.cursor())
+    # Racing appends in old builds could store the same turn_index twice
+    conn.executemany("INSERT INTO chat_turns (session_id, turn_index, user, ai) VALUES (?, ?, ?, ?)",
+                     [("s", 0, "q0", "a0"), ("s", 1, "q1", "a1"), ("s", 1, "q2", "a2"), ("t", 0, "x", "y")])
+    conn.commit()
+    database.apply_migrations(conn, database.CHAT_MIGRATIONS, "chat.db")
+    rows = conn.execute("SELECT session_id, turn_index, user FROM chat_turns ORDER BY session_id, turn_index").fetchall()
+    assert rows == [("s", 0, "q0"), ("s", 1, "q1"), ("s", 2, "q2"), ("t", 0, "x")]
+    conn.close()
+
+def test_v3_drops_the_covering_history_index(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "chat.db"))
+    database.apply_migrations(conn, database.CHAT_MIGRATIONS[:2], "chat.db")
+    conn.execute("CREATE INDEX ix_chat_turns_history ON chat_turns (session_id, turn_index, user, ai)")
+    conn.commit()
+    assert database.apply_migrations(conn, database.CHAT_MIGRATIONS, "chat.db") == 3
+    assert "ix_chat_turns_history" not in _indexes(conn, "chat_turns")
+    conn.close()
+
+def test_catalog_migration_is_versioned(catalog_db):
+    assert catalog_db.execute("PRAGMA user_version").fetchone()[0] == database.CATALOG_MIGRATIONS[-1][0]
+    tables = {r[0] for r in catalog_db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {"company_info", "products", "experts"} <= tables
+
+@pytest.fixture
+def fts_db(catalog_db):
+    if not database.fts_available(catalog_db.cursor()):
+        pytest.skip("SQLite built without FTS5")
+    return catalog_db
+
+def test_fts_backfill_and_triggers(fts_db, tmp_path):
+    fts_db.executemany("INSERT INTO products (code, name, usage) VALUES (?, ?, ?)",
+                       [("K1", "Thuốc trừ nấm", "Phòng bệnh thán thư sầu riêng"), ("K2", "Phân bón lá", "Dưỡng đọt")])
+    fts_db.commit()
+    database.init_fts(fts_db.cursor())
+    fts_db.commit()
+    assert fts_db.execute("SELECT COUNT(*) FROM products_fts").fetchone()[0] == 2
+    # Tokenizer folds diacritics: unaccented queries match accented text
+    assert _fts_rows(fts_db, "products_fts", "than thu") == [1]
+
+    # Triggers are plain SQL: another client without any app UDFs can write
+    other = sqlite3.connect(str(tmp_path / "kagri.db"))
+    other.execute("INSERT INTO products (code, name, usage) VALUES ('K3', 'Trừ sâu', 'Sâu vẽ bùa')")
+    other.execute("UPDATE products SET usage = 'Bón gốc' WHERE code = 'K2'")
+    other.execute("DELETE FROM products WHERE code = 'K1'")
+    other.commit()
+    other.close()
+    assert _fts_rows(fts_db, "products_fts", "sau ve bua") == [3]
+    assert _fts_rows(fts_db, "products_fts", "bon goc") == [2]
+    assert _fts_rows(fts_db, "products_fts", "than thu") == []
+
+def test_fts_out_of_sync_is_rebuilt(fts_db):
+    database.init_fts(fts_db.cursor())
+    fts_db.execute("INSERT INTO products (code, name) VALUES ('K1', 'Đồng')")
+    fts_db.execute("DELETE FROM products_fts")
+    fts_db.commit()
+    database.init_fts(fts_db.cursor())
+    fts_db.commit()
+    assert _fts_rows(fts_db, "products_fts", "đồng") == [1]
+
+def test_old_fts_layout_is_dropped_and_rebuilt(fts_db):
+    fts_db.execute("INSERT INTO products (code, name) VALUES ('K1', 'Thán thư')")
+    fts_db.execute("CREATE VIRTUAL TABLE products_fts USING fts5(code, name, name_folded, tokenize='unicode61')")
+    fts_db.execute("CREATE TRIGGER products_fts_ai AFTER INSERT ON products BEGIN SELECT 1; END")
+    fts_db.commit()
+    database.init_fts(fts_db.cursor())
+    fts_db.commit()
+    sql = fts_db.execute("SELECT sql FROM sqlite_master WHERE name = 'products_fts'").fetchone()[0]
+    assert database.FTS_TOKENIZER in sql
+    assert "name_folded" not in sql
+    assert _fts_rows(fts_db, "products_fts", "than thu") == [1]
+    fts_db.execute("INSERT INTO products (code, name) VALUES ('K2', 'Thán thư 2')")
+    assert _fts_rows(fts_db, "products_fts", "than thu") == [1, 2]
@@ -0,0 +1,58 @@
+import pytest
+from app.utils.text_processing import SentenceBuffer
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def _feed(buffer, tokens):
+    chunks = []
+    for token in tokens:
+        chunks.extend(buffer.add_token(token))
+    return chunks, buffer.flush()
+
+def test_sentence_policy_emits_one_chunk_per_sentence():
+    chunks, rest = _feed(SentenceBuffer("sentence"), ["Xin", " chào.", " Bạn", " khỏe", " không?", " Tốt"])
+    assert chunks == ["Xin chào.", "Bạn khỏe không?"]
+    assert rest == "Tốt"
+
+def test_sentence_policy_cuts_long_runs_at_spaces():
+    words = "một hai ba bốn năm sáu bảy tám chín mười mười một".split()
+    chunks, rest = _feed(SentenceBuffer("sentence", max_chars=20), [w + " " for w in words])
+    assert len(chunks) == 2
+    assert all(c.endswith(" ") for c in chunks)
+    assert " ".join(chunks + [rest]).split() == words
+
+def test_sentence_policy_keeps_table_rows_whole():
+    rows = ["| a | b |\n", "| c | d |\n", "| e | f |\n", "| g"]
+    chunks, rest = _feed(SentenceBuffer("sentence", max_chars=20), rows)
+    assert chunks == ["| a | b |\n| c | d |\n"]
+    assert rest == "| e | f |\n| g"
+
+def test_chars_policy_coalesces_up_to_the_last_sentence_end():
+    tokens = ["Câu một. ", "Câu hai. ", "Câu ba. ", "Câu bốn. ", "Câu năm. ", "Hết"]
+    chunks, rest = _feed(SentenceBuffer("chars", max_chars=30), tokens)
+    assert chunks == ["Câu một. Câu hai. Câu ba. Câu bốn."]
+    assert rest == "Câu năm. Hết"
+
+def test_latency_policy_flushes_stale_words():
+    clock = FakeClock()
+    buffer = SentenceBuffer("latency", max_latency_ms=100, clock=clock)
+    assert buffer.add_token("xin ") == []
+    clock.now = 0.05
+    assert buffer.add_token("chào ") == []
+    clock.now = 0.2
+    assert buffer.add_token("bạn") == ["xin chào "]
+    clock.now = 0.25
+    assert buffer.add_token(" ơi") == []
+    clock.now = 0.5
+    assert buffer.add_token(".") == ["bạn "]
+    assert buffer.add_token(" Vâng") == ["ơi."]
+    assert buffer.flush() == "Vâng"
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        SentenceBuffer("words")
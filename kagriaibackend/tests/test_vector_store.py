@@ -0,0 +1,48 @@
+import os
+import numpy as np
+import pytest
+from app.services.vector_store import DOCS_FILE, MmapVectorStore
+
+TEXTS = ["Thán thư sầu riêng", "Gỉ sắt cà phê", "Phân bón lá", "Rệp sáp", "Bọ trĩ"]
+METAS = [{"source": f"doc{i}.pdf", "page": i} for i in range(len(TEXTS))]
+
+@pytest.fixture
+def vectors():
+    return np.random.default_rng(0).random((len(TEXTS), 8), dtype=np.float32)
+
+@pytest.mark.parametrize("use_mmap", [True, False])
+def test_save_load_round_trip(tmp_path, vectors, use_mmap):
+    store = MmapVectorStore.from_texts(TEXTS, METAS, vectors, kind="flat")
+    store.save(str(tmp_path))
+    assert MmapVectorStore.exists(str(tmp_path))
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+    loaded = MmapVectorStore.load(str(tmp_path), use_mmap=use_mmap)
+    assert len(loaded) == len(TEXTS)
+    assert loaded.kind == "flat"
+    assert (loaded.path is not None) == use_mmap
+    for row, (text, meta) in enumerate(zip(TEXTS, METAS)):
+        chunk = loaded.get(row)
+        assert (chunk.page_content, chunk.metadata) == (text, meta)
+    hits = loaded.similarity_search_with_score_by_vector(vectors[2].tolist(), k=2)
+    assert hits[0][0].page_content == TEXTS[2]
+    assert hits[0][1] == pytest.approx(0.0, abs=1e-5)
+
+def test_add_to_mapped_store_copies_before_writing(tmp_path, vectors):
+    MmapVectorStore.from_texts(TEXTS[:3], METAS[:3], vectors[:3], kind="flat").save(str(tmp_path))
+    loaded = MmapVectorStore.load(str(tmp_path), use_mmap=True)
+    loaded.add(TEXTS[3:], METAS[3:], vectors[3:], kind="flat")
+    assert loaded.path is None
+    assert len(loaded) == len(TEXTS)
+    assert loaded.get(4).page_content == TEXTS[4]
+    # The files on disk are unchanged until the new store is saved
+    assert len(MmapVectorStore.load(str(tmp_path), use_mmap=True)) == 3
+    loaded.save(str(tmp_path))
+    assert [MmapVectorStore.load(str(tmp_path)).get(i).page_content for i in range(5)] == TEXTS
+
+def test_inconsistent_docstore_is_rejected(tmp_path, vectors):
+    MmapVectorStore.from_texts(TEXTS, METAS, vectors, kind="flat").save(str(tmp_path))
+    with open(os.path.join(tmp_path, DOCS_FILE), "ab") as f:
+        f.write(b'{"text": "stray", "metadata": {}}\n')
+    with pytest.raises(ValueError):
+        MmapVectorStore.load(str(tmp_path))